@@ -25,11 +25,24 @@ import os
 import subprocess
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List
 
+from githubbuilder.daemon import (
+    oneshot_action_cmd,
+    query_queue,
+    request_action,
+)
+from githubbuilder.job_queue import JobQueue
+from githubbuilder.upload_batch import UploadBatch
+from githubbuilder.upload_batch import request_id as upload_request_id
+
 log = logging.getLogger("github-command")
 
+# Builder instances updated and running an action at the same time
+MAX_PARALLEL_BUILDERS = 4
+
 
 class GithubCommandError(Exception):
     pass
@@ -145,9 +158,46 @@ def _run_dispatch(args):
     if not args.no_builders_update:
         run_command(cmd, wait=args.wait, ignore_exit_codes=(0, 11))
 
+    # Arguments of the action, common to every builder instance
+    action_args = []
+    if args.command == "Build-component":
+        assert component_name
+        action_args += [component_name]
+    elif args.command == "Upload-component":
+        assert (
+            component_name
+            and commit_sha
+            and repository_publish
+            and distribution_name
+        )
+        action_args += [
+            component_name,
+            commit_sha,
+            repository_publish,
+        ]
+        if distribution_name == "all":
+            action_args += ["--distribution", "all"]
+        else:
+            for d in distribution_name.split(","):
+                action_args += ["--distribution", d]
+    elif args.command == "Build-template":
+        assert template_name and template_timestamp
+        action_args += [template_name, template_timestamp]
+    elif args.command == "Upload-template":
+        assert template_name and template_sha and repository_publish
+        action_args += [
+            template_name,
+            template_sha,
+            repository_publish,
+        ]
+    elif args.command == "Build-iso":
+        assert iso_version and iso_timestamp
+        action_args += [iso_version, iso_timestamp]
+
     with open(args.config_file, "r") as f:
         content = f.read().splitlines()
 
+    builders = []
     for line in content:
         builder_release_name, builder_dir_str, builder_conf = line.split("=")
 
@@ -160,104 +210,199 @@ def _run_dispatch(args):
             log.info(f"Requested release does not match builder release.")
             continue
 
-        builder_dir = Path(builder_dir_str).resolve()
-
-        # Update Qubes Builder
-        cmd = [
-            "flock",
-            "-x",
-            "-n",
-            "-E",
-            "11",
-            str(builder_dir / "builder.lock"),
-            str(scripts_dir / "utils/update-qubes-builder"),
-            str(builder_dir),
-        ]
-        if not args.no_builders_update:
-            run_command(cmd, wait=args.wait, ignore_exit_codes=(0, 11))
+        builders.append((Path(builder_dir_str).resolve(), builder_conf))
 
-        # Prepare github-command action invocation
-        action_cmd = [str(scripts_dir / "github-command.py"), "action"]
-        if args.signer_fpr:
-            action_cmd += ["--signer-fpr", args.signer_fpr]
-        else:
-            action_cmd += ["--no-signer-github-command-check"]
+    if not builders:
+        return
 
-        if args.local_log_file:
-            action_cmd += ["--local-log-file", args.local_log_file]
+    # Builder instances don't share anything: update and run the action of
+    # each of them concurrently.
+    failures = []
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(args.max_parallel, len(builders)))
+    ) as executor:
+        futures = {
+            executor.submit(
+                _dispatch_to_builder,
+                args,
+                scripts_dir,
+                builder_dir,
+                builder_conf,
+                action_args,
+            ): builder_dir
+            for builder_dir, builder_conf in builders
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f"{futures[future]}: {str(e)}")
+                failures.append(f"{futures[future]}: {str(e)}")
+    if failures:
+        raise GithubCommandError(
+            f"Failed to dispatch to {len(failures)}/{len(builders)} builders: "
+            + "; ".join(failures)
+        )
 
-        action_cmd += [
-            str(args.command).lower(),
-            str(builder_dir),
-            builder_conf,
-        ]
-        if args.command == "Build-component":
-            assert component_name
-            action_cmd += [component_name]
-        elif args.command == "Upload-component":
-            assert (
-                component_name
-                and commit_sha
-                and repository_publish
-                and distribution_name
-            )
-            action_cmd += [
-                component_name,
-                commit_sha,
-                repository_publish,
-            ]
-            if distribution_name == "all":
-                action_cmd += ["--distribution", "all"]
-            else:
-                for d in distribution_name.split(","):
-                    action_cmd += ["--distribution", d]
-        elif args.command == "Build-template":
-            assert template_name and template_timestamp
-            action_cmd += [template_name, template_timestamp]
-        elif args.command == "Upload-template":
-            assert template_name and template_sha and repository_publish
-            action_cmd += [
-                template_name,
-                template_sha,
-                repository_publish,
-            ]
-        elif args.command == "Build-iso":
-            assert iso_version and iso_timestamp
-            action_cmd += [iso_version, iso_timestamp]
-
-        cmd = [
-            "flock",
-            "-x",
-            str(builder_dir / "builder.lock"),
-            "bash",
-            "-c",
-            " ".join(action_cmd),
-        ]
+
+def _dispatch_to_builder(
+    args, scripts_dir, builder_dir, builder_conf, action_args
+):
+    # Update Qubes Builder
+    cmd = [
+        "flock",
+        "-x",
+        "-n",
+        "-E",
+        "11",
+        str(builder_dir / "builder.lock"),
+        str(scripts_dir / "utils/update-qubes-builder"),
+        str(builder_dir),
+    ]
+    if not args.no_builders_update:
+        run_command(cmd, wait=args.wait, ignore_exit_codes=(0, 11))
+
+    # Prepare github-command action invocation
+    action_cmd = [str(scripts_dir / "github-command.py"), "action"]
+    if args.signer_fpr:
+        action_cmd += ["--signer-fpr", args.signer_fpr]
+    else:
+        action_cmd += ["--no-signer-github-command-check"]
+
+    if args.local_log_file:
+        action_cmd += ["--local-log-file", args.local_log_file]
+
+    if args.force_rebuild:
+        action_cmd += ["--force-rebuild"]
+
+    action_cmd += [
+        str(args.command).lower(),
+        str(builder_dir),
+        builder_conf,
+        *action_args,
+    ]
+
+    if args.command == "Upload-component":
+        # Known before the action starts, to be uploaded with other commands
+        # received meanwhile
+        _add_upload_request(builder_dir, action_cmd[2:])
+
+    if not args.no_daemon:
+        reply = request_action(builder_dir, action_cmd[2:], wait=args.wait)
+        if reply is not None:
+            if reply.get("status") == "failed":
+                raise GithubCommandError(
+                    f"Failed to run action: {reply.get('error')}"
+                )
+            return
+
+    # Actions are run by priority by the worker of the builder, each of them
+    # holding builder.lock
+    job_queue = JobQueue(builder_dir)
+    job_id = job_queue.put(action_cmd[2:], wait=args.wait)
+
+    def start_worker():
+        # exits at once if a worker is running already
         run_command(
-            cmd,
-            wait=args.wait,
-            env={
-                "PYTHONPATH": f"{builder_dir!s}:{os.environ.get('PYTHONPATH','')}",
-                **os.environ,
-            },
+            [
+                str(scripts_dir / "github-command.py"),
+                "worker",
+                "--scripts-dir",
+                str(scripts_dir),
+                str(builder_dir),
+            ]
         )
 
+    start_worker()
+    if args.wait:
+        # other jobs are run by the worker, not in this process
+        reply = job_queue.wait_result(job_id, start_worker=start_worker)
+        if reply.get("status") == "failed":
+            raise GithubCommandError(
+                f"Failed to run action: {reply.get('error')}"
+            )
+
+
+def _run_queued_action(builder_dir, scripts_dir, argv):
+    run_command(
+        oneshot_action_cmd(builder_dir, scripts_dir, argv),
+        wait=True,
+        env={
+            "PYTHONPATH": f"{builder_dir!s}:{os.environ.get('PYTHONPATH','')}",
+            **os.environ,
+        },
+    )
+
+
+def _add_upload_request(builder_dir, argv):
+    action_args = build_parser().parse_args(["action", *argv])
+    try:
+        UploadBatch(builder_dir, action_args.repository_publish).add(
+            _upload_request_id(action_args), argv
+        )
+    except OSError as e:
+        log.warning(f"Cannot store upload request: {str(e)}")
+
 
 #
 # action subcommand
 #
 
 
-def _run_action(args):
+def _run_action(args, config=None, context=None):
+    from githubbuilder.action import AutoActionTimeout, CommitMismatchError
+    from githubbuilder.context import ActionContext
+    from qubesbuilder.config import Config
+    from qubesbuilder.log import QubesBuilderLogger
+
+    log_action = QubesBuilderLogger
+
+    if config is None:
+        config = Config(args.builder_conf)
+    # Plugin managers, GitHub clients and templates shared by all actions
+    if context is None:
+        context = ActionContext()
+
+    if args.subcommand == "upload-component" and _run_upload_batch(
+        args, config, context
+    ):
+        return
+
+    cli_list = _get_actions(args, config, context)
+    try:
+        for cli in cli_list:
+            try:
+                if args.subcommand in (
+                    "build-component",
+                    "build-template",
+                    "build-iso",
+                ):
+                    cli.build()
+                elif args.subcommand in (
+                    "upload-component",
+                    "upload-template",
+                ):
+                    cli.upload()
+                else:
+                    return
+            except CommitMismatchError as exc:
+                # this is expected for multi-branch components, don't interrupt processing
+                log_action.warning(str(exc))
+            except AutoActionTimeout as autobuild_exc:
+                raise AutoActionTimeout(str(autobuild_exc)) from autobuild_exc
+    finally:
+        for cli in cli_list:
+            cli.wait_notifications()
+
+
+def _get_actions(args, config, context) -> List:
     from githubbuilder.action import (
         AutoAction,
         AutoActionTemplate,
         AutoActionISO,
         AutoActionError,
-        AutoActionTimeout,
-        CommitMismatchError,
     )
-    from qubesbuilder.config import Config, ConfigError
+    from qubesbuilder.config import ConfigError
     from qubesbuilder.log import QubesBuilderLogger
 
     log_action = QubesBuilderLogger
@@ -287,7 +432,6 @@ def _run_action(args):
     )
 
     cli_list: List = []
-    config = Config(args.builder_conf)
     dry_run = args.dry_run or config.get("github", {}).get("dry-run", False)
 
     if args.subcommand in ("build-component", "upload-component"):
@@ -315,7 +459,7 @@ def _run_action(args):
                 ]
             if not components:
                 log_action.info("Cannot find any allowed components.")
-                return
+                return []
 
             # maintainers distributions filtering (only supported for upload)
             if args.subcommand == "upload-component":
@@ -339,7 +483,7 @@ def _run_action(args):
                 ]
                 if not distributions:
                     log_action.info("Cannot find any allowed distributions.")
-                    return
+                    return []
 
         for component in components:
             cli_list.append(
@@ -353,12 +497,14 @@ def _run_action(args):
                     repository_publish=repository_publish,
                     local_log_file=local_log_file,
                     dry_run=dry_run,
+                    context=context,
+                    force_rebuild=args.force_rebuild,
                 )
             )
     elif args.subcommand in ("build-template", "upload-template"):
         supported_templates = [t.name for t in config.get_templates()]
         if args.template_name not in supported_templates:
-            return
+            return []
         if not args.no_signer_github_command_check:
             allowed_templates = (
                 config.get("github", {})
@@ -369,7 +515,7 @@ def _run_action(args):
             if allowed_templates == "_all_":
                 allowed_templates = supported_templates
             if args.template_name not in allowed_templates:
-                return
+                return []
         cli_list.append(
             AutoActionTemplate(
                 builder_dir=args.builder_dir,
@@ -381,6 +527,7 @@ def _run_action(args):
                 repository_publish=repository_publish,
                 local_log_file=local_log_file,
                 dry_run=dry_run,
+                context=context,
             )
         )
     elif args.subcommand == "build-iso":
@@ -393,7 +540,7 @@ def _run_action(args):
             )
             if not allowed_to_trigger_build_iso:
                 log_action.info("Trigger build for ISO is not allowed.")
-                return
+                return []
         cli_list.append(
             AutoActionISO(
                 builder_dir=args.builder_dir,
@@ -404,28 +551,154 @@ def _run_action(args):
                 repository_publish=repository_publish,
                 local_log_file=local_log_file,
                 dry_run=dry_run,
+                context=context,
             )
         )
-    else:
-        return
+    return cli_list
+
 
-    for cli in cli_list:
+def _upload_request_id(args) -> str:
+    return upload_request_id(
+        args.builder_conf,
+        args.component_name,
+        args.commit_sha,
+        args.distribution,
+    )
+
+
+def _run_upload_batch(args, config, context) -> bool:
+    """
+    Upload together Upload-component commands of the same repository
+    received within the batch window. Return True if the command has been
+    handled that way.
+    """
+    from githubbuilder.action import upload_components
+    from qubesbuilder.log import QubesBuilderLogger
+
+    log_action = QubesBuilderLogger
+
+    batch = UploadBatch(args.builder_dir, args.repository_publish)
+    req_id = _upload_request_id(args)
+    if batch.take_done(req_id):
+        log_action.info("Already uploaded with another Upload-component.")
+        return True
+    window = config.get("github", {}).get("upload-batch-window", 0)
+    if not window:
+        batch.discard(req_id)
+        return False
+
+    parser = build_parser()
+    requests = []
+    for other_id, request in batch.collect(window).items():
+        if other_id == req_id:
+            continue
+        other_args = parser.parse_args(["action", *request["argv"]])
+        if (
+            other_args.subcommand != "upload-component"
+            or other_args.builder_dir.resolve() != args.builder_dir.resolve()
+            or other_args.builder_conf != args.builder_conf
+        ):
+            continue
+        # run like this command, only the request itself is taken
+        other_args.dry_run = args.dry_run
+        other_args.state_dir = args.state_dir
+        other_args.local_log_file = args.local_log_file
+        requests.append((other_id, other_args))
+    batch.discard(req_id)
+    if not requests:
+        return False
+
+    cli_list = _get_actions(args, config, context)
+    batched = []
+    for other_id, other_args in requests:
         try:
-            if args.subcommand in (
-                "build-component",
-                "build-template",
-                "build-iso",
-            ):
-                cli.build()
-            elif args.subcommand in ("upload-component", "upload-template"):
-                cli.upload()
-            else:
-                return
-        except CommitMismatchError as exc:
-            # this is expected for multi-branch components, don't interrupt processing
-            log_action.warning(str(exc))
-        except AutoActionTimeout as autobuild_exc:
-            raise AutoActionTimeout(str(autobuild_exc)) from autobuild_exc
+            other_cli_list = _get_actions(other_args, config, context)
+        except Exception as e:
+            # left to its own action, to be reported there
+            log_action.warning(f"Cannot batch upload request: {str(e)}")
+            continue
+        cli_list += other_cli_list
+        batched.append((other_id, other_cli_list))
+    log_action.info(
+        f"Uploading {len(batched) + 1} Upload-component commands together."
+    )
+    try:
+        uploaded = upload_components(cli_list)
+    finally:
+        for cli in cli_list:
+            cli.wait_notifications()
+    # requests not uploaded are left pending, for their own action
+    for other_id, other_cli_list in batched:
+        if all(cli in uploaded for cli in other_cli_list):
+            batch.mark_done(other_id)
+    return True
+
+
+#
+# serve subcommand
+#
+
+
+def _run_serve(args):
+    logging.basicConfig(level=logging.INFO)
+    builder_dir = args.builder_dir.resolve()
+    sys.path.insert(0, str(builder_dir))
+
+    # Loaded once for every action run by the daemon
+    import githubbuilder.action  # noqa: F401
+    from githubbuilder.context import ActionContext
+    from githubbuilder.daemon import ActionDaemon, ConfigCache
+    from qubesbuilder.config import Config
+
+    configs = ConfigCache(Config)
+    context = ActionContext()
+    parser = build_parser()
+
+    def run(argv):
+        action_args = parser.parse_args(["action", *argv])
+        if action_args.builder_dir.resolve() != builder_dir:
+            raise GithubCommandError(
+                f"Action for another builder: {action_args.builder_dir}"
+            )
+        _run_action(
+            action_args,
+            config=configs.get(action_args.builder_conf),
+            context=context,
+        )
+
+    daemon = ActionDaemon(builder_dir, run)
+    if daemon.serve_forever():
+        log.info("Sources have been updated, restarting.")
+        os.execv(sys.executable, [sys.executable, *sys.argv])
+
+
+#
+# worker and queue-status subcommands
+#
+
+
+def _run_worker(args):
+    logging.basicConfig(level=logging.INFO)
+    builder_dir = args.builder_dir.resolve()
+    scripts_dir = Path(args.scripts_dir).resolve()
+    if not JobQueue(builder_dir).drain(
+        lambda argv: _run_queued_action(builder_dir, scripts_dir, argv)
+    ):
+        log.info("Actions are run by another worker.")
+
+
+def _run_queue_status(args):
+    builder_dir = args.builder_dir.resolve()
+    jobs = JobQueue(builder_dir).pending()
+    daemon_jobs = query_queue(builder_dir)
+    print(f"{builder_dir}: {len(jobs)} queued actions")
+    for job in jobs:
+        state = "running" if job["running"] else f"priority {job['priority']}"
+        print(f"  [{state}] {' '.join(job['argv'])}")
+    if daemon_jobs is not None:
+        print(f"{builder_dir}: {len(daemon_jobs)} actions queued by daemon")
+        for job in daemon_jobs:
+            print(f"  [priority {job['priority']}] {' '.join(job['argv'])}")
 
 
 #
@@ -470,6 +743,24 @@ def build_parser() -> argparse.ArgumentParser:
         "--local-log-file",
         help="Use local log file instead of qubesbuilder.BuildLog RPC.",
     )
+    dispatch.add_argument(
+        "--no-daemon",
+        action="store_true",
+        default=False,
+        help="Don't send actions to a running 'serve' daemon.",
+    )
+    dispatch.add_argument(
+        "--force-rebuild",
+        action="store_true",
+        default=False,
+        help="Build components even if already built from the same sources.",
+    )
+    dispatch.add_argument(
+        "--max-parallel",
+        type=int,
+        default=MAX_PARALLEL_BUILDERS,
+        help="Maximum number of builders to dispatch to concurrently.",
+    )
     signer = dispatch.add_mutually_exclusive_group()
     signer.add_argument(
         "--no-signer-github-command-check",
@@ -500,6 +791,12 @@ def build_parser() -> argparse.ArgumentParser:
         "--signer-fpr", help="Signer GitHub command fingerprint."
     )
     action.add_argument("--dry-run", action="store_true", default=False)
+    action.add_argument(
+        "--force-rebuild",
+        action="store_true",
+        default=False,
+        help="Build components even if already built from the same sources.",
+    )
     action.add_argument(
         "--state-dir",
         default=Path.home() / "github-notify-state",
@@ -545,6 +842,34 @@ def build_parser() -> argparse.ArgumentParser:
     build_iso.add_argument("iso_timestamp")
     build_iso.add_argument("--final", action="store_true", default=False)
 
+    # serve
+    serve = subparsers.add_parser(
+        "serve",
+        help="Run actions sent by dispatch for a builder in a long-lived process.",
+    )
+    serve.set_defaults(func=_run_serve)
+    serve.add_argument("builder_dir", type=Path)
+
+    # worker
+    worker = subparsers.add_parser(
+        "worker",
+        help="Run actions queued by dispatch for a builder, by priority.",
+    )
+    worker.set_defaults(func=_run_worker)
+    worker.add_argument(
+        "--scripts-dir",
+        default=Path("/usr/local/lib/qubes-builder-github"),
+    )
+    worker.add_argument("builder_dir", type=Path)
+
+    # queue-status
+    queue_status = subparsers.add_parser(
+        "queue-status",
+        help="Show actions waiting to be run for a builder.",
+    )
+    queue_status.set_defaults(func=_run_queue_status)
+    queue_status.add_argument("builder_dir", type=Path)
+
     return parser
 
 
@@ -26,15 +26,28 @@
 # - upload to current-testing repository
 
 import datetime
+import itertools
+import math
 import os
+import queue
 import re
 import signal
 import subprocess
+import threading
+import time
 from abc import abstractmethod, ABC
 from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
-from logging import Handler, DEBUG, Logger
+from logging import (
+    Filter,
+    Handler,
+    LogRecord,
+    StreamHandler,
+    DEBUG,
+    ERROR,
+    Logger,
+)
 from pathlib import Path
 from typing import List, Optional, Any
 from urllib.parse import urljoin
@@ -65,13 +78,50 @@ from qubesbuilder.log import (
     create_console_handler,
 )
 from qubesbuilder.component import ComponentError
-from qubesbuilder.pluginmanager import PluginManager
+from qubesbuilder.distribution import QubesDistribution
 
+from githubbuilder.build_ledger import BuildLedger, config_digest
+from githubbuilder.context import ActionContext
+from githubbuilder.git_metadata import open_repo_view
+from githubbuilder.job_queue import superseded_markers
 from githubbuilder.notify_issues import NotifyIssueCli, NotifyIssueError
+from githubbuilder.notify_queue import NotifyQueue
 
 # Root of the qubes-builder-github repository
 PROJECT_PATH = Path(__file__).resolve().parent.parent
 
+# Stages writing into the shared repository, never run concurrently
+SERIALIZED_STAGES = ("publish", "upload")
+
+# Build logs forwarded to qubesbuilder.BuildLog are written through a buffer
+# of this size and flushed at least every LOG_FLUSH_INTERVAL seconds
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 0.5
+
+# On timeout, stage processes of distributions built in parallel get this
+# long to exit after SIGTERM, before being killed
+STOP_GRACE_PERIOD = 30
+
+# Builder configuration options changing what is built, digested in build
+# ledger keys (the github section doesn't)
+BUILD_CONFIG_KEYS = (
+    "qubes-release",
+    "distributions",
+    "components",
+    "stages",
+    "executor",
+    "plugins",
+    "sign-key",
+    "gpg-client",
+    "use-qubes-repo",
+    "increment-devel-versions",
+    "fetch-versions-only",
+    "skip-files-fetch",
+    "template-root-size",
+    "cache",
+    "debug",
+)
+
 init_logger(verbose=True)
 log = QubesBuilderLogger
 
@@ -141,7 +191,9 @@ def get_log_file_from_qubesbuilder_buildlog(stdout, logger=None):
             )
         return None
 
-    for raw in stdout.splitlines():
+    # With live logs, the name reserved at start is reported before the
+    # final one (possibly compressed)
+    for raw in reversed(stdout.splitlines()):
         line = raw.strip()
         if not line:
             continue
@@ -159,6 +211,34 @@ def raise_timeout(signum, frame):
     raise TimeoutError
 
 
+def descendant_pids(pid: int) -> list[int]:
+    """Return PIDs of all processes started by pid, children first."""
+    children: dict[int, list[int]] = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # the command name may contain spaces and parentheses
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+            ppid = int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(stat_path.parent.name))
+    pids = []
+    todo = list(children.get(pid, []))
+    while todo:
+        child = todo.pop(0)
+        pids.append(child)
+        todo += children.get(child, [])
+    return pids
+
+
+def signal_descendants(sig: int):
+    for pid in descendant_pids(os.getpid()):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+
 @contextmanager
 def timeout(seconds: int):
     old_handler = signal.getsignal(signal.SIGALRM)
@@ -175,13 +255,26 @@ class SafeWrapper(Handler):
     """
     Wrap an existing handler to BrokenPipeError. On first BrokenPipe,
     disables itself and optionally removes itself from logger.
+
+    With a flush interval, records written to a stream handler are batched
+    and flushed at most flush_interval seconds later, or immediately for
+    records at flush_level and above.
     """
 
-    def __init__(self, inner: Handler, parent_logger: Logger | None = None):
+    def __init__(
+        self,
+        inner: Handler,
+        parent_logger: Logger | None = None,
+        flush_interval: float = 0,
+        flush_level: int = ERROR,
+    ):
         super().__init__(level=inner.level)
         self.inner = inner
         self.parent_logger = parent_logger
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
         self._disabled = False
+        self._flush_timer: Optional[threading.Timer] = None
 
         # Keep existing formatting
         try:
@@ -189,41 +282,102 @@ class SafeWrapper(Handler):
         except Exception:
             pass
 
-    def emit(self, record):
-        if self._disabled:
-            return
-        try:
-            self.inner.emit(record)
+    def _disable(self):
+        self._disabled = True
+        self._cancel_flush_timer()
+        # detach so future logging doesn't keep trying
+        if self.parent_logger is not None:
             try:
-                self.inner.flush()
-            except Exception:
-                pass
-        except BrokenPipeError:
-            self._disabled = True
-            # detach so future logging doesn't keep trying
-            if self.parent_logger is not None:
-                try:
-                    self.parent_logger.removeHandler(self)
-                except Exception:
-                    pass
-            try:
-                self.inner.close()
+                self.parent_logger.removeHandler(self)
             except Exception:
                 pass
+        try:
+            self.inner.close()
+        except Exception:
+            pass
 
-    def flush(self):
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _flush_inner(self):
+        self._cancel_flush_timer()
         try:
             self.inner.flush()
+        except BrokenPipeError:
+            self._disable()
         except Exception:
             pass
 
+    def _timed_flush(self):
+        self.acquire()
+        try:
+            self._flush_timer = None
+            if not self._disabled:
+                self._flush_inner()
+        finally:
+            self.release()
+
+    def emit(self, record):
+        if self._disabled:
+            return
+        try:
+            if self.flush_interval and isinstance(self.inner, StreamHandler):
+                # StreamHandler.emit() would flush every record
+                msg = self.inner.format(record)
+                self.inner.stream.write(msg + self.inner.terminator)
+                if record.levelno >= self.flush_level:
+                    self._flush_inner()
+                elif self._flush_timer is None:
+                    self._flush_timer = threading.Timer(
+                        self.flush_interval, self._timed_flush
+                    )
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+            else:
+                self.inner.emit(record)
+                self._flush_inner()
+        except BrokenPipeError:
+            self._disable()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self._disabled:
+                self._flush_inner()
+        finally:
+            self.release()
+
     def close(self):
         try:
+            self.flush()
             self.inner.close()
         finally:
             super().close()
 
 
+class ThreadLogFilter(Filter):
+    """
+    Drop records emitted by other build worker threads so that each
+    distribution built in parallel gets its own log. Records from any other
+    thread (e.g. helper threads of executors) are kept.
+    """
+
+    def __init__(self, worker_threads: set):
+        super().__init__()
+        self.thread_id = threading.get_ident()
+        self.worker_threads = worker_threads
+
+    def filter(self, record):
+        return (
+            record.thread == self.thread_id
+            or record.thread not in self.worker_threads
+        )
+
+
 class TailBufferHandler(Handler):
     def __init__(self, capacity=30, level=DEBUG, formatter=None):
         super().__init__(level)
@@ -233,17 +387,27 @@ class TailBufferHandler(Handler):
             self.setFormatter(formatter)
 
     def emit(self, record):
+        # only the last records are reported, format them when needed
+        self.buffer.append(record)
+
+    def _format_entry(self, entry):
+        if not isinstance(entry, LogRecord):
+            return entry
         try:
-            self.buffer.append(self.format(record))
+            return self.format(entry)
         except Exception:
-            self.buffer.append(record.getMessage())
+            return entry.getMessage()
 
     def text(self, header=None):
         if not self.buffer:
             return None
         if not header:
             header = f"Last {self.capacity} log lines"
-        return header + ":\n" + "\n".join(self.buffer)
+        return (
+            header
+            + ":\n"
+            + "\n".join(self._format_entry(entry) for entry in self.buffer)
+        )
 
 
 class AutoActionError(Exception):
@@ -261,6 +425,10 @@ class CommitMismatchError(AutoActionError):
     pass
 
 
+class BuildSupersededError(Exception):
+    pass
+
+
 class BaseAutoAction(ABC):
     def __init__(
         self,
@@ -272,11 +440,16 @@ class BaseAutoAction(ABC):
         local_log_file=None,
         dry_run=False,
         source_dir=None,
+        context: Optional[ActionContext] = None,
     ):
         self.builder_dir = Path(builder_dir).resolve()
         self.state_dir = Path(state_dir).resolve()
         self.config = config
-        self.manager = PluginManager(self.config.get_plugins_dirs())
+        # Shared with other actions run by the same process
+        self.context = context or ActionContext()
+        self.manager = self.context.get_plugin_manager(
+            self.config.get_plugins_dirs()
+        )
         self.timeout = 21600
         self.qubes_release = self.config.get("qubes-release")
         self.commit_sha = commit_sha
@@ -298,6 +471,7 @@ class BaseAutoAction(ABC):
         self.logs_repo = self.config.get("github", {}).get(
             "logs-repo", "QubesOS/build-logs"
         )
+        self.live_log = self.config.get("github", {}).get("live-log", False)
 
         self.env = os.environ.copy()
         self.env.update(
@@ -320,13 +494,35 @@ class BaseAutoAction(ABC):
                 )
             ),
             "min_age_days": self.config.get("min-age-days", 5),
+            "state_dir": self.state_dir,
+            "context": self.context,
         }
 
+        self.notify_cli_kwargs = notify_cli_kwargs
         self.notify_cli = NotifyIssueCli(
             token=self.api_key, **notify_cli_kwargs
         )
         self.results: dict[str, BuildTargetResult] = {}
 
+        # Notifications may be sent from a durable background queue so that
+        # builds don't wait for GitHub.
+        self.notify_queue = None
+        self._queued_notify_clis: dict[tuple, NotifyIssueCli] = {
+            (
+                str(self.source_dir),
+                self.qubes_release,
+                self.build_report_repo,
+            ): self.notify_cli
+        }
+        if self.config.get("github", {}).get("notify-async", False):
+            self.notify_queue = NotifyQueue(
+                self.state_dir / "notify-queue", self.process_notification
+            )
+
+        # Idents of threads building distributions in parallel
+        self._worker_threads: set[int] = set()
+        self._notify_lock = threading.Lock()
+
     def register_result(
         self, key: str, target: Any, label: str
     ) -> BuildTargetResult:
@@ -341,26 +537,40 @@ class BaseAutoAction(ABC):
         if self.local_log_file:
             return log_file
         else:
-            return f"https://github.com/{self.logs_repo}/tree/master/{log_file}"
+            return (
+                f"https://github.com/{self.logs_repo}/tree/master/{log_file}"
+            )
 
     def display_head_info(self, args):
         pass
 
-    def make_with_log(self, func, *args, **kwargs):
+    def make_with_log(self, func, *args, on_log_start=None, **kwargs):
+        """
+        Run func with its log sent to a build log. on_log_start, if given,
+        is called with the log file as soon as it is known, before func
+        completes.
+        """
         if self.dry_run:
             log.debug(f"[DRY-RUN] func: {func.__qualname__}")
             log.debug(f"[DRY-RUN] args: {args}")
             log.debug(f"[DRY-RUN] kwargs: {kwargs}")
             return None
         if self.local_log_file:
-            return self.make_with_log_local(func, *args, **kwargs)
-        return self.make_with_log_qrexec(func, *args, **kwargs)
+            return self.make_with_log_local(
+                func, *args, on_log_start=on_log_start, **kwargs
+            )
+        return self.make_with_log_qrexec(
+            func, *args, on_log_start=on_log_start, **kwargs
+        )
 
-    def make_with_log_local(self, func, *args, **kwargs):
+    def make_with_log_local(self, func, *args, on_log_start=None, **kwargs):
         log_fh = create_file_handler(self.local_log_file)
+        log_fh.addFilter(ThreadLogFilter(self._worker_threads))
         log.addHandler(log_fh)
         log.debug("> starting build with log")
         self.display_head_info(args)
+        if on_log_start is not None:
+            on_log_start(self.local_log_file)
 
         try:
             func(*args, **kwargs)
@@ -389,13 +599,15 @@ class BaseAutoAction(ABC):
 
         return self.local_log_file
 
-    def make_with_log_qrexec(self, func, *args, **kwargs):
+    def make_with_log_qrexec(self, func, *args, on_log_start=None, **kwargs):
         log_file = None
         caught_exc = None
+        stdout_lines: list[str] = []
 
         with subprocess.Popen(
             ["qrexec-client-vm", "dom0", "qubesbuilder.BuildLog"],
             text=True,
+            bufsize=LOG_BUFFER_SIZE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             stdin=subprocess.PIPE,
@@ -405,17 +617,34 @@ class BaseAutoAction(ABC):
             assert p.stderr is not None
 
             raw_qrexec = create_console_handler(True, stream=p.stdin)
-            qrexec = SafeWrapper(raw_qrexec, parent_logger=log)
+            qrexec = SafeWrapper(
+                raw_qrexec,
+                parent_logger=log,
+                flush_interval=LOG_FLUSH_INTERVAL,
+            )
             tail = TailBufferHandler(
                 capacity=self.on_error_lines_to_report,
                 level=DEBUG,
                 formatter=raw_qrexec.formatter,
             )
+            thread_filter = ThreadLogFilter(self._worker_threads)
+            qrexec.addFilter(thread_filter)
+            tail.addFilter(thread_filter)
 
             # Attach handlers (attach wrapper, not raw handler)
             log.addHandler(qrexec)
             log.addHandler(tail)
 
+            # With live logs, BuildLog reports the log file at start
+            reader = None
+            if on_log_start is not None:
+                reader = threading.Thread(
+                    target=self._read_buildlog_stdout,
+                    args=(p.stdout, stdout_lines, on_log_start),
+                    daemon=True,
+                )
+                reader.start()
+
             try:
                 log.debug("> starting build with log")
                 self.display_head_info(args)
@@ -425,6 +654,8 @@ class BaseAutoAction(ABC):
                 except Exception as e:
                     caught_exc = e
 
+                # end of stage, send everything before closing the log
+                qrexec.flush()
                 try:
                     p.stdin.close()
                 except Exception:
@@ -433,7 +664,11 @@ class BaseAutoAction(ABC):
                 # Wait for BuildLog to finish writing the filename to stdout
                 p.wait()
 
-                out = p.stdout.read()
+                if reader is not None:
+                    reader.join()
+                    out = "".join(stdout_lines)
+                else:
+                    out = p.stdout.read()
                 err = p.stderr.read()
 
             finally:
@@ -461,6 +696,41 @@ class BaseAutoAction(ABC):
 
         return log_file
 
+    @staticmethod
+    def _read_buildlog_stdout(stdout, lines, on_log_start):
+        for line in stdout:
+            lines.append(line)
+            if len(lines) > 1:
+                continue
+            log_file = get_log_file_from_qubesbuilder_buildlog(line)
+            if log_file is None:
+                continue
+            try:
+                on_log_start(log_file)
+            except Exception as e:
+                log.error(f"Failed to report live log {log_file}: {str(e)}")
+
+    def live_log_notifier(self, result: BuildTargetResult, stage, **kwargs):
+        """
+        Return a make_with_log() callback sending the "building"
+        notification again with the log being written, if live logs are
+        enabled.
+        """
+        if not self.live_log:
+            return None
+
+        def on_log_start(log_file):
+            self.update_result(
+                result,
+                status="building",
+                stage=stage,
+                log_file=log_file,
+                notify=True,
+                **kwargs,
+            )
+
+        return on_log_start
+
     @abstractmethod
     def notify_build_status(
         self,
@@ -562,12 +832,81 @@ class BaseAutoAction(ABC):
         try:
             if self.dry_run:
                 log.debug(f"[DRY-RUN] kwargs: {cli_run_kwargs}")
+            elif self.notify_queue is not None:
+                self.queue_notification(cli_run_kwargs, build_target)
             else:
-                self.notify_cli.run(**cli_run_kwargs)
+                # Distributions built in parallel share the same issues
+                with self._notify_lock:
+                    self.notify_cli.run(**cli_run_kwargs)
         except NotifyIssueError as e:
             msg = f"{build_target}: Failed to notify GitHub: {str(e)}"
             log.error(msg)
 
+    def queue_notification(self, cli_run_kwargs, build_target):
+        kwargs = {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in cli_run_kwargs.items()
+        }
+        kwargs["dist"] = cli_run_kwargs["dist"].distribution
+        # the notification may be sent after sources have changed
+        kwargs["current_commit"] = self.notify_cli.get_current_commit()
+        state_file = cli_run_kwargs.get("state_file")
+        if (
+            cli_run_kwargs["command"] == "upload"
+            and cli_run_kwargs["build_status"] == "uploaded"
+            and state_file is not None
+        ):
+            # the uploaded commit is recorded now, whether the notification
+            # is sent or not, so that the next upload gets the right range
+            kwargs["previous_commit"] = self.notify_cli.read_state_file(
+                state_file
+            )
+            kwargs["state_file"] = None
+            state_file.write_text(kwargs["current_commit"], encoding="utf-8")
+        payload = {
+            "source_dir": str(self.source_dir),
+            "release_name": self.qubes_release,
+            "github_report_repo_name": self.build_report_repo,
+            "kwargs": kwargs,
+        }
+        assert self.notify_queue is not None
+        self.notify_queue.put(
+            key=f"{self.qubes_release}-{build_target}",
+            status=cli_run_kwargs["build_status"],
+            payload=payload,
+        )
+
+    def process_notification(self, payload: dict):
+        key = (
+            payload["source_dir"],
+            payload["release_name"],
+            payload["github_report_repo_name"],
+        )
+        if key not in self._queued_notify_clis:
+            notify_cli_kwargs = {
+                **self.notify_cli_kwargs,
+                "source_dir": Path(payload["source_dir"]),
+                "release_name": payload["release_name"],
+                "github_report_repo_name": payload["github_report_repo_name"],
+            }
+            self._queued_notify_clis[key] = NotifyIssueCli(
+                token=self.api_key, **notify_cli_kwargs
+            )
+        kwargs = dict(payload["kwargs"])
+        # kept in the queue entry if the notification is retried
+        kwargs["commented_issues"] = payload["kwargs"].setdefault(
+            "commented_issues", []
+        )
+        kwargs["dist"] = QubesDistribution(kwargs["dist"])
+        for state_key in ("state_file", "stable_state_file"):
+            if kwargs.get(state_key):
+                kwargs[state_key] = Path(kwargs[state_key])
+        self._queued_notify_clis[key].run(**kwargs)
+
+    def wait_notifications(self):
+        if self.notify_queue is not None:
+            self.notify_queue.join()
+
 
 class AutoAction(BaseAutoAction):
     def __init__(
@@ -581,6 +920,8 @@ class AutoAction(BaseAutoAction):
         repository_publish,
         local_log_file,
         dry_run,
+        context=None,
+        force_rebuild=False,
     ):
         super().__init__(
             builder_dir=builder_dir,
@@ -590,6 +931,7 @@ class AutoAction(BaseAutoAction):
             repository_publish=repository_publish,
             local_log_file=local_log_file,
             dry_run=dry_run,
+            context=context,
             source_dir=component.source_dir,
         )
 
@@ -605,20 +947,180 @@ class AutoAction(BaseAutoAction):
             )
 
         self.timeout = self.component.timeout
+        self.build_concurrency = max(
+            1, int(self.config.get("github", {}).get("build-concurrency", 1))
+        )
+        # Sync remote repositories once for all distributions uploaded
+        self.batch_upload = self.config.get("github", {}).get(
+            "batch-upload", True
+        )
+        # Builds already done from the same sources and configuration are
+        # published and uploaded without being built again
+        self.force_rebuild = force_rebuild
+        self.build_ledger = None
+        if self.config.get("github", {}).get("build-ledger", True):
+            self.build_ledger = BuildLedger(self.state_dir / "build-ledger")
+        self._build_ledger_base: Optional[tuple[str, str]] = None
+        # A newer build of the component queued after that cancels this one,
+        # if the component branch moved since it was fetched
+        self._started_ns = time.time_ns()
+        self._superseded_lock = threading.Lock()
+        self._superseded_checked_ns = self._started_ns
+        self._superseded = False
+        self._repository_lock = threading.Lock()
+        self._stop_building = threading.Event()
+        self._anything_built = False
+        # Release status index keyed by (component name, distribution)
+        self._release_status: dict[tuple[str, str], dict] = {}
         for dist in self.distributions:
             self.register_result(
                 dist.name, dist, f"{self.component.name}:{dist}"
             )
 
-    def run_stages(self, dist, stages):
-        _component_stage(
-            stages=stages,
+    def load_release_status(self, distributions):
+        """
+        Compute release status of the component for all given distributions
+        in one call and store it in the release status index.
+        """
+        release_status = _check_release_status_for_component(
             config=self.config,
             components=[self.component],
-            distributions=[dist],
+            distributions=distributions,
         )
+        component_status = release_status.get(self.component.name, {})
+        for dist in distributions:
+            self._release_status[(self.component.name, dist.distribution)] = (
+                component_status.get(dist.distribution, {})
+            )
 
-    def publish_and_upload(self, repository_publish: str, distributions: List):
+    def get_release_status(self, dist) -> dict:
+        key = (self.component.name, dist.distribution)
+        if key not in self._release_status:
+            self.load_release_status([dist])
+        return self._release_status[key]
+
+    def superseded_at(self) -> int:
+        """
+        Return when builds of the component were last superseded, in ns,
+        including builds requested by its URL.
+        """
+        latest = 0
+        for requested, superseded_ns in superseded_markers(
+            self.builder_dir
+        ).items():
+            if superseded_ns <= latest:
+                continue
+            if requested != self.component.name:
+                try:
+                    components = self.config.get_components(
+                        [requested], url_match=True
+                    )
+                except ConfigError:
+                    continue
+                if self.component.name not in [c.name for c in components]:
+                    continue
+            latest = superseded_ns
+        return latest
+
+    def upstream_commit(self) -> Optional[str]:
+        """Return the commit of the component branch, None if unknown."""
+        try:
+            proc = subprocess.run(
+                [
+                    "git",
+                    "ls-remote",
+                    "--",
+                    str(self.component.url),
+                    f"refs/heads/{self.component.branch}",
+                ],
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            log.debug(f"{self.component.name}: cannot query branch: {e}")
+            return None
+        if proc.returncode != 0 or not proc.stdout.strip():
+            return None
+        return proc.stdout.split()[0]
+
+    def fetched_commit(self) -> str:
+        return open_repo_view(self.component.source_dir).current_commit()
+
+    def check_superseded(self):
+        """
+        Raise BuildSupersededError if a newer build of the component has been
+        dispatched since this one started, and the component branch moved
+        since it was fetched. Called before building and before publishing
+        each distribution.
+        """
+        superseded_ns = self.superseded_at()
+        with self._superseded_lock:
+            if superseded_ns > self._superseded_checked_ns:
+                self._superseded_checked_ns = superseded_ns
+                upstream = self.upstream_commit()
+                fetched = self.fetched_commit()
+                self._superseded = upstream is not None and upstream != fetched
+                if not self._superseded:
+                    log.info(
+                        f"{self.component.name}: newer build requested, but"
+                        f" {fetched or 'the fetched commit'} is still current"
+                    )
+            superseded = self._superseded
+        if superseded:
+            raise BuildSupersededError(
+                f"{self.component.name}: superseded by a newer build"
+            )
+
+    def load_build_ledger_base(self):
+        """
+        Compute the part of build ledger keys shared by all distributions,
+        once sources are fetched.
+        """
+        self._build_ledger_base = None
+        if self.build_ledger is None or self.dry_run:
+            return
+        try:
+            source_hash = self.component.get_source_hash()
+        except ComponentError as e:
+            log.debug(f"{self.component.name}: no source hash: {str(e)}")
+            return
+        conf = {key: self.config.get(key) for key in BUILD_CONFIG_KEYS}
+        self._build_ledger_base = (source_hash, config_digest(conf))
+
+    def build_ledger_key(self, dist) -> Optional[str]:
+        if self._build_ledger_base is None:
+            return None
+        source_hash, digest = self._build_ledger_base
+        return BuildLedger.key(
+            self.component.name, source_hash, dist.distribution, digest
+        )
+
+    def run_stages(self, dist, stages):
+        for index, (serialized, group) in enumerate(
+            itertools.groupby(stages, key=lambda s: s in SERIALIZED_STAGES)
+        ):
+            if index:
+                # stage boundary, before publishing
+                self.check_superseded()
+            group_stages = list(group)
+            if serialized:
+                with self._repository_lock:
+                    _component_stage(
+                        stages=group_stages,
+                        config=self.config,
+                        components=[self.component],
+                        distributions=[dist],
+                    )
+            else:
+                _component_stage(
+                    stages=group_stages,
+                    config=self.config,
+                    components=[self.component],
+                    distributions=[dist],
+                )
+
+    def publish(self, repository_publish: str, distributions: List):
         _publish(
             config=self.config,
             repository_publish=repository_publish,
@@ -626,6 +1128,10 @@ class AutoAction(BaseAutoAction):
             distributions=distributions,
             templates=[],
         )
+
+    def upload_repositories(
+        self, repository_publish: str, distributions: List
+    ):
         _upload(
             config=self.config,
             repository_publish=repository_publish,
@@ -633,6 +1139,10 @@ class AutoAction(BaseAutoAction):
             templates=[],
         )
 
+    def publish_and_upload(self, repository_publish: str, distributions: List):
+        self.publish(repository_publish, distributions)
+        self.upload_repositories(repository_publish, distributions)
+
     def notify_kwargs(self, result: BuildTargetResult) -> dict:
         return {"dist": result.target}
 
@@ -683,191 +1193,342 @@ class AutoAction(BaseAutoAction):
             log.debug(
                 f">>     commit-hash: {self.component.get_source_commit_hash()}"
             )
-            log.debug(f">>     source-hash: {self.component.get_source_hash()}")
+            log.debug(
+                f">>     source-hash: {self.component.get_source_hash()}"
+            )
         except ComponentError:
             # we may have not yet source (like calling fetch stage)
             pass
         log.debug(f">> distributions:")
         log.debug(f">>   {self.distributions}")
 
-    def build(self):
-        self.make_with_log(
-            _component_stage,
-            config=self.config,
-            components=[self.component],
-            distributions=self.distributions,
-            stages=["fetch"],
-        )
+    def fail_on_timeout(
+        self, stage: str, result: Optional[BuildTargetResult] = None
+    ):
+        if result is not None:
+            self.update_result(
+                result,
+                status="failed",
+                stage=stage,
+                reason="Timeout",
+                additional_info="Timeout",
+                notify=True,
+                **self.notify_kwargs(result),
+            )
+        for r in self.results.values():
+            if r.status in ("pending", "building", "built"):
+                self.update_result(
+                    r,
+                    status="failed",
+                    stage=r.stage or stage,
+                    reason="Timeout",
+                    additional_info="Timeout",
+                    notify=True,
+                    **self.notify_kwargs(r),
+                )
+
+    def build_distribution(self, dist):
         require_version_tag = self.component.fetch_versions_only
-        anything_built = False
+        result = self.get_result(dist.name)
+        result.stage = "build"
+        dist_release_status = self.get_release_status(dist)
+        result.release_status = dist_release_status.get("status", None)
+        result.version_tag = dist_release_status.get("tag", None)
+
+        if (
+            result.release_status in (None, "no packages defined")
+            and not self.dry_run
+        ):
+            reason = "no packages defined"
+            extra = format_additional_info(base=f"Skipped: {reason}.")
+            self.update_result(
+                result,
+                status="skipped",
+                stage="build",
+                reason=reason,
+                additional_info=extra,
+            )
+            log.info(f"{result.label}: skipped ({reason})")
+            return
 
-        for dist in self.distributions:
-            result = self.get_result(dist.name)
-            result.stage = "build"
-            release_status = _check_release_status_for_component(
-                config=self.config,
-                components=[self.component],
-                distributions=[dist],
+        if result.release_status != "not released" and not self.dry_run:
+            reason = f"release status is '{result.release_status}'"
+            extra = format_additional_info(base=f"Skipped: {reason}.")
+            self.update_result(
+                result,
+                status="skipped",
+                stage="build",
+                reason=reason,
+                additional_info=extra,
             )
-            dist_release_status = release_status.get(
-                self.component.name, {}
-            ).get(dist.distribution, {})
-            result.release_status = dist_release_status.get("status", None)
-            result.version_tag = dist_release_status.get("tag", None)
+            log.info(f"{result.label}: skipped ({reason})")
+            return
 
-            if (
-                result.release_status in (None, "no packages defined")
-                and not self.dry_run
-            ):
-                reason = "no packages defined"
-                extra = format_additional_info(base=f"Skipped: {reason}.")
+        if (
+            require_version_tag
+            and result.version_tag == "no version tag"
+            and not self.dry_run
+        ):
+            reason = "no version tag found"
+            extra = format_additional_info(base=f"Skipped: {reason}.")
+            self.update_result(
+                result,
+                status="skipped",
+                stage="build",
+                reason=reason,
+                additional_info=extra,
+            )
+            log.info(f"{result.label}: skipped ({reason})")
+            return
+
+        ledger = self.build_ledger
+        ledger_key = self.build_ledger_key(dist)
+        cached = None
+        if ledger is not None and ledger_key is not None:
+            if not self.force_rebuild:
+                cached = ledger.get(ledger_key)
+
+        stage = "build"
+        try:
+            self.check_superseded()
+            if cached is not None:
+                build_log_file = cached.get("log-file")
+                log.info(
+                    f"{result.label}: already built from the same sources"
+                    f" and configuration, publishing it"
+                )
+                try:
+                    self.make_with_log(
+                        self.run_stages, dist=dist, stages=["publish"]
+                    )
+                except AutoActionError as e:
+                    # artifacts of the previous build may have been removed
+                    log.warning(
+                        f"{result.label}: cannot publish the previous build,"
+                        f" building it again: {str(e)}"
+                    )
+                    cached = None
+            if cached is None:
                 self.update_result(
                     result,
-                    status="skipped",
-                    stage="build",
-                    reason=reason,
-                    additional_info=extra,
+                    status="building",
+                    stage=stage,
+                    notify=True,
+                    dist=dist,
                 )
-                log.info(f"{result.label}: skipped ({reason})")
-                continue
 
-            if result.release_status != "not released" and not self.dry_run:
-                reason = f"release status is '{result.release_status}'"
-                extra = format_additional_info(base=f"Skipped: {reason}.")
-                self.update_result(
-                    result,
-                    status="skipped",
-                    stage="build",
-                    reason=reason,
-                    additional_info=extra,
+                build_log_file = self.make_with_log(
+                    self.run_stages,
+                    dist=dist,
+                    stages=["prep", "build", "sign", "publish"],
+                    on_log_start=self.live_log_notifier(
+                        result, stage, dist=dist
+                    ),
                 )
-                log.info(f"{result.label}: skipped ({reason})")
-                continue
+                if ledger is not None and ledger_key is not None:
+                    ledger.record(
+                        ledger_key,
+                        {
+                            "component": self.component.name,
+                            "distribution": dist.distribution,
+                            "log-file": build_log_file,
+                        },
+                    )
+
+            self.update_result(
+                result,
+                status="built",
+                stage=stage,
+                log_file=build_log_file,
+                notify=True,
+                dist=dist,
+            )
+
+            # FIXME: possibly send sign/publish logs
 
-            if (
-                require_version_tag
-                and result.version_tag == "no version tag"
-                and not self.dry_run
+            # never cancelled once published
+            stage = "upload"
+            result.stage = stage
+            self.make_with_log(self.run_stages, dist=dist, stages=["upload"])
+
+            self.update_result(
+                result,
+                status="uploaded",
+                stage=stage,
+                log_file=build_log_file,
+                notify=True,
+                dist=dist,
+            )
+
+            self._anything_built = True
+
+            # Only the entry of the distribution just built is outdated, it
+            # is refreshed on next lookup
+            self._release_status.pop(
+                (self.component.name, dist.distribution), None
+            )
+        except BuildSupersededError as exc:
+            self._handle_superseded(result, exc, stage, dist=dist)
+        except TimeoutError:
+            raise
+        except Exception as exc:
+            if self._stop_building.is_set():
+                # stopped on timeout, reported as such
+                log.info(f"{result.label}: stopped on timeout")
+                return
+            if isinstance(exc, AutoActionError) and isinstance(
+                exc.__cause__, BuildSupersededError
             ):
-                reason = "no version tag found"
-                extra = format_additional_info(base=f"Skipped: {reason}.")
-                self.update_result(
+                # cancelled between stages run with a build log
+                self._handle_superseded(
                     result,
-                    status="skipped",
-                    stage="build",
-                    reason=reason,
-                    additional_info=extra,
+                    exc.__cause__,
+                    stage,
+                    log_file=exc.log_file,
+                    dist=dist,
+                )
+            elif isinstance(exc, AutoActionError):
+                self._handle_error(
+                    result,
+                    exc,
+                    stage,
+                    default_msg="Auto Build failed",
+                    dist=dist,
+                )
+            else:
+                self._handle_error(
+                    result,
+                    exc,
+                    stage,
+                    label="build",
+                    dist=dist,
                 )
-                log.info(f"{result.label}: skipped ({reason})")
-                continue
 
-            with timeout(self.timeout):
-                stage = "build"
-                try:
-                    self.update_result(
-                        result,
-                        status="building",
-                        stage=stage,
-                        notify=True,
-                        dist=dist,
-                    )
+    def _handle_superseded(self, result, exc, stage, log_file=None, dist=None):
+        log.info(f"{result.label}: {str(exc)}")
+        self.update_result(
+            result,
+            status="superseded",
+            stage=stage,
+            reason="Superseded by a newer build",
+            log_file=log_file,
+            notify=True,
+            dist=dist,
+        )
 
-                    build_log_file = self.make_with_log(
-                        self.run_stages,
-                        dist=dist,
-                        stages=["prep", "build", "sign", "publish"],
-                    )
+    def build_distributions_parallel(self, distributions):
+        jobs: queue.SimpleQueue = queue.SimpleQueue()
+        for dist in distributions:
+            jobs.put(dist)
+        workers = min(self.build_concurrency, len(distributions))
 
-                    self.update_result(
-                        result,
-                        status="built",
-                        stage=stage,
-                        log_file=build_log_file,
-                        notify=True,
-                        dist=dist,
-                    )
+        def worker():
+            self._worker_threads.add(threading.get_ident())
+            try:
+                while not self._stop_building.is_set():
+                    try:
+                        dist = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        self.build_distribution(dist)
+                    except Exception:
+                        log.exception(
+                            f"{self.component.name}:{dist}: build worker failed"
+                        )
+            finally:
+                self._worker_threads.discard(threading.get_ident())
 
-                    # FIXME: possibly send sign/publish logs
+        threads = [
+            threading.Thread(
+                target=worker,
+                name=f"build-{self.component.name}-{i}",
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        # SIGALRM is only delivered to the main thread: give the whole pool
+        # one timeout slot per wave of distributions.
+        waves = math.ceil(len(distributions) / workers)
+        with timeout(self.timeout * waves):
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            except TimeoutError as timeout_exc:
+                self.stop_build_workers(threads)
+                self.fail_on_timeout("build")
+                raise AutoActionTimeout(
+                    "Timeout reached for build!"
+                ) from timeout_exc
 
-                    stage = "upload"
-                    result.stage = stage
-                    self.make_with_log(
-                        self.run_stages, dist=dist, stages=["upload"]
-                    )
+    def stop_build_workers(self, threads):
+        """
+        Stop distributions being built in parallel: their stage processes are
+        terminated and worker threads joined, so that nothing keeps building
+        once builder.lock is released.
+        """
+        self._stop_building.set()
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            signal_descendants(sig)
+            for thread in threads:
+                thread.join(STOP_GRACE_PERIOD)
+            if not any(thread.is_alive() for thread in threads):
+                return
+        log.warning("Waiting for build workers to stop...")
+        for thread in threads:
+            thread.join()
 
-                    self.update_result(
-                        result,
-                        status="uploaded",
-                        stage=stage,
-                        log_file=build_log_file,
-                        notify=True,
-                        dist=dist,
-                    )
+    def build(self):
+        self.make_with_log(
+            _component_stage,
+            config=self.config,
+            components=[self.component],
+            distributions=self.distributions,
+            stages=["fetch"],
+        )
+        self._anything_built = False
 
-                    anything_built = True
-                except AutoActionError as exc:
-                    self._handle_error(
-                        result,
-                        exc,
-                        stage,
-                        default_msg="Auto Build failed",
-                        dist=dist,
-                    )
-                except TimeoutError as timeout_exc:
-                    self.update_result(
-                        result,
-                        status="failed",
-                        stage=stage,
-                        reason="Timeout",
-                        additional_info="Timeout",
-                        notify=True,
-                        **self.notify_kwargs(result),
-                    )
-                    for r in self.results.values():
-                        if r.status in ("pending", "building"):
-                            self.update_result(
-                                r,
-                                status="failed",
-                                stage=r.stage or "build",
-                                reason="Timeout",
-                                additional_info="Timeout",
-                                notify=True,
-                                **self.notify_kwargs(r),
-                            )
-                    raise AutoActionTimeout(
-                        "Timeout reached for build!"
-                    ) from timeout_exc
-                except Exception as exc:
-                    self._handle_error(
-                        result,
-                        exc,
-                        stage,
-                        label="build",
-                        dist=dist,
-                    )
+        # One batched pass for all distributions instead of one per distribution
+        self.load_release_status(self.distributions)
+        self.load_build_ledger_base()
 
-        if not anything_built:
+        if self.build_concurrency > 1 and len(self.distributions) > 1:
+            self.build_distributions_parallel(self.distributions)
+        else:
+            for dist in self.distributions:
+                result = self.get_result(dist.name)
+                with timeout(self.timeout):
+                    try:
+                        self.build_distribution(dist)
+                    except TimeoutError as timeout_exc:
+                        self.fail_on_timeout(result.stage or "build", result)
+                        raise AutoActionTimeout(
+                            "Timeout reached for build!"
+                        ) from timeout_exc
+
+        if not self._anything_built:
             log.warning(
                 "Nothing was built, something gone wrong or version tag was not found."
             )
 
-    def upload(self):
+    def prepare_upload(self):
+        """
+        Check the commit to upload and skip distributions having nothing to
+        upload. Return (distribution, result) of others.
+        """
         actual_commit_sha = self.component.get_source_commit_hash()
         if self.commit_sha != actual_commit_sha:
             raise CommitMismatchError(
                 f"Source have changed in the meantime (current: {actual_commit_sha})"
             )
-        release_status = _check_release_status_for_component(
-            config=self.config,
-            components=[self.component],
-            distributions=self.distributions,
-        )
+        self.load_release_status(self.distributions)
+        eligible = []
         for dist in self.distributions:
             result = self.get_result(dist.name)
             result.stage = "upload"
-            dist_release_status = release_status.get(
-                self.component.name, {}
-            ).get(dist.distribution, {})
+            dist_release_status = self.get_release_status(dist)
             result.release_status = dist_release_status.get("status", None)
             result.version_tag = dist_release_status.get("tag", None)
             if result.release_status in (None, "no packages defined"):
@@ -883,61 +1544,156 @@ class AutoAction(BaseAutoAction):
                 )
                 log.info(f"{result.label}: skipped ({reason})")
                 continue
-            with timeout(self.timeout):
-                try:
-                    upload_log_file = self.make_with_log(
-                        self.publish_and_upload,
-                        repository_publish=self.repository_publish,
-                        distributions=[dist],
-                    )
-                    self.update_result(
-                        result,
-                        status="uploaded",
-                        stage="upload",
-                        log_file=upload_log_file,
-                        notify=True,
-                        dist=dist,
-                    )
-                except AutoActionError as exc:
-                    self._handle_error(
-                        result,
-                        exc,
-                        "upload",
-                        default_msg="Auto Upload failed",
-                        dist=dist,
-                    )
-                except TimeoutError as timeout_exc:
-                    self.update_result(
-                        result,
-                        status="failed",
-                        stage="upload",
-                        reason="Timeout",
-                        additional_info="Timeout",
-                        notify=True,
-                        **self.notify_kwargs(result),
-                    )
-                    for r in self.results.values():
-                        if r.status in ("pending", "building"):
-                            self.update_result(
-                                r,
-                                status="failed",
-                                stage=r.stage or "upload",
-                                reason="Timeout",
-                                additional_info="Timeout",
-                                notify=True,
-                                **self.notify_kwargs(r),
-                            )
-                    raise AutoActionTimeout(
-                        "Timeout reached for upload!"
-                    ) from timeout_exc
-                except Exception as exc:
-                    self._handle_error(
-                        result,
-                        exc,
-                        "upload",
-                        label="upload",
-                        dist=dist,
-                    )
+            eligible.append((dist, result))
+
+        return eligible
+
+    def upload(self):
+        eligible = self.prepare_upload()
+        if self.batch_upload and len(eligible) > 1:
+            upload_batched([(self, dist, result) for dist, result in eligible])
+            return
+        for dist, result in eligible:
+            ok, upload_log_file = self.run_upload_step(
+                result, dist, self.publish_and_upload, [dist]
+            )
+            if ok:
+                self.update_result(
+                    result,
+                    status="uploaded",
+                    stage="upload",
+                    log_file=upload_log_file,
+                    notify=True,
+                    dist=dist,
+                )
+
+    def run_upload_step(self, result, dist, func, distributions):
+        """
+        Run func for distributions with its log, reporting errors in result.
+        Return whether it succeeded, and its log file.
+        """
+        with timeout(self.timeout):
+            try:
+                log_file = self.make_with_log(
+                    func,
+                    repository_publish=self.repository_publish,
+                    distributions=distributions,
+                )
+                return True, log_file
+            except AutoActionError as exc:
+                self._handle_error(
+                    result,
+                    exc,
+                    "upload",
+                    default_msg="Auto Upload failed",
+                    dist=dist,
+                )
+            except TimeoutError as timeout_exc:
+                self.fail_on_timeout("upload", result)
+                raise AutoActionTimeout(
+                    "Timeout reached for upload!"
+                ) from timeout_exc
+            except Exception as exc:
+                self._handle_error(
+                    result,
+                    exc,
+                    "upload",
+                    label="upload",
+                    dist=dist,
+                )
+        return False, None
+
+
+def upload_batched(items):
+    """
+    Publish each (action, distribution, result) of items, then sync the
+    remote repositories once for all of them. If it fails, upload
+    distributions one by one so that only those failing to upload are
+    reported as failed. Return (action, distribution) of items uploaded.
+    """
+    published = []
+    for action, dist, result in items:
+        ok, publish_log_file = action.run_upload_step(
+            result, dist, action.publish, [dist]
+        )
+        if ok:
+            published.append((action, dist, result, publish_log_file))
+    if not published:
+        return []
+
+    # Actions of the same repository: any of them can upload for others
+    uploader = published[0][0]
+    distributions: dict[str, QubesDistribution] = {}
+    for _, dist, _, _ in published:
+        distributions.setdefault(dist.distribution, dist)
+    uploaded = published
+    with timeout(uploader.timeout):
+        try:
+            uploader.make_with_log(
+                uploader.upload_repositories,
+                repository_publish=uploader.repository_publish,
+                distributions=list(distributions.values()),
+            )
+        except TimeoutError as timeout_exc:
+            for action in dict.fromkeys(a for a, _, _, _ in items):
+                action.fail_on_timeout("upload")
+            raise AutoActionTimeout(
+                "Timeout reached for upload!"
+            ) from timeout_exc
+        except Exception as exc:
+            log.warning(
+                f"Batched upload failed, uploading distributions one by"
+                f" one: {exc}"
+            )
+            uploaded = []
+
+    if not uploaded:
+        for action, dist, result, _ in published:
+            ok, upload_log_file = action.run_upload_step(
+                result, dist, action.upload_repositories, [dist]
+            )
+            if ok:
+                uploaded.append((action, dist, result, upload_log_file))
+
+    for action, dist, result, log_file in uploaded:
+        action.update_result(
+            result,
+            status="uploaded",
+            stage="upload",
+            log_file=log_file,
+            notify=True,
+            dist=dist,
+        )
+    return [(action, dist) for action, dist, _, _ in uploaded]
+
+
+def upload_components(actions: List[AutoAction]) -> List[AutoAction]:
+    """
+    Upload components of several Upload-component commands for the same
+    repository, syncing remote repositories once for all of them. Return
+    actions having all their distributions uploaded.
+    """
+    items = []
+    done = []
+    for action in actions:
+        try:
+            eligible = action.prepare_upload()
+        except CommitMismatchError as exc:
+            # expected for multi-branch components, don't interrupt others
+            log.warning(f"{action.component.name}: {exc}")
+            continue
+        items += [(action, dist, result) for dist, result in eligible]
+        done.append(action)
+    uploaded = upload_batched(items) if items else []
+    return [
+        action
+        for action in done
+        if all(
+            (item_action, dist) in uploaded
+            for item_action, dist, _ in items
+            if item_action is action
+        )
+    ]
 
 
 class AutoActionTemplate(BaseAutoAction):
@@ -952,6 +1708,7 @@ class AutoActionTemplate(BaseAutoAction):
         repository_publish,
         local_log_file,
         dry_run,
+        context=None,
     ):
         super().__init__(
             builder_dir=builder_dir,
@@ -961,13 +1718,16 @@ class AutoActionTemplate(BaseAutoAction):
             repository_publish=repository_publish,
             local_log_file=local_log_file,
             dry_run=dry_run,
+            context=context,
             source_dir=builder_dir,
         )
 
         try:
             self.templates = self.config.get_templates([template_name])
         except ConfigError as e:
-            raise AutoActionError(f"No such template '{template_name}'.") from e
+            raise AutoActionError(
+                f"No such template '{template_name}'."
+            ) from e
         self.template_timestamp = template_timestamp
         self.template_version = self.config.qubes_release.lstrip("r") + ".0"
 
@@ -1099,6 +1859,7 @@ class AutoActionTemplate(BaseAutoAction):
                 build_log_file = self.make_with_log(
                     self.run_stages,
                     stages=["prep", "build", "sign", "publish"],
+                    on_log_start=self.live_log_notifier(result, stage),
                 )
 
                 self.update_result(
@@ -1213,6 +1974,7 @@ class AutoActionISO(BaseAutoAction):
         local_log_file,
         dry_run,
         is_final=False,
+        context=None,
     ):
         super().__init__(
             builder_dir=builder_dir,
@@ -1222,6 +1984,7 @@ class AutoActionISO(BaseAutoAction):
             repository_publish=repository_publish,
             local_log_file=local_log_file,
             dry_run=dry_run,
+            context=context,
             source_dir=builder_dir,
         )
 
@@ -1385,6 +2148,7 @@ class AutoActionISO(BaseAutoAction):
                 build_log_file = self.make_with_log(
                     self.run_stages,
                     stages=["init-cache", "prep", "build", "sign"],
+                    on_log_start=self.live_log_notifier(result, stage),
                 )
 
                 self.update_result(
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: ledger of successful component builds.
+# - entries are JSON files in a ledger directory (usually in state-dir)
+# - an entry is keyed by component, source hash, distribution and digest of
+#   the builder configuration, so the same build is not run twice
+# - entries older than max_age_days are ignored and removed
+
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger("build-ledger")
+
+
+def config_digest(conf: dict) -> str:
+    data = json.dumps(conf, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class BuildLedger:
+    """
+    Successful builds by key, with the log of the build. Written by builds
+    running in parallel, each of them using its own key.
+    """
+
+    def __init__(self, ledger_dir: Path, max_age_days: int = 30):
+        self.ledger_dir = Path(ledger_dir)
+        self.max_age = max_age_days * 86400
+
+    @staticmethod
+    def key(component: str, source_hash: str, dist: str, digest: str) -> str:
+        data = json.dumps([component, source_hash, dist, digest])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self.ledger_dir / f"{key}.json"
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning(f"Cannot read build ledger entry {path.name}: {e}")
+            return None
+        if entry.get("time", 0) < time.time() - self.max_age:
+            path.unlink(missing_ok=True)
+            return None
+        return entry
+
+    def record(self, key: str, entry: dict):
+        self.ledger_dir.mkdir(parents=True, exist_ok=True)
+        path = self.ledger_dir / f"{key}.json"
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(
+            json.dumps({**entry, "time": time.time()}, default=str),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, path)
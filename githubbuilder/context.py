@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: objects shared by every action run in the same process.
+# - plugin managers, per plugins directories
+# - GitHub clients and repositories, per token
+# - message templates, read again when modified
+
+import threading
+from pathlib import Path
+from typing import Optional
+
+from github import Auth, Github
+
+
+class ActionContext:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plugin_managers: dict = {}
+        self._github_clients: dict[str, Github] = {}
+        self._github_repos: dict = {}
+        self._message_templates: dict[Path, tuple[int, str]] = {}
+
+    def get_plugin_manager(self, plugins_dirs):
+        from qubesbuilder.pluginmanager import PluginManager
+
+        key = tuple(str(d) for d in plugins_dirs)
+        with self._lock:
+            if key not in self._plugin_managers:
+                self._plugin_managers[key] = PluginManager(plugins_dirs)
+            return self._plugin_managers[key]
+
+    def get_github(self, token: str) -> Github:
+        # A client keeps its HTTP session, so connections to the API are
+        # reused by every action.
+        with self._lock:
+            if token not in self._github_clients:
+                self._github_clients[token] = Github(
+                    auth=Auth.Token(token) if token else None,
+                    retry=5,
+                    seconds_between_requests=1,
+                )
+            return self._github_clients[token]
+
+    def get_github_repo(self, token: str, repo_name: str):
+        repo = self._github_repos.get((token, repo_name))
+        if repo is None:
+            repo = self.get_github(token).get_repo(repo_name)
+            with self._lock:
+                repo = self._github_repos.setdefault((token, repo_name), repo)
+        return repo
+
+    def read_message_template(self, path: Path) -> Optional[str]:
+        """Return content of a message template or None if it does not exist."""
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._message_templates.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, path.read_text())
+                self._message_templates[path] = cached
+            return cached[1]
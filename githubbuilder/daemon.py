@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: long-lived 'github-command.py action' runner.
+# - one daemon per builder directory, listening on a UNIX socket in it
+# - actions are run one at a time in the main thread, holding builder.lock,
+#   uploads first, then component builds, then template and ISO builds
+# - when builder or scripts sources are updated, queued actions are run
+#   with the one-shot command and the daemon exits to be restarted
+
+import copy
+import fcntl
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import subprocess
+import threading
+import traceback
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import yaml
+
+from githubbuilder.job_queue import (
+    job_priority,
+    mark_superseded,
+    superseding_component,
+)
+
+log = logging.getLogger("github-command")
+
+# Root of the qubes-builder-github repository
+PROJECT_PATH = Path(__file__).resolve().parent.parent
+
+SOCKET_NAME = "github-command.sock"
+
+
+def socket_path(builder_dir: Path) -> Path:
+    return Path(builder_dir) / SOCKET_NAME
+
+
+def git_head(path: Path) -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "-C", str(path), "rev-parse", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def oneshot_action_cmd(builder_dir: Path, scripts_dir: Path, argv):
+    return [
+        "flock",
+        "-x",
+        str(builder_dir / "builder.lock"),
+        "bash",
+        "-c",
+        " ".join([str(scripts_dir / "github-command.py"), "action", *argv]),
+    ]
+
+
+def request_action(builder_dir: Path, argv, wait=False, timeout=5):
+    """
+    Send action arguments to the daemon serving builder_dir. Return None if
+    no daemon accepted it, so the caller can fall back to the one-shot
+    command, or the daemon reply otherwise.
+    """
+    path = socket_path(builder_dir)
+    if not path.exists():
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(
+            json.dumps({"argv": list(argv), "wait": wait}).encode() + b"\n"
+        )
+        stream = sock.makefile("rb")
+        reply = json.loads(stream.readline())
+        if reply.get("status") != "queued":
+            return None
+    except (OSError, ValueError) as e:
+        log.debug(f"Action daemon not available: {str(e)}")
+        return None
+    if not wait:
+        sock.close()
+        return reply
+    # From there, the action is owned by the daemon and must not be run again
+    try:
+        sock.settimeout(None)
+        return json.loads(stream.readline())
+    except (OSError, ValueError) as e:
+        return {"status": "failed", "error": f"Lost action daemon: {str(e)}"}
+    finally:
+        sock.close()
+
+
+def query_queue(builder_dir: Path, timeout=5) -> Optional[list]:
+    """Return actions queued by the daemon serving builder_dir, if any."""
+    path = socket_path(builder_dir)
+    if not path.exists():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(path))
+            sock.sendall(json.dumps({"query": "queue"}).encode() + b"\n")
+            reply = json.loads(sock.makefile("rb").readline())
+    except (OSError, ValueError) as e:
+        log.debug(f"Action daemon not available: {str(e)}")
+        return None
+    return reply.get("jobs")
+
+
+class ConfigCache:
+    """
+    Parsed builder configurations, parsed again when the file or any file it
+    includes is modified. Every caller gets its own copy so that nothing
+    leaks between actions.
+    """
+
+    def __init__(self, loader: Callable):
+        self.loader = loader
+        self._configs: dict = {}
+
+    @staticmethod
+    def loaded_files(conf_file) -> List[Path]:
+        """
+        Return conf_file and the files it includes, recursively, resolved
+        like qubesbuilder does: relative to the including file.
+        """
+        files: List[Path] = []
+        pending = [Path(conf_file)]
+        while pending:
+            path = pending.pop()
+            if path in files:
+                continue
+            files.append(path)
+            try:
+                conf = yaml.safe_load(path.read_text())
+            except (OSError, yaml.YAMLError):
+                # reported by the loader if it matters
+                continue
+            included = (
+                conf.get("include", []) if isinstance(conf, dict) else []
+            )
+            for inc in included if isinstance(included, list) else []:
+                inc_path = Path(inc)
+                if not inc_path.is_absolute():
+                    inc_path = path.parent / inc_path
+                pending.append(inc_path)
+        return files
+
+    @staticmethod
+    def _mtimes(files):
+        mtimes: List[Optional[int]] = []
+        for path in files:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return mtimes
+
+    def get(self, conf_file):
+        cached = self._configs.get(str(conf_file))
+        if cached is None or self._mtimes(cached[0]) != cached[1]:
+            files = self.loaded_files(conf_file)
+            mtimes = self._mtimes(files)
+            cached = (files, mtimes, self.loader(conf_file))
+            self._configs[str(conf_file)] = cached
+        return copy.deepcopy(cached[2])
+
+
+class ActionJob:
+    _seq = itertools.count()
+
+    def __init__(self, argv, conn: Optional[socket.socket] = None):
+        self.argv = argv
+        self.conn = conn
+        self.superseded = False
+        # run by priority, then in arrival order
+        self.sort_key = (job_priority(argv), next(ActionJob._seq))
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+
+class ActionDaemon:
+    def __init__(
+        self,
+        builder_dir: Path,
+        run_action: Callable,
+        scripts_dir: Path = PROJECT_PATH,
+    ):
+        self.builder_dir = Path(builder_dir).resolve()
+        self.scripts_dir = Path(scripts_dir).resolve()
+        self.run_action = run_action
+        self.socket_path = socket_path(self.builder_dir)
+        self.jobs: queue.PriorityQueue = queue.PriorityQueue()
+        self.heads = self.current_heads()
+        self.stale = False
+        self._sock: Optional[socket.socket] = None
+
+    def current_heads(self):
+        return git_head(self.builder_dir), git_head(self.scripts_dir)
+
+    def serve_forever(self):
+        """
+        Run actions until sources are updated. Return True if the daemon
+        needs to be restarted.
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket_path.unlink(missing_ok=True)
+        old_umask = os.umask(0o077)
+        try:
+            self._sock.bind(str(self.socket_path))
+        finally:
+            os.umask(old_umask)
+        self._sock.listen()
+        log.info(f"Serving actions for {self.builder_dir}")
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        try:
+            while not self.stale:
+                self._run_job(self.jobs.get())
+            # don't accept anything more and run what is already queued
+            self._close()
+            while True:
+                try:
+                    self._run_job(self.jobs.get(timeout=1))
+                except queue.Empty:
+                    break
+        finally:
+            self._close()
+        return self.stale
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self.socket_path.unlink(missing_ok=True)
+
+    def _accept_loop(self):
+        while True:
+            sock = self._sock
+            if sock is None:
+                return
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._handle, args=(conn,), daemon=True
+            ).start()
+
+    def _handle(self, conn: socket.socket):
+        try:
+            conn.settimeout(30)
+            request = json.loads(conn.makefile("rb").readline())
+            if request.get("query") == "queue":
+                conn.sendall(
+                    json.dumps(
+                        {"status": "queue", "jobs": self.queued()}
+                    ).encode()
+                    + b"\n"
+                )
+                conn.close()
+                return
+            argv = [str(arg) for arg in request["argv"]]
+            component = superseding_component(argv)
+            if component is not None:
+                self.supersede(component)
+            if request.get("wait"):
+                # the result is sent on the same connection once done
+                conn.sendall(json.dumps({"status": "queued"}).encode() + b"\n")
+                conn.settimeout(None)
+                self.jobs.put(ActionJob(argv, conn))
+                return
+            self.jobs.put(ActionJob(argv))
+            conn.sendall(json.dumps({"status": "queued"}).encode() + b"\n")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error(f"Invalid action request: {str(e)}")
+        conn.close()
+
+    def supersede(self, component):
+        with self.jobs.mutex:
+            for job in self.jobs.queue:
+                if superseding_component(job.argv) == component:
+                    job.superseded = True
+        mark_superseded(self.builder_dir, component)
+
+    def queued(self):
+        with self.jobs.mutex:
+            jobs = sorted(job for job in self.jobs.queue if not job.superseded)
+        return [
+            {"priority": job.sort_key[0], "argv": job.argv} for job in jobs
+        ]
+
+    def run_oneshot(self, argv):
+        subprocess.run(
+            oneshot_action_cmd(self.builder_dir, self.scripts_dir, argv),
+            check=True,
+            capture_output=True,
+            env={
+                **os.environ,
+                "PYTHONPATH": f"{self.builder_dir!s}:{os.environ.get('PYTHONPATH', '')}",
+            },
+        )
+
+    def _run_job(self, job: ActionJob):
+        if job.superseded:
+            log.info(f"Skipping superseded action: {' '.join(job.argv)}")
+            self._reply(job, {"status": "superseded"})
+            return
+        log.info(f"Running action: {' '.join(job.argv)}")
+        result = {"status": "done"}
+        try:
+            oneshot = False
+            lock_fd = os.open(
+                self.builder_dir / "builder.lock", os.O_RDWR | os.O_CREAT
+            )
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                # modules loaded here may not match updated sources anymore
+                if self.stale or self.current_heads() != self.heads:
+                    self.stale = oneshot = True
+                else:
+                    self.run_action(job.argv)
+            finally:
+                os.close(lock_fd)
+            if oneshot:
+                self.run_oneshot(job.argv)
+        except subprocess.CalledProcessError as e:
+            log.error(f"Action failed: {e.stderr}")
+            result = {"status": "failed", "error": str(e.stderr)}
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            result = {"status": "failed", "error": str(e)}
+        self._reply(job, result)
+
+    @staticmethod
+    def _reply(job: ActionJob, result: dict):
+        if job.conn is not None:
+            try:
+                job.conn.sendall(json.dumps(result).encode() + b"\n")
+            except OSError:
+                pass
+            finally:
+                job.conn.close()
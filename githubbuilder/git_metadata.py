@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: memoized git queries on a component source directory.
+# - queries go through a GitRepoView: they are done in-process with pygit2
+#   when available, with 'git' commands otherwise
+# - 'describe' and revision lookups are kept in memory, as tags may be
+#   added later
+# - logs of a commit range are collected in a single pass and stored in a
+#   cache directory, keyed by the commits of the range
+
+import json
+import logging
+import os
+import re
+import subprocess
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+try:
+    import pygit2
+
+    HAVE_PYGIT2 = True
+except ImportError:
+    HAVE_PYGIT2 = False
+
+log = logging.getLogger("notify-issues")
+
+sha_re = re.compile("^[0-9a-f]{40}$")
+
+# Fields and records separators of 'git log' output
+LOG_FORMAT = "%H%x1f%h%x1f%s%x1f%b%x1e"
+
+# Tags considered as versions
+VERSION_TAGS_PATTERN = "v*"
+
+
+class GitLogEntry(NamedTuple):
+    sha: str
+    abbrev: str
+    subject: str
+    body: str
+
+    def message_lines(self):
+        return [self.subject] + self.body.splitlines()
+
+
+def split_message(message: str) -> tuple[str, str]:
+    """Return subject and body of a commit message, like %s and %b."""
+    lines = message.split("\n")
+    subject = []
+    while lines and lines[0].strip():
+        subject.append(lines.pop(0).rstrip())
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    return " ".join(subject), "\n".join(lines).rstrip("\n")
+
+
+class GitRepoView(ABC):
+    """
+    Read-only queries on a git repository, mirroring output of the
+    corresponding git commands. Each query returns an empty result when
+    git would fail.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @abstractmethod
+    def current_commit(self) -> str:
+        """git log -n 1 --pretty=format:%H"""
+
+    @abstractmethod
+    def describe(
+        self, rev: str, always=False, exact_match=False, abbrev=None
+    ) -> str:
+        """git describe --match v* [--always] [--exact-match] [--abbrev=N]"""
+
+    @abstractmethod
+    def root_commits(self, rev: str) -> list[str]:
+        """git rev-list --max-parents=0"""
+
+    @abstractmethod
+    def resolve(self, revs) -> Optional[list[str]]:
+        """git rev-parse rev^{commit}..., None if one is unknown"""
+
+    @abstractmethod
+    def log(self, start: str, end: str) -> Optional[list[GitLogEntry]]:
+        """git log start..end, None if the range is unknown"""
+
+
+class SubprocessGitRepoView(GitRepoView):
+    def _run(self, *args) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["git", "-C", str(self.path), *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def current_commit(self):
+        proc = self._run("log", "-n", "1", "--pretty=format:%H")
+        return proc.stdout.decode().strip()
+
+    def describe(self, rev, always=False, exact_match=False, abbrev=None):
+        cmd = ["describe", "--match", VERSION_TAGS_PATTERN]
+        if always:
+            cmd.append("--always")
+        if exact_match:
+            cmd.append("--exact-match")
+        if abbrev is not None:
+            cmd.append(f"--abbrev={abbrev}")
+        return self._run(*cmd, rev).stdout.decode().strip()
+
+    def root_commits(self, rev):
+        proc = self._run("rev-list", "--max-parents=0", rev)
+        return proc.stdout.decode().split()
+
+    def resolve(self, revs):
+        proc = self._run("rev-parse", *[f"{rev}^{{commit}}" for rev in revs])
+        commits = proc.stdout.decode().split()
+        if proc.returncode != 0 or len(commits) != len(revs):
+            return None
+        return commits
+
+    def log(self, start, end):
+        proc = self._run("log", f"--format={LOG_FORMAT}", f"{start}..{end}")
+        if proc.returncode != 0:
+            return None
+        entries = []
+        for record in proc.stdout.decode().split("\x1e"):
+            fields = record.strip("\n").split("\x1f")
+            if len(fields) == 4:
+                entries.append(GitLogEntry(*fields))
+        return entries
+
+
+class Pygit2GitRepoView(GitRepoView):
+    """
+    Queries done in-process, without starting a git command for each of
+    them. Abbreviated commit IDs have the length git would use.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        assert HAVE_PYGIT2
+        self.repo = pygit2.Repository(str(path))
+        self._abbrev_len: Optional[int] = None
+
+    def _commit(self, rev):
+        try:
+            return self.repo.revparse_single(f"{rev}^{{commit}}")
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+
+    def _default_abbrev(self) -> int:
+        # like core.abbrev=auto: from the number of packed objects
+        if self._abbrev_len is None:
+            count = 0
+            pack_dir = Path(self.repo.path) / "objects" / "pack"
+            for idx_path in pack_dir.glob("*.idx"):
+                try:
+                    with open(idx_path, "rb") as idx:
+                        # version 2 header, then 256 fan-out entries
+                        idx.seek(8 + 255 * 4)
+                        count += int.from_bytes(idx.read(4), "big")
+                except OSError:
+                    continue
+            self._abbrev_len = max(7, (count.bit_length() + 1) // 2)
+        return self._abbrev_len
+
+    def _abbrev(self, commit) -> str:
+        # short_id is the shortest unique prefix of at least 7 characters
+        return str(commit.id)[
+            : max(len(commit.short_id), self._default_abbrev())
+        ]
+
+    def current_commit(self):
+        try:
+            return str(self.repo.head.target)
+        except pygit2.GitError:
+            return ""
+
+    def describe(self, rev, always=False, exact_match=False, abbrev=None):
+        try:
+            return self.repo.describe(
+                rev,
+                pattern=VERSION_TAGS_PATTERN,
+                max_candidates_tags=0 if exact_match else None,
+                abbreviated_size=(
+                    self._default_abbrev() if abbrev is None else abbrev
+                ),
+            )
+        except (KeyError, ValueError, pygit2.GitError):
+            if not always or exact_match:
+                return ""
+        commit = self._commit(rev)
+        return self._abbrev(commit) if commit is not None else ""
+
+    def root_commits(self, rev):
+        commit = self._commit(rev)
+        if commit is None:
+            return []
+        return [
+            str(c.id)
+            for c in self.repo.walk(commit.id, pygit2.enums.SortMode.TIME)
+            if not c.parent_ids
+        ]
+
+    def resolve(self, revs):
+        commits = [self._commit(rev) for rev in revs]
+        if None in commits:
+            return None
+        return [str(c.id) for c in commits]
+
+    def log(self, start, end):
+        start_commit, end_commit = self._commit(start), self._commit(end)
+        if start_commit is None or end_commit is None:
+            return None
+        walker = self.repo.walk(end_commit.id, pygit2.enums.SortMode.TIME)
+        walker.hide(start_commit.id)
+        entries = []
+        for commit in walker:
+            subject, body = split_message(commit.message)
+            entries.append(
+                GitLogEntry(
+                    str(commit.id), self._abbrev(commit), subject, body
+                )
+            )
+        return entries
+
+
+def open_repo_view(path: Path) -> GitRepoView:
+    if HAVE_PYGIT2:
+        try:
+            return Pygit2GitRepoView(path)
+        except pygit2.GitError as e:
+            log.debug(f"Cannot open {path} with pygit2: {str(e)}")
+    return SubprocessGitRepoView(path)
+
+
+class GitMetadata:
+    def __init__(
+        self,
+        source_dir: Path,
+        cache_dir: Optional[Path] = None,
+        repo: Optional[GitRepoView] = None,
+    ):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self._repo = repo
+        self._describe: dict[tuple, str] = {}
+        self._revisions: dict[tuple, list[str]] = {}
+        self._logs: dict[tuple[str, str], list[GitLogEntry]] = {}
+
+    @property
+    def repo(self) -> GitRepoView:
+        # sources may not be there yet when notifying about a build start
+        if self._repo is None:
+            self._repo = open_repo_view(self.source_dir)
+        return self._repo
+
+    def current_commit(self) -> str:
+        # not memoized, sources are updated between builds
+        return self.repo.current_commit()
+
+    def describe(self, rev, always=False, exact_match=False, abbrev=None):
+        key = (rev, always, exact_match, abbrev)
+        if key not in self._describe:
+            self._describe[key] = self.repo.describe(
+                rev, always=always, exact_match=exact_match, abbrev=abbrev
+            )
+        return self._describe[key]
+
+    def root_commits(self, rev: str) -> list[str]:
+        key = ("--max-parents=0", rev)
+        if key not in self._revisions:
+            self._revisions[key] = self.repo.root_commits(rev)
+        return self._revisions[key]
+
+    def resolve(self, *revs: str) -> Optional[list[str]]:
+        """Return commit IDs of given revisions, or None if one is unknown."""
+        if all(sha_re.match(rev) for rev in revs):
+            return list(revs)
+        if revs not in self._revisions:
+            self._revisions[revs] = self.repo.resolve(revs) or []
+        return self._revisions[revs] or None
+
+    def _cache_path(self, start: str, end: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / self.source_dir.name / f"{start}..{end}.json"
+
+    def log(self, start: str, end: str) -> list[GitLogEntry]:
+        """Commits in 'start..end' range, most recent first."""
+        commits = self.resolve(start, end)
+        key = (commits[0], commits[1]) if commits else (start, end)
+        if key in self._logs:
+            return self._logs[key]
+
+        cache_path = self._cache_path(*key) if commits else None
+        entries = None
+        if cache_path is not None:
+            try:
+                entries = [
+                    GitLogEntry(*entry)
+                    for entry in json.loads(cache_path.read_text())
+                ]
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, TypeError) as e:
+                log.warning(
+                    f"Ignoring invalid git cache {cache_path}: {str(e)}"
+                )
+
+        if entries is None:
+            entries = self.repo.log(*key)
+            # don't keep a log of history not available (yet)
+            if entries is None:
+                entries = []
+            elif cache_path is not None:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_name(
+                    f".{cache_path.name}.{os.getpid()}"
+                )
+                tmp_path.write_text(json.dumps(entries))
+                os.replace(tmp_path, cache_path)
+
+        self._logs[key] = entries
+        return entries
+
+    def shortlog(self, start: str, end: str, repo_name: str) -> str:
+        return "\n".join(
+            f"{repo_name}@{entry.abbrev} {entry.subject}"
+            for entry in self.log(start, end)
+        )
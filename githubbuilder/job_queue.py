@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: queue of actions dispatched to a builder.
+# - jobs are JSON files in the builder directory, named so that sorting
+#   them gives priority order, then arrival order
+# - a single worker per builder, holding builder.queue.lock, runs them one
+#   at a time; each action still holds builder.lock while running
+# - results of jobs waited for are written next to them
+# - a build of a component supersedes its builds still queued, and marks
+#   the running one to be cancelled before it builds or publishes a
+#   distribution, if the component branch moved since it was fetched
+
+import fcntl
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+log = logging.getLogger("job-queue")
+
+QUEUE_DIR = ".jobs"
+QUEUE_LOCK = "builder.queue.lock"
+JOB_SUFFIX = ".json"
+WORK_SUFFIX = ".work"
+RESULT_SUFFIX = ".result"
+SUPERSEDED_DIR = "superseded"
+
+# Lower runs first: uploads are short and often urgent, templates and ISO
+# may take hours
+PRIORITIES = {
+    "upload-component": 0,
+    "upload-template": 0,
+    "build-component": 1,
+    "build-template": 2,
+    "build-iso": 2,
+}
+DEFAULT_PRIORITY = 1
+
+
+def job_priority(argv) -> int:
+    for arg in argv:
+        if arg in PRIORITIES:
+            return PRIORITIES[arg]
+    return DEFAULT_PRIORITY
+
+
+def superseding_component(argv) -> Optional[str]:
+    """Return the component built by a build-component action."""
+    if "build-component" not in argv:
+        return None
+    # build-component builder_dir builder_conf component_name
+    positional = argv[argv.index("build-component") + 1 :]
+    return positional[2] if len(positional) > 2 else None
+
+
+def _superseded_path(builder_dir: Path, component: str) -> Path:
+    return (
+        Path(builder_dir)
+        / QUEUE_DIR
+        / SUPERSEDED_DIR
+        / re.sub(r"[^A-Za-z0-9_.-]", "_", component)
+    )
+
+
+def mark_superseded(builder_dir: Path, component: str):
+    """Record that builds of component started until now are superseded."""
+    path = _superseded_path(builder_dir, component)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(str(time.time_ns()), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def superseded_markers(builder_dir: Path) -> dict[str, int]:
+    """
+    Return when builds were last superseded, in ns, by component as
+    requested (possibly matching a component by its URL).
+    """
+    markers = {}
+    for path in (Path(builder_dir) / QUEUE_DIR / SUPERSEDED_DIR).glob("[!.]*"):
+        try:
+            markers[path.name] = int(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+    return markers
+
+
+class JobQueue:
+    """
+    Actions of a builder waiting to be run. Jobs may be added by any
+    process, but are only taken by the worker holding the queue lock.
+    """
+
+    def __init__(self, builder_dir: Path):
+        self.builder_dir = Path(builder_dir)
+        self.path = self.builder_dir / QUEUE_DIR
+        self.lock_path = self.builder_dir / QUEUE_LOCK
+
+    def put(self, argv: List[str], wait: bool = False) -> str:
+        self.path.mkdir(parents=True, exist_ok=True)
+        component = superseding_component(argv)
+        if component is not None:
+            self._supersede(component)
+        job_id = f"{job_priority(argv)}-{time.time_ns():020d}-{os.getpid()}"
+        tmp_path = self.path / f".{job_id}.tmp"
+        tmp_path.write_text(
+            json.dumps({"argv": list(argv), "wait": wait}), encoding="utf-8"
+        )
+        os.replace(tmp_path, self.path / f"{job_id}{JOB_SUFFIX}")
+        return job_id
+
+    def pending(self) -> List[dict]:
+        """Return queued jobs, the running one first, in run order."""
+        jobs = []
+        for path in sorted(self.path.glob(f"*[0-9]{JOB_SUFFIX}*")):
+            if path.suffix not in (JOB_SUFFIX, WORK_SUFFIX):
+                continue
+            job_id = path.name.split(".", 1)[0]
+            try:
+                job = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            jobs.append(
+                {
+                    "id": job_id,
+                    "priority": int(job_id.split("-", 1)[0]),
+                    "running": path.suffix == WORK_SUFFIX,
+                    "argv": job.get("argv", []),
+                }
+            )
+        return sorted(jobs, key=lambda job: (not job["running"], job["id"]))
+
+    def _supersede(self, component: str):
+        for path in sorted(self.path.glob(f"*{JOB_SUFFIX}")):
+            try:
+                job = json.loads(path.read_text(encoding="utf-8"))
+                if superseding_component(job.get("argv", [])) != component:
+                    continue
+                # not taken by the worker in the meantime
+                path.unlink()
+            except (OSError, ValueError):
+                continue
+            log.info(f"{component}: superseding queued build {path.name}")
+            if job.get("wait"):
+                self._write_result(
+                    path.name.split(".", 1)[0], {"status": "superseded"}
+                )
+        mark_superseded(self.builder_dir, component)
+
+    def _write_result(self, job_id: str, result: dict):
+        tmp_path = self.path / f".{job_id}.result.tmp"
+        tmp_path.write_text(json.dumps(result), encoding="utf-8")
+        os.replace(tmp_path, self.path / f"{job_id}{RESULT_SUFFIX}")
+
+    def _take(self) -> Optional[Path]:
+        for path in sorted(self.path.glob(f"*{JOB_SUFFIX}")):
+            work_path = path.with_name(path.name + WORK_SUFFIX)
+            try:
+                os.rename(path, work_path)
+            except FileNotFoundError:
+                continue
+            return work_path
+        return None
+
+    def _recover(self):
+        # only the worker takes jobs: any job taken is left by a dead one
+        for work_path in self.path.glob(f"*{JOB_SUFFIX}{WORK_SUFFIX}"):
+            os.rename(work_path, work_path.with_suffix(""))
+
+    def drain(self, run: Callable[[List[str]], None]) -> bool:
+        """
+        Run queued jobs with run(argv) until the queue is empty. Return False
+        if another worker is running them.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        while True:
+            lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                self._recover()
+                while True:
+                    work_path = self._take()
+                    if work_path is None:
+                        break
+                    self._run_job(work_path, run)
+            finally:
+                os.close(lock_fd)
+            # a job may have been added after the queue was found empty, but
+            # before the lock was released
+            if not list(self.path.glob(f"*{JOB_SUFFIX}")):
+                return True
+
+    def worker_running(self) -> bool:
+        lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(lock_fd)
+        return False
+
+    def _run_job(self, work_path: Path, run: Callable[[List[str]], None]):
+        job_id = work_path.name.split(".", 1)[0]
+        try:
+            job = json.loads(work_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            log.error(f"Cannot read job {job_id}: {str(e)}")
+            work_path.unlink(missing_ok=True)
+            return
+        result = {"status": "done"}
+        try:
+            run(job["argv"])
+        except Exception as e:
+            log.error(f"Job {job_id} failed: {str(e)}")
+            result = {"status": "failed", "error": str(e)}
+        if job.get("wait"):
+            self._write_result(job_id, result)
+        work_path.unlink(missing_ok=True)
+
+    def wait_result(
+        self,
+        job_id: str,
+        start_worker: Optional[Callable[[], None]] = None,
+        poll_interval: float = 1.0,
+    ) -> dict:
+        """
+        Wait for the result of a job, run by a worker. If start_worker is
+        given, it is called whenever no worker is running, for example if
+        the previous one died.
+        """
+        result_path = self.path / f"{job_id}{RESULT_SUFFIX}"
+        while True:
+            try:
+                result = json.loads(result_path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                if start_worker is not None and not self.worker_running():
+                    start_worker()
+                time.sleep(poll_interval)
+                continue
+            result_path.unlink(missing_ok=True)
+            return result
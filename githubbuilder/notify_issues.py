@@ -22,17 +22,21 @@
 #
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import datetime
+import json
 import logging
 import os
 import re
-import subprocess
 from pathlib import Path
 from typing import Optional
 
-from github import Github, GithubException, Auth
+from github import GithubException
 
 from qubesbuilder.distribution import QubesDistribution
 
+from githubbuilder.context import ActionContext
+from githubbuilder.git_metadata import GitMetadata
+
 log = logging.getLogger("notify-issues")
 
 github_issues_repo = "QubesOS/qubes-issues"
@@ -55,6 +59,83 @@ class NotifyIssueError(Exception):
     pass
 
 
+class IssueIndex:
+    """
+    Persistent index of issue titles to issue numbers for a GitHub
+    repository. Only open issues are indexed. The index is refreshed
+    incrementally using the 'updated at' cursor of the issues.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.issues: dict[str, int] = {}
+        self.cursor: Optional[datetime.datetime] = None
+        self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.issues = {
+                str(title): int(number)
+                for title, number in data.get("issues", {}).items()
+            }
+            cursor = data.get("cursor", None)
+            self.cursor = (
+                datetime.datetime.fromisoformat(cursor) if cursor else None
+            )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            log.warning(f"Ignoring invalid issue index {self.path}: {str(e)}")
+            self.issues = {}
+            self.cursor = None
+
+    def save(self):
+        data = {
+            "cursor": self.cursor.isoformat() if self.cursor else None,
+            "issues": self.issues,
+        }
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Failed to save issue index {self.path}: {str(e)}")
+
+    def refresh(self, github_repo):
+        if self.cursor is None:
+            # first run: index every open issue
+            issues = github_repo.get_issues(state="open")
+        else:
+            # closed issues are fetched too, to drop them from the index
+            issues = github_repo.get_issues(
+                state="all",
+                since=self.cursor,
+                sort="updated",
+                direction="asc",
+            )
+        for issue in issues:
+            if issue.state == "open":
+                self.issues[issue.title] = issue.number
+            elif self.issues.get(issue.title) == issue.number:
+                del self.issues[issue.title]
+            if self.cursor is None or issue.updated_at > self.cursor:
+                self.cursor = issue.updated_at
+        self.save()
+
+    def get(self, title: str) -> Optional[int]:
+        return self.issues.get(title, None)
+
+    def add(self, title: str, number: int):
+        self.issues[title] = number
+        self.save()
+
+    def discard(self, title: str):
+        if self.issues.pop(title, None) is not None:
+            self.save()
+
+
 class NotifyIssueCli:
     def __init__(
         self,
@@ -64,6 +145,8 @@ class NotifyIssueCli:
         message_templates_dir: Path,
         github_report_repo_name: str,
         min_age_days: int,
+        state_dir: Optional[Path] = None,
+        context: Optional[ActionContext] = None,
     ):
         self.token = token or ""
         self.release_name = release_name
@@ -71,11 +154,16 @@ class NotifyIssueCli:
         self.message_templates_dir = message_templates_dir
         self.github_report_repo_name = github_report_repo_name
         self.min_age_days = min_age_days
-        self.gi = Github(
-            auth=Auth.Token(self.token) if self.token else None,
-            retry=5,
-            seconds_between_requests=1,
+        self.state_dir = state_dir
+        self.issue_indexes: dict[str, IssueIndex] = {}
+        self.context = context or ActionContext()
+        # Git queries are shared by every notification of this source
+        self.git = GitMetadata(
+            self.source_dir,
+            cache_dir=Path(state_dir) / "git-log-cache" if state_dir else None,
         )
+        self.package_changes: dict[tuple, tuple] = {}
+        self.gi = self.context.get_github(self.token)
 
     def get_labels(
         self, command, repository_type, build_status, dist_label, package_name
@@ -136,27 +224,15 @@ class NotifyIssueCli:
                     f"{prefix_label}-failed",
                     f"{prefix_label}-building",
                 ]
+            elif build_status == "superseded":
+                delete_labels = [f"{prefix_label}-building"]
             else:
                 delete_labels = []
 
         return add_labels, delete_labels
 
     def get_current_commit(self):
-        git_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "log",
-                "-n",
-                "1",
-                "--pretty=format:%H",
-            ],
-            stdout=subprocess.PIPE,
-        )
-        (b_current_commit, _) = git_proc.communicate()
-        current_commit = b_current_commit.decode().strip()
-        return current_commit
+        return self.git.current_commit()
 
     def get_package_changes(
         self, git_url, current_commit, previous_current_commit=None
@@ -167,123 +243,95 @@ class NotifyIssueCli:
         - git short log formatted with GitHub links
         - referenced GitHub issues, in GitHub syntax
         """
-        git_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "describe",
-                "--match",
-                "v*",
-                "--always",
-            ],
-            stdout=subprocess.PIPE,
-        )
-        (version_tags, _) = git_proc.communicate()
-        versions = version_tags.decode().splitlines()
+        key = (git_url, current_commit, previous_current_commit)
+        if key not in self.package_changes:
+            self.package_changes[key] = self._get_package_changes(
+                git_url, current_commit, previous_current_commit
+            )
+        return self.package_changes[key]
+
+    def _get_package_changes(
+        self, git_url, current_commit, previous_current_commit=None
+    ):
+        versions = self.git.describe(current_commit, always=True).splitlines()
         if not versions:
             raise ValueError("No version tags found")
         version = versions[0]
 
         # get previous version
         if previous_current_commit:
-            git_proc = subprocess.Popen(
-                [
-                    "git",
-                    "-C",
-                    str(self.source_dir),
-                    "describe",
-                    "--match",
-                    "v*",
-                    "--exact-match",
-                    previous_current_commit,
-                ],
-                stdout=subprocess.PIPE,
+            version_tags = self.git.describe(
+                previous_current_commit, exact_match=True
             )
-            (version_tags, _) = git_proc.communicate()
             if not version_tags:
                 # if no tag there, point at the commit directly
-                version_tags = previous_current_commit.encode()
+                version_tags = previous_current_commit
         else:
-            git_proc = subprocess.Popen(
-                [
-                    "git",
-                    "-C",
-                    str(self.source_dir),
-                    "describe",
-                    "--match",
-                    "v*",
-                    "--abbrev=0",
-                    current_commit + "~",
-                ],
-                stdout=subprocess.PIPE,
-            )
-            (version_tags, _) = git_proc.communicate()
+            version_tags = self.git.describe(current_commit + "~", abbrev=0)
         if not version_tags:
             # if no previous version tag, check from (some) root commit
-            git_proc = subprocess.Popen(
-                [
-                    "git",
-                    "-C",
-                    str(self.source_dir),
-                    "rev-list",
-                    "--max-parents=0",
-                    current_commit + "~",
-                ],
-                stdout=subprocess.PIPE,
+            version_tags = "\n".join(
+                self.git.root_commits(current_commit + "~")
             )
-            (version_tags, _) = git_proc.communicate()
 
         if not version_tags:
             # still nothing - looks there is only one commit - no history
             return version, version, "", ""
-        previous_version = version_tags.decode().splitlines()[0]
-
-        git_log_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "log",
-                "{}..{}".format(previous_version, version),
-            ],
-            stdout=subprocess.PIPE,
-        )
+        previous_version = version_tags.splitlines()[0]
 
-        (b_git_log, _) = git_log_proc.communicate()
-        git_log = b_git_log.decode()
         referenced_issues = []
-        for line in git_log.splitlines():
-            match = issue_re.search(line)
-            if match:
-                issues_string = match.group(0)
-                issues_numbers = [
-                    int(cleanup_re.sub("", s)) for s in issues_string.split()
-                ]
-                referenced_issues.extend(issues_numbers)
+        for entry in self.git.log(previous_version, version):
+            for line in entry.message_lines():
+                match = issue_re.search(line)
+                if match:
+                    issues_string = match.group(0)
+                    issues_numbers = [
+                        int(cleanup_re.sub("", s))
+                        for s in issues_string.split()
+                    ]
+                    referenced_issues.extend(issues_numbers)
 
         referenced_issues_txt = "\n".join(
             "QubesOS/qubes-issues#{}".format(x) for x in set(referenced_issues)
         )
 
         github_full_repo_name = "/".join(git_url.split("/")[-2:])
-
-        git_log_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "log",
-                "--pretty=format:{}@%h %s".format(github_full_repo_name),
-                "{}..{}".format(previous_version, version),
-            ],
-            stdout=subprocess.PIPE,
+        shortlog = self.git.shortlog(
+            previous_version, version, github_full_repo_name
         )
-        (b_shortlog, _) = git_log_proc.communicate()
-        shortlog = b_shortlog.decode()
 
         return version, previous_version, shortlog, referenced_issues_txt
 
+    def get_issue_index(self, repo_name) -> Optional[IssueIndex]:
+        if self.state_dir is None:
+            return None
+        if repo_name not in self.issue_indexes:
+            self.issue_indexes[repo_name] = IssueIndex(
+                Path(self.state_dir)
+                / f"issues-index-{repo_name.replace('/', '_')}.json"
+            )
+        return self.issue_indexes[repo_name]
+
+    def search_issue(self, github_repo, issue_title):
+        index = self.get_issue_index(self.github_report_repo_name)
+        if index is None:
+            for issue in github_repo.get_issues():
+                if issue.title == issue_title:
+                    return issue.number
+            return None
+
+        issue_no = index.get(issue_title)
+        if issue_no is not None:
+            # invalidate the entry if the issue was closed in the meantime
+            issue = github_repo.get_issue(issue_no)
+            if issue.state == "open" and issue.title == issue_title:
+                return issue_no
+            index.discard(issue_title)
+
+        # look for issues created or updated since the last refresh
+        index.refresh(github_repo)
+        return index.get(issue_title)
+
     def search_or_create_issue(
         self,
         release,
@@ -293,18 +341,19 @@ class NotifyIssueCli:
         message_template_kwargs=None,
     ):
         try:
-            github_repo = self.gi.get_repo(self.github_report_repo_name)
+            github_repo = self.context.get_github_repo(
+                self.token, self.github_report_repo_name
+            )
         except GithubException as e:
             raise NotifyIssueError(str(e)) from e
 
         issue_title = "{component} {version} ({release})".format(
             component=component, version=version, release=release
         )
-        issue_no = None
-        for issue in github_repo.get_issues():
-            if issue.title == issue_title:
-                issue_no = issue.number
-                break
+        try:
+            issue_no = self.search_issue(github_repo, issue_title)
+        except GithubException as e:
+            raise NotifyIssueError(str(e)) from e
 
         # if nothing, create new issue
         if issue_no is None:
@@ -325,13 +374,13 @@ class NotifyIssueCli:
                     self.message_templates_dir / "message-build-report"
                 )
 
-            if not message_template_path.exists():
+            message_template = self.context.read_message_template(
+                message_template_path
+            )
+            if message_template is None:
                 log.warning(f"Cannot find template message")
                 return None
 
-            with open(message_template_path) as f:
-                message_template = f.read()
-
             message = (
                 message_template.replace("@COMPONENT@", component)
                 .replace("@RELEASE_NAME@", release)
@@ -349,6 +398,9 @@ class NotifyIssueCli:
                     title=issue_title, body=message
                 )
                 issue_no = issue.number
+                index = self.get_issue_index(self.github_report_repo_name)
+                if index is not None:
+                    index.add(issue_title, issue_no)
             except GithubException as e:
                 log.warning(f"Failed to create issue: {str(e)}")
 
@@ -364,7 +416,7 @@ class NotifyIssueCli:
     ):
 
         try:
-            github_repo = self.gi.get_repo(github_repo)
+            github_repo = self.context.get_github_repo(self.token, github_repo)
             issue = github_repo.get_issue(issue_no)
         except GithubException as e:
             raise NotifyIssueError(str(e)) from e
@@ -375,21 +427,20 @@ class NotifyIssueCli:
             except GithubException as e:
                 log.warning(f"Failed to create comment on {issue_no}: {str(e)}")
 
-        for label in delete_labels:
-            try:
-                issue.remove_from_labels(label)
-            except GithubException as e:
-                log.warning(
-                    f"Failed to delete {label} label from issue {issue_no}: {str(e)}"
-                )
-
-        for label in add_labels:
-            try:
-                issue.add_to_labels(label)
-            except GithubException as e:
-                log.warning(
-                    f"Failed to add {label} label to issue {issue_no}: {str(e)}"
-                )
+        # compute the final set of labels and apply it in one request
+        current_labels = [label.name for label in issue.labels]
+        labels = [
+            label for label in current_labels if label not in delete_labels
+        ]
+        labels += [label for label in add_labels if label not in labels]
+        if set(labels) == set(current_labels):
+            return
+        try:
+            issue.set_labels(*labels)
+        except GithubException as e:
+            log.warning(
+                f"Failed to set labels {labels} on issue {issue_no}: {str(e)}"
+            )
 
     def notify_closed_issues(
         self,
@@ -400,61 +451,44 @@ class NotifyIssueCli:
         previous_commit,
         add_labels,
         delete_labels,
+        commented_issues=None,
     ):
+        """
+        Comment issues closed by commits between previous_commit and
+        current_commit. Issues in commented_issues are skipped, and issues
+        commented are added to it, so that a retry doesn't comment them
+        again.
+        """
         message = f"message-{repo_type}-{dist.package_set}"
-        if (self.message_templates_dir / f"{message}-{dist.name}").exists():
-            message_template_path = (
-                self.message_templates_dir / f"{message}-{dist.name}"
-            )
-        elif (
-            self.message_templates_dir / f"{message}-{dist.fullname}"
-        ).exists():
-            message_template_path = (
+        message_template = self.context.read_message_template(
+            self.message_templates_dir / f"{message}-{dist.name}"
+        )
+        if message_template is None:
+            message_template = self.context.read_message_template(
                 self.message_templates_dir / f"{message}-{dist.fullname}"
             )
-        else:
+        if message_template is None:
             log.warning("Cannot find message template not adding comments")
-            message_template_path = None
-
-        git_log_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "log",
-                "{}..{}".format(previous_commit, current_commit),
-            ],
-            stdout=subprocess.PIPE,
-        )
-        (b_git_log, _) = git_log_proc.communicate()
+
         closed_issues = []
-        for line in b_git_log.decode().splitlines():
-            match = fixes_re.search(line)
-            if match:
-                issues_string = match.group(0)
-                issues_numbers = [
-                    int(cleanup_re.sub("", s))
-                    for s in issues_string.split()[1:]
-                ]
-                closed_issues.extend(issues_numbers)
+        for entry in self.git.log(previous_commit, current_commit):
+            for line in entry.message_lines():
+                match = fixes_re.search(line)
+                if match:
+                    issues_string = match.group(0)
+                    issues_numbers = [
+                        int(cleanup_re.sub("", s))
+                        for s in issues_string.split()[1:]
+                    ]
+                    closed_issues.extend(issues_numbers)
 
         closed_issues = set(closed_issues)  # type: ignore
 
-        git_log_proc = subprocess.Popen(
-            [
-                "git",
-                "-C",
-                str(self.source_dir),
-                "log",
-                "--pretty=format:{}-{}@%h %s".format(
-                    github_repo_prefix, self.source_dir.name
-                ),
-                "{}..{}".format(previous_commit, current_commit),
-            ],
-            stdout=subprocess.PIPE,
+        shortlog = self.git.shortlog(
+            previous_commit,
+            current_commit,
+            "{}-{}".format(github_repo_prefix, self.source_dir.name),
         )
-        (b_shortlog, _) = git_log_proc.communicate()
-        shortlog = b_shortlog.decode()
 
         git_url_var = "GIT_URL_" + self.source_dir.name.replace("-", "_")
         if git_url_var in os.environ:
@@ -474,12 +508,12 @@ class NotifyIssueCli:
         component = self.source_dir.name
 
         for issue in closed_issues:
+            if commented_issues is not None and issue in commented_issues:
+                continue
             log.info(f"Adding a comment to issue #{issue}")
-            if message_template_path:
+            if message_template is not None:
                 issue_message: Optional[str] = (
-                    open(message_template_path, "r")
-                    .read()
-                    .replace("@DIST@", dist.name)
+                    message_template.replace("@DIST@", dist.name)
                     .replace("@PACKAGE_SET@", dist.package_set)
                     .replace("@PACKAGE_NAME@", package_name)
                     .replace("@COMPONENT@", component)
@@ -492,6 +526,16 @@ class NotifyIssueCli:
                 issue_message = None
 
             self.comment_issue(issue, issue_message, add_labels, delete_labels)
+            if commented_issues is not None:
+                commented_issues.append(issue)
+
+    def read_state_file(self, state_file):
+        if not state_file.exists():
+            log.warning(
+                f"{str(state_file)} does not exist, initializing with the current state"
+            )
+            return None
+        return state_file.read_text(encoding="utf-8").strip()
 
     def run(
         self,
@@ -505,13 +549,21 @@ class NotifyIssueCli:
         stable_state_file=None,
         build_log=None,
         additional_info=None,
+        current_commit=None,
+        previous_commit=None,
+        commented_issues=None,
     ):
+        """
+        Report build status. Without state_file, the commit uploaded before
+        is given by previous_commit, the caller keeping the state itself.
+        """
         if dist.package_set == "host":
             dist_label = "host"
         else:
             dist_label = dist.distribution
 
-        current_commit = self.get_current_commit()
+        if current_commit is None:
+            current_commit = self.get_current_commit()
         previous_stable_commit = None
 
         if command == "upload" and repository_type == "current":
@@ -526,13 +578,8 @@ class NotifyIssueCli:
         )
 
         if command == "upload" and build_status == "uploaded":
-            if not state_file.exists():
-                log.warning(
-                    f"{str(state_file)} does not exist, initializing with the current state"
-                )
-                previous_commit = None
-            else:
-                previous_commit = state_file.read_text(encoding="utf-8").strip()
+            if state_file is not None:
+                previous_commit = self.read_state_file(state_file)
 
             if previous_commit is not None and repository_type in [
                 "stable",
@@ -546,9 +593,11 @@ class NotifyIssueCli:
                     previous_commit,
                     add_labels,
                     delete_labels,
+                    commented_issues=commented_issues,
                 )
 
-            state_file.write_text(current_commit, encoding="utf-8")
+            if state_file is not None:
+                state_file.write_text(current_commit, encoding="utf-8")
 
             if stable_state_file.exists():
                 previous_stable_commit = stable_state_file.read_text(
@@ -573,7 +622,13 @@ class NotifyIssueCli:
             upload_suffix_message = f"{repository_type} repository"
 
         if build_status == "building":
-            report_message = None
+            # only with live logs, to link the log being written
+            if build_log:
+                report_message = (
+                    f"{base_message} is being built ([build log]({build_log}))."
+                )
+            else:
+                report_message = None
         elif build_status == "built":
             if build_log:
                 report_message = (
@@ -593,6 +648,10 @@ class NotifyIssueCli:
                 report_message = (
                     f"{report_message.rstrip('.')} ({additional_info})."
                 )
+        elif build_status == "superseded":
+            report_message = (
+                f"{base_message} build was cancelled, superseded by a newer build."
+            )
         elif build_status == "failed" and command in ["build", "upload"]:
             if command == "build":
                 suffix_message = "build"
@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: durable queue of GitHub notifications.
+# - entries are JSON files in a queue directory (usually in state-dir)
+# - a background thread processes them in order, one target at a time
+# - failed entries are retried with exponential backoff
+# - a "building" entry not yet processed is dropped when a newer entry for
+#   the same target is queued
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+log = logging.getLogger("notify-queue")
+
+ENTRY_SUFFIX = ".json"
+WORK_SUFFIX = ".work"
+
+# Longest time an action waits for its notifications when done, others are
+# sent by a next run
+JOIN_TIMEOUT = 30
+
+
+def entry_slug(key: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", key)
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class NotifyQueue:
+    """
+    Durable queue of notifications processed by a background thread.
+
+    Entries are claimed by renaming them to a '.work' file, so several
+    processes may share the same queue directory. Entries of the same key
+    are always processed in order.
+    """
+
+    def __init__(
+        self,
+        queue_dir: Path,
+        handler: Callable[[dict], None],
+        max_attempts: int = 5,
+        backoff: float = 2.0,
+    ):
+        self.queue_dir = Path(queue_dir)
+        self.failed_dir = self.queue_dir / "failed"
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._seq = 0
+        # entries queued by this instance, waited for by join()
+        self._queued: set[str] = set()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = False
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """Put back entries claimed by processes that are not running anymore."""
+        for work in self.queue_dir.glob(f"*{ENTRY_SUFFIX}.*{WORK_SUFFIX}"):
+            name, pid, _ = work.name.rsplit(".", 2)
+            if pid.isdigit() and not pid_alive(int(pid)):
+                try:
+                    os.rename(work, self.queue_dir / name)
+                except FileNotFoundError:
+                    pass
+
+    def put(self, key: str, status: str, payload: dict):
+        slug = entry_slug(key)
+        entry = {
+            "key": key,
+            "status": status,
+            "payload": payload,
+            "attempts": 0,
+            "not-before": 0,
+        }
+        with self._cond:
+            # a pending 'building' notification is superseded by any newer one
+            for path in sorted(self.queue_dir.glob(f"*-{slug}{ENTRY_SUFFIX}")):
+                try:
+                    pending = json.loads(path.read_text(encoding="utf-8"))
+                except (OSError, ValueError):
+                    continue
+                if (
+                    pending.get("key") == key
+                    and pending.get("status") == "building"
+                    and pending.get("attempts") == 0
+                ):
+                    try:
+                        path.unlink()
+                        log.debug(
+                            f"{key}: dropping superseded 'building' notification"
+                        )
+                    except FileNotFoundError:
+                        pass
+            self._seq += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self._seq:06d}-{slug}{ENTRY_SUFFIX}"
+            tmp_path = self.queue_dir / f".{name}.tmp"
+            tmp_path.write_text(json.dumps(entry), encoding="utf-8")
+            os.rename(tmp_path, self.queue_dir / name)
+            self._queued.add(name)
+            self._cond.notify_all()
+            self.start()
+
+    def start(self):
+        self._stop = False
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="notify-queue", daemon=True
+            )
+            self._thread.start()
+
+    def _claim(self):
+        """
+        Claim the oldest entry that can be processed now. Return (path,
+        entry) or (None, delay) with the delay before something may become
+        ready.
+        """
+        blocked = set()
+        delay = None
+        now = time.time()
+        for path in sorted(self.queue_dir.iterdir()):
+            name = path.name
+            if name.endswith(WORK_SUFFIX):
+                blocked.add(name.rsplit(".", 2)[0].split("-", 3)[-1])
+                continue
+            if not name.endswith(ENTRY_SUFFIX) or name.startswith("."):
+                continue
+            slug = name.split("-", 3)[-1]
+            if slug in blocked:
+                continue
+            # keep order of entries for the same target
+            blocked.add(slug)
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as e:
+                log.error(f"Invalid notification entry {name}: {str(e)}")
+                self._move_to_failed(path)
+                continue
+            wait = entry.get("not-before", 0) - now
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            work = path.with_name(f"{name}.{os.getpid()}{WORK_SUFFIX}")
+            try:
+                os.rename(path, work)
+            except FileNotFoundError:
+                # claimed or superseded in the meantime
+                continue
+            return work, entry
+        return None, delay
+
+    def _move_to_failed(self, path: Path):
+        self.failed_dir.mkdir(exist_ok=True)
+        try:
+            os.rename(path, self.failed_dir / path.name)
+        except FileNotFoundError:
+            pass
+
+    def _process(self, work: Path, entry: dict):
+        try:
+            self.handler(entry["payload"])
+            work.unlink()
+        except Exception as e:
+            entry["attempts"] += 1
+            name = work.name.rsplit(".", 2)[0]
+            if entry["attempts"] >= self.max_attempts:
+                log.error(
+                    f"{entry['key']}: giving up notification after {entry['attempts']} attempts: {str(e)}"
+                )
+                work.write_text(json.dumps(entry), encoding="utf-8")
+                self._move_to_failed(work)
+                return
+            delay = self.backoff * 2 ** (entry["attempts"] - 1)
+            log.warning(
+                f"{entry['key']}: notification failed, retrying in {delay}s: {str(e)}"
+            )
+            entry["not-before"] = time.time() + delay
+            work.write_text(json.dumps(entry), encoding="utf-8")
+            os.rename(work, self.queue_dir / name)
+
+    def process_pending(self) -> Optional[float]:
+        """
+        Process every entry ready now. Return None when the queue is empty
+        or the delay before the next entry becomes ready.
+        """
+        while True:
+            with self._lock:
+                work, entry_or_delay = self._claim()
+            if work is None:
+                return entry_or_delay
+            self._process(work, entry_or_delay)
+
+    def _run(self):
+        while True:
+            delay = self.process_pending()
+            with self._cond:
+                if self._stop:
+                    return
+                self._cond.wait(timeout=delay if delay is not None else 5)
+
+    def pending(self) -> int:
+        return len(
+            [
+                p
+                for p in self.queue_dir.iterdir()
+                if p.name.endswith(ENTRY_SUFFIX) and not p.name.startswith(".")
+            ]
+        )
+
+    def queued_pending(self) -> int:
+        """Return the number of entries queued by this instance pending."""
+        names = set()
+        for path in self.queue_dir.iterdir():
+            if path.name.endswith(WORK_SUFFIX):
+                names.add(path.name.rsplit(".", 2)[0])
+            else:
+                names.add(path.name)
+        with self._lock:
+            self._queued &= names
+            return len(self._queued)
+
+    def join(self, timeout: float = JOIN_TIMEOUT):
+        """
+        Wait until notifications queued by this instance are processed.
+        Entries of other processes sharing the queue directory, and entries
+        still failing after timeout, are kept for a next run.
+        """
+        deadline = time.monotonic() + timeout
+        if self.queued_pending():
+            with self._cond:
+                self.start()
+        while self.queued_pending() and time.monotonic() < deadline:
+            with self._cond:
+                self._cond.notify_all()
+            time.sleep(0.1)
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=max(0, deadline - time.monotonic()))
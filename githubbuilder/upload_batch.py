@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Library module: Upload-component requests uploaded together.
+# - dispatch stores each request in the builder directory before starting
+#   its action, so requests waiting for builder.lock are known
+# - the first action holding builder.lock waits for the batch window and
+#   uploads every pending request of the same repository at once
+# - requests uploaded that way are marked done, their own action only
+#   removes the marker
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict, List
+
+log = logging.getLogger("upload-batch")
+
+BATCH_DIR = ".upload-batch"
+REQUEST_SUFFIX = ".json"
+DONE_SUFFIX = ".done"
+
+# Requests and markers older than that are left over by failed commands
+MAX_AGE = 86400
+
+
+def request_id(
+    builder_conf, component_name: str, commit_sha: str, distributions
+) -> str:
+    data = json.dumps(
+        [str(builder_conf), component_name, commit_sha, sorted(distributions)]
+    )
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+class UploadBatch:
+    """
+    Upload-component requests of a builder for one repository. Requests are
+    added without lock, but only taken by actions holding builder.lock.
+    """
+
+    def __init__(self, builder_dir: Path, repository_publish: str):
+        self.path = (
+            Path(builder_dir)
+            / BATCH_DIR
+            / re.sub(r"[^A-Za-z0-9_.-]", "_", repository_publish)
+        )
+
+    def add(self, req_id: str, argv: List[str]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / f".{req_id}.{os.getpid()}.tmp"
+        tmp_path.write_text(
+            json.dumps({"argv": list(argv), "time": time.time()}),
+            encoding="utf-8",
+        )
+        os.replace(tmp_path, self.path / f"{req_id}{REQUEST_SUFFIX}")
+
+    def take_done(self, req_id: str) -> bool:
+        """Return True if the request was uploaded by another action."""
+        try:
+            (self.path / f"{req_id}{DONE_SUFFIX}").unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def discard(self, req_id: str):
+        (self.path / f"{req_id}{REQUEST_SUFFIX}").unlink(missing_ok=True)
+
+    def mark_done(self, req_id: str):
+        try:
+            os.replace(
+                self.path / f"{req_id}{REQUEST_SUFFIX}",
+                self.path / f"{req_id}{DONE_SUFFIX}",
+            )
+        except FileNotFoundError:
+            pass
+
+    def pending(self) -> Dict[str, dict]:
+        """Return pending requests by ID, forgetting stale ones."""
+        requests = {}
+        now = time.time()
+        for path in sorted(self.path.glob("*")):
+            try:
+                if path.suffix == DONE_SUFFIX:
+                    if path.stat().st_mtime < now - MAX_AGE:
+                        path.unlink()
+                    continue
+                if path.suffix != REQUEST_SUFFIX:
+                    continue
+                request = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                log.warning(f"Cannot read upload request {path.name}: {e}")
+                continue
+            if request.get("time", 0) < now - MAX_AGE:
+                log.warning(f"Dropping stale upload request {path.name}")
+                path.unlink(missing_ok=True)
+                continue
+            requests[path.name[: -len(REQUEST_SUFFIX)]] = request
+        return requests
+
+    def collect(self, window: float) -> Dict[str, dict]:
+        """
+        Wait until window seconds passed since the oldest pending request
+        was received, and return pending requests.
+        """
+        requests = self.pending()
+        if requests:
+            oldest = min(r.get("time", 0) for r in requests.values())
+            delay = oldest + window - time.time()
+            if delay > 0:
+                log.info(f"Waiting {delay:.0f}s for more upload requests")
+                time.sleep(delay)
+                requests = self.pending()
+        return requests
@@ -0,0 +1,244 @@
+import logging
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from conftest import load_action_module
+
+NOTIFICATIONS = 20
+LOG_LINES = 50000
+
+
+def make_synthetic_repo(path: Path, commits=6000, tag_every=10):
+    """
+    Create a repository with many commits and annotated version tags, packed
+    like a cloned one.
+    """
+    if (path / ".git").exists():
+        return path
+    path.mkdir(parents=True)
+    subprocess.run(["git", "init", "-q", str(path)], check=True)
+    stream = []
+    timestamp = 1600000000
+    for i in range(commits):
+        message = f"Change {i}\n"
+        if i % 7 == 0:
+            message += f"\nFixes QubesOS/qubes-issues#{i}\n"
+        content = f"{i}\n"
+        stream += [
+            "commit refs/heads/main",
+            f"mark :{i + 1}",
+            f"committer unit <unit@localhost> {timestamp + i * 60} +0000",
+            f"data {len(message.encode())}",
+            message,
+            "M 644 inline version",
+            f"data {len(content.encode())}",
+            content,
+        ]
+        if i % tag_every == tag_every - 1:
+            tag_message = f"v1.{i // tag_every}\n"
+            stream += [
+                f"tag v1.{i // tag_every}",
+                f"from :{i + 1}",
+                f"tagger unit <unit@localhost> {timestamp + i * 60} +0000",
+                f"data {len(tag_message.encode())}",
+                tag_message,
+            ]
+    subprocess.run(
+        ["git", "-C", str(path), "fast-import", "--quiet"],
+        input="\n".join(stream).encode(),
+        check=True,
+    )
+    subprocess.run(
+        ["git", "-C", str(path), "checkout", "-q", "main"], check=True
+    )
+    subprocess.run(
+        ["git", "-C", str(path), "repack", "-q", "-a", "-d"], check=True
+    )
+    # a few commits after the last tag
+    subprocess.run(
+        ["git", "-C", str(path), "commit", "-q", "--allow-empty"]
+        + ["-m", "Work in progress\n\nFixes QubesOS/qubes-issues#1"],
+        check=True,
+        env={
+            "GIT_AUTHOR_NAME": "unit",
+            "GIT_AUTHOR_EMAIL": "unit@localhost",
+            "GIT_COMMITTER_NAME": "unit",
+            "GIT_COMMITTER_EMAIL": "unit@localhost",
+            "GIT_AUTHOR_DATE": f"{timestamp + commits * 60} +0000",
+            "GIT_COMMITTER_DATE": f"{timestamp + commits * 60} +0000",
+        },
+    )
+    return path
+
+
+@pytest.fixture(scope="module")
+def synthetic_repo(workdir):
+    tmpdir, _env = workdir
+    return make_synthetic_repo(Path(str(tmpdir)) / "benchmark" / "core-qrexec")
+
+
+def test_benchmark_git_repo_views_match(workdir, synthetic_repo):
+    pytest.importorskip("pygit2")
+    git_metadata = sys.modules["githubbuilder.git_metadata"]
+    subprocess_view = git_metadata.SubprocessGitRepoView(synthetic_repo)
+    pygit2_view = git_metadata.Pygit2GitRepoView(synthetic_repo)
+
+    head = subprocess_view.current_commit()
+    assert pygit2_view.current_commit() == head
+    for revs in [
+        ["v1.10", head],
+        [head + "~", "v1.10~3", head[:12]],
+        ["v1.0^{commit}", "main"],
+    ]:
+        assert pygit2_view.resolve(revs) == subprocess_view.resolve(revs)
+        assert len(pygit2_view.resolve(revs)) == len(revs)
+    assert pygit2_view.resolve(["v9.9"]) is None
+    assert subprocess_view.resolve(["v9.9"]) is None
+
+    for rev in [head, head + "~", "v1.10", "v1.10~3", "v9.9"]:
+        for kwargs in [
+            {},
+            {"always": True},
+            {"exact_match": True},
+            {"abbrev": 0},
+        ]:
+            assert pygit2_view.describe(
+                rev, **kwargs
+            ) == subprocess_view.describe(rev, **kwargs), (rev, kwargs)
+        assert pygit2_view.root_commits(rev) == subprocess_view.root_commits(
+            rev
+        )
+    assert pygit2_view.describe(head, always=True).startswith("v1.599-1-g")
+
+    for start, end in [("v1.500", head), ("v1.10", "v1.12"), ("v9.9", head)]:
+        assert pygit2_view.log(start, end) == subprocess_view.log(start, end)
+    assert len(pygit2_view.log("v1.500", head)) == 991
+
+
+@pytest.mark.parametrize(
+    "backend", ["SubprocessGitRepoView", "Pygit2GitRepoView"]
+)
+def test_benchmark_notification_git_latency(workdir, synthetic_repo, backend):
+    """
+    Git queries of an action notifying about its component: the first
+    notification computes package changes, the following ones (other
+    distributions and statuses) reuse them.
+    """
+    if backend == "Pygit2GitRepoView":
+        pytest.importorskip("pygit2")
+    git_metadata = sys.modules["githubbuilder.git_metadata"]
+    notify_issues = sys.modules["githubbuilder.notify_issues"]
+    git_url = "https://github.com/QubesOS/qubes-core-qrexec"
+
+    first, following = [], []
+    for run in range(5):
+        notify_cli = notify_issues.NotifyIssueCli(
+            token="",
+            release_name="r4.2",
+            source_dir=synthetic_repo,
+            message_templates_dir=Path("/nonexistent"),
+            github_report_repo_name="QubesOS/updates-status",
+            min_age_days=5,
+        )
+        notify_cli.git._repo = getattr(git_metadata, backend)(synthetic_repo)
+        for i in range(NOTIFICATIONS):
+            start = time.perf_counter()
+            current_commit = notify_cli.get_current_commit()
+            changes = notify_cli.get_package_changes(
+                git_url,
+                current_commit,
+                previous_current_commit=f"v1.{500 + run}",
+            )
+            (first if i == 0 else following).append(
+                time.perf_counter() - start
+            )
+            assert changes[1] == f"v1.{500 + run}"
+            assert "QubesOS/qubes-issues#1" in changes[3].splitlines()
+
+    def median(durations):
+        return sorted(durations)[len(durations) // 2]
+
+    # following notifications don't query git again
+    assert median(following) * 10 < median(first)
+
+
+@pytest.mark.parametrize("flush_interval", [0, 0.5])
+def test_benchmark_build_log_forwarding(workdir, monkeypatch, flush_interval):
+    """
+    Build log lines forwarded to a pipe, like qubesbuilder.BuildLog stdin:
+    flushed after every record or batched.
+    """
+    tmpdir, env = workdir
+    action = load_action_module(
+        env, tmpdir / "qubes-builder-github", monkeypatch
+    )
+    with subprocess.Popen(
+        ["wc", "-l"],
+        text=True,
+        bufsize=action.LOG_BUFFER_SIZE if flush_interval else -1,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    ) as p:
+        assert p.stdin is not None
+        assert p.stdout is not None
+        logger = logging.getLogger(f"benchmark-log-{flush_interval}")
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        handler = action.SafeWrapper(
+            logging.StreamHandler(p.stdin),
+            parent_logger=logger,
+            flush_interval=flush_interval,
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+        start = time.perf_counter()
+        for i in range(LOG_LINES):
+            logger.info(f"compiling source file {i}.c")
+        handler.flush()
+        duration = time.perf_counter() - start
+        logger.removeHandler(handler)
+        p.stdin.close()
+        # nothing is dropped
+        assert int(p.stdout.read()) == LOG_LINES
+    assert duration < 60
+
+
+def test_benchmark_build_log_receiver(workdir):
+    """
+    qubesbuilder.BuildLog receiving a large build log, below the size
+    compressed with xz.
+    """
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "benchmark-buildlog")
+    lines = [
+        f"gcc -O2 -c -o build/{i}.o src/{i}.c\x1b[0m".encode()
+        for i in range(100000)
+    ]
+    data = b"\n".join(lines) + b"\n"
+    start = time.perf_counter()
+    p = subprocess.run(
+        [
+            "python3",
+            str(
+                tmpdir
+                / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+            ),
+        ],
+        input=data,
+        stdout=subprocess.PIPE,
+        check=True,
+        env=env,
+    )
+    duration = time.perf_counter() - start
+    assert duration < 60
+    log_file = (
+        Path(env["HOME"]) / "QubesIncomingBuildLog" / p.stdout.decode().strip()
+    )
+    # starting and closing lines, and every line received
+    assert len(log_file.read_bytes().splitlines()) == len(lines) + 2
@@ -1,6 +1,8 @@
 import importlib.util
+import lzma
 import subprocess
 import sys
+import time
 from pathlib import Path
 
 from conftest import run_cmd
@@ -39,3 +41,226 @@ def test_qubesbuilder_buildlog(workdir):
     log_file = github_action.get_log_file_from_qubesbuilder_buildlog(p.stdout)
     assert log_file is not None
     assert log_file.startswith("testvm/log_")
+
+
+def test_qubesbuilder_buildlog_sanitize(workdir):
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "buildlog-sanitize")
+    untrusted_lines = [
+        b"plain line",
+        b"",
+        b"crlf\r",
+        b"\x1b[1;31mcolors\x1b[0m",
+        bytes(range(256)).replace(b"\n", b""),
+        b"x" * 3 * 2**20,
+        "unicodé".encode(),
+        b"no newline at the end",
+    ]
+    p = run_cmd(
+        [
+            "python3",
+            str(
+                tmpdir
+                / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+            ),
+            "sub/dir",
+        ],
+        stdout=subprocess.PIPE,
+        input=b"\n".join(untrusted_lines),
+        check=True,
+        env=env,
+    )
+    log_file = (
+        tmpdir
+        / "buildlog-sanitize/QubesIncomingBuildLog"
+        / (p.stdout.decode().strip())
+    )
+    lines = Path(log_file).read_bytes().split(b"\n")
+    assert lines.pop() == b""
+    assert lines[0].endswith(b" +0000 > starting log")
+    assert lines[-1].endswith(b" +0000 > closing log")
+    messages = [line.split(b" testvm: ", 1)[1] for line in lines[1:-1]]
+    assert messages == [
+        bytes(c if 0x20 <= c <= 0x7E else 0x2E for c in line)
+        for line in untrusted_lines
+    ]
+
+
+def test_qubesbuilder_buildlog_compressed(workdir):
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "buildlog-compressed")
+    incoming_log_dir = (
+        Path(str(tmpdir)) / "buildlog-compressed/QubesIncomingBuildLog"
+    )
+    incoming_log_dir.mkdir(parents=True)
+    (incoming_log_dir / "buildlog.conf").write_text("# fast\nxz-preset = 0\n")
+    untrusted_lines = [f"line {i}".encode() for i in range(600000)]
+    p = run_cmd(
+        [
+            "python3",
+            str(
+                tmpdir
+                / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+            ),
+        ],
+        stdout=subprocess.PIPE,
+        input=b"\n".join(untrusted_lines),
+        check=True,
+        env=env,
+    )
+    log_file = incoming_log_dir / p.stdout.decode().strip()
+    assert log_file.suffix == ".xz"
+    # the uncompressed name reserved is released
+    assert list(log_file.parent.iterdir()) == [log_file]
+    lines = lzma.decompress(log_file.read_bytes()).split(b"\n")
+    assert lines.pop() == b""
+    assert len(lines) == len(untrusted_lines) + 2
+    assert lines[0].endswith(b" +0000 > starting log")
+    assert lines[-1].endswith(b" +0000 > closing log")
+    assert [
+        line.split(b" testvm: ", 1)[1] for line in lines[1:-1]
+    ] == untrusted_lines
+
+
+def test_qubesbuilder_buildlog_hook_batched(workdir):
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "buildlog-hook")
+    incoming_log_dir = (
+        Path(str(tmpdir)) / "buildlog-hook/QubesIncomingBuildLog"
+    )
+    incoming_log_dir.mkdir(parents=True)
+    calls = incoming_log_dir.parent / "calls"
+    hook = incoming_log_dir / "post-log-hook-batch"
+    hook.write_text(f'#!/bin/sh\nsleep 2\necho "$@" >> {calls}\n')
+    hook.chmod(0o755)
+
+    log_files = []
+    for i in range(3):
+        start = time.monotonic()
+        p = run_cmd(
+            [
+                "python3",
+                str(
+                    tmpdir
+                    / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+                ),
+                f"build-{i}",
+            ],
+            stdout=subprocess.PIPE,
+            input=b"some log\n",
+            check=True,
+            env=env,
+        )
+        # upload is not waited for
+        assert time.monotonic() - start < 2
+        log_files.append(str(incoming_log_dir / p.stdout.decode().strip()))
+
+    spool_dir = incoming_log_dir / ".post-log-hook-spool"
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if len(list(spool_dir.iterdir())) == 1:
+            break
+        time.sleep(0.2)
+    # logs spooled during the first upload are uploaded together
+    assert calls.read_text().splitlines() == [
+        log_files[0],
+        " ".join(log_files[1:]),
+    ]
+    assert [p.name for p in spool_dir.iterdir()] == [".lock"]
+
+
+def test_qubesbuilder_buildlog_live(workdir):
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "buildlog-live")
+    incoming_log_dir = (
+        Path(str(tmpdir)) / "buildlog-live/QubesIncomingBuildLog"
+    )
+    incoming_log_dir.mkdir(parents=True)
+    (incoming_log_dir / "buildlog.conf").write_text(
+        "live-log-segment-size = 0.01\npost-log-hook-async = 0\n"
+    )
+    calls = incoming_log_dir.parent / "calls"
+    hook = incoming_log_dir / "post-log-hook"
+    hook.write_text(f'#!/bin/sh\necho "$@" >> {calls}\n')
+    hook.chmod(0o755)
+
+    p = subprocess.Popen(
+        [
+            "python3",
+            str(
+                tmpdir
+                / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+            ),
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    # the log file name is known before the end of the log
+    log_name = p.stdout.readline().decode().strip()
+    log_file = incoming_log_dir / log_name
+    assert log_name.startswith("testvm/log_")
+    # and can be linked to at once
+    assert log_file.read_text().startswith("Build log being received")
+    for i in range(1000):
+        p.stdin.write(f"line {i}\n".encode())
+    p.stdin.close()
+    assert p.stdout.read().decode().strip() == log_name
+    assert p.wait() == 0
+
+    segments = sorted(log_file.parent.glob(f"{log_file.name}.part*"))
+    assert len(segments) > 1
+    assert b"".join(s.read_bytes() for s in segments) == log_file.read_bytes()
+    # the index is updated with each segment
+    assert calls.read_text().splitlines() == [str(log_file)] + [
+        str(f) for s in segments for f in (s, log_file)
+    ] + [str(log_file)]
+
+
+def test_qubesbuilder_buildlog_live_compressed(workdir):
+    tmpdir, env = workdir
+    env = env.copy()
+    env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+    env["HOME"] = str(tmpdir / "buildlog-live-xz")
+    incoming_log_dir = (
+        Path(str(tmpdir)) / "buildlog-live-xz/QubesIncomingBuildLog"
+    )
+    incoming_log_dir.mkdir(parents=True)
+    (incoming_log_dir / "buildlog.conf").write_text(
+        "live-log-segment-size = 8\nxz-preset = 0\n"
+    )
+    untrusted_lines = [f"line {i}".encode() for i in range(600000)]
+    p = run_cmd(
+        [
+            "python3",
+            str(
+                tmpdir
+                / "qubes-builder-github/rpc-services/qubesbuilder.BuildLog"
+            ),
+        ],
+        stdout=subprocess.PIPE,
+        input=b"\n".join(untrusted_lines),
+        check=True,
+        env=env,
+    )
+    log_name, final_name = p.stdout.decode().split()
+    assert final_name == log_name + ".xz"
+    log_file = incoming_log_dir / log_name
+    segments = sorted(log_file.parent.glob(f"{log_file.name}.part*"))
+    assert len(segments) > 1
+    # the name reported at start stays valid, as an index
+    assert log_file.read_text().splitlines() == [
+        f"Complete build log: {log_file.name}.xz",
+        "Also available in segments:",
+    ] + [s.name for s in segments]
+    assert b"".join(s.read_bytes() for s in segments) == lzma.decompress(
+        (incoming_log_dir / final_name).read_bytes()
+    )
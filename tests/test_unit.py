@@ -1,9 +1,24 @@
 import datetime
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import types
 from pathlib import Path
 
+import pytest
 import yaml
 
-from conftest import load_action_module, make_config
+from conftest import (
+    load_action_module,
+    load_module,
+    make_config,
+    set_conf_options,
+)
+
+PROJECT_PATH = Path(__file__).resolve().parents[1]
 
 
 def test_format_additional_info_base_only(workdir, monkeypatch):
@@ -63,6 +78,62 @@ def test_format_additional_info_tail_truncated(workdir, monkeypatch):
     assert "x" * 101 not in result
 
 
+class FlushCountingStream:
+    def __init__(self):
+        self.written = []
+        self.flushed = []
+        self.broken = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        if self.broken:
+            raise BrokenPipeError
+        self.flushed.append(len(self.written))
+
+
+def test_safe_wrapper_batched_flush(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    import logging
+
+    logger = logging.getLogger("unit-safe-wrapper")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    stream = FlushCountingStream()
+    handler = mod.SafeWrapper(
+        logging.StreamHandler(stream), parent_logger=logger, flush_interval=0.2
+    )
+    logger.addHandler(handler)
+
+    for i in range(100):
+        logger.info(f"line {i}")
+    assert len(stream.written) == 100
+    assert stream.flushed == []
+    # flushed once the interval elapsed
+    deadline = time.monotonic() + 5
+    while not stream.flushed and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert stream.flushed == [100]
+
+    # errors are flushed immediately
+    logger.info("line 100")
+    logger.error("failed")
+    assert stream.flushed == [100, 102]
+
+    # stage boundary
+    logger.info("line 101")
+    handler.flush()
+    assert stream.flushed == [100, 102, 103]
+
+    stream.broken = True
+    logger.error("reader is gone")
+    assert handler not in logger.handlers
+    logger.error("not written")
+    assert len(stream.written) == 104
+
+
 def test_get_log_file_valid_path(workdir, monkeypatch):
     tmpdir, env = workdir
     mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
@@ -97,6 +168,13 @@ def test_get_log_file_skips_blank_lines(workdir, monkeypatch):
     )
 
 
+def test_get_log_file_live_log_returns_final(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    out = "vm/log_abc\nvm/log_abc.xz\n"
+    assert mod.get_log_file_from_qubesbuilder_buildlog(out) == "vm/log_abc.xz"
+
+
 def test_action_template_build_timestamp_skip(workdir, monkeypatch):
     tmpdir, env = workdir
     mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
@@ -225,3 +303,1335 @@ def test_action_component_build_skipped_already_released(workdir, monkeypatch):
     for result in action.results.values():
         assert result.status == "skipped"
         assert "current" in (result.reason or "")
+
+
+def test_action_component_build_parallel(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    builder_conf = tmpdir / "builder-parallel.yml"
+    shutil.copy2(tmpdir / "builder.yml", builder_conf)
+    set_conf_options(builder_conf, {"github": {"build-concurrency": 3}})
+    config = make_config(builder_conf)
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+
+    def fake_release_status(config, components, distributions):
+        return {
+            c.name: {
+                d.distribution: {"status": "not released", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    lock = threading.Lock()
+    running = {"build": 0, "serialized": 0}
+    peak = {"build": 0, "serialized": 0}
+
+    def fake_component_stage(stages, config, components, distributions):
+        if "fetch" in stages:
+            return
+        kind = (
+            "serialized"
+            if "publish" in stages or "upload" in stages
+            else "build"
+        )
+        with lock:
+            running[kind] += 1
+            peak[kind] = max(peak[kind], running[kind])
+        time.sleep(0.2)
+        with lock:
+            running[kind] -= 1
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(mod, "_component_stage", fake_component_stage)
+    monkeypatch.setattr(
+        mod.BaseAutoAction,
+        "make_with_log",
+        lambda self, func, *a, on_log_start=None, **kw: func(*a, **kw),
+    )
+
+    action = mod.AutoAction(
+        builder_dir=tmpdir / "qubes-builderv2",
+        config=config,
+        component=components[0],
+        distributions=config.get_distributions(),
+        state_dir=tmpdir / "github-notify-state-parallel",
+        commit_sha=None,
+        repository_publish=None,
+        local_log_file=None,
+        dry_run=False,
+    )
+    action.build()
+
+    assert peak["build"] > 1, "distributions must be built concurrently"
+    assert peak["serialized"] == 1, "publish/upload must stay serialized"
+    for result in action.results.values():
+        assert result.status == "uploaded"
+
+
+def test_action_component_build_parallel_timeout(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    builder_conf = tmpdir / "builder-parallel-timeout.yml"
+    shutil.copy2(tmpdir / "builder.yml", builder_conf)
+    set_conf_options(builder_conf, {"github": {"build-concurrency": 2}})
+    config = make_config(builder_conf)
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    distributions = config.get_distributions()[:2]
+
+    def fake_release_status(config, components, distributions):
+        return {
+            c.name: {
+                d.distribution: {"status": "not released", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    stage_processes = []
+
+    def fake_component_stage(stages, config, components, distributions):
+        if "fetch" in stages:
+            return
+        with subprocess.Popen(["sleep", "60"]) as p:
+            stage_processes.append(p)
+            if p.wait() != 0:
+                raise RuntimeError("stage interrupted")
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(mod, "_component_stage", fake_component_stage)
+    monkeypatch.setattr(
+        mod.BaseAutoAction,
+        "make_with_log",
+        lambda self, func, *a, on_log_start=None, **kw: func(*a, **kw),
+    )
+
+    action = mod.AutoAction(
+        builder_dir=tmpdir / "qubes-builderv2",
+        config=config,
+        component=components[0],
+        distributions=distributions,
+        state_dir=tmpdir / "github-notify-state-parallel-timeout",
+        commit_sha=None,
+        repository_publish=None,
+        local_log_file=None,
+        dry_run=False,
+        force_rebuild=True,
+    )
+    action.timeout = 1
+    start = time.monotonic()
+    with pytest.raises(mod.AutoActionTimeout):
+        action.build()
+
+    # nothing keeps building once the action is over
+    assert time.monotonic() - start < 30
+    assert len(stage_processes) == 2
+    assert all(p.returncode is not None for p in stage_processes)
+    assert not [
+        t for t in threading.enumerate() if t.name.startswith("build-")
+    ]
+    for result in action.results.values():
+        assert result.status == "failed"
+        assert result.reason == "Timeout"
+
+
+def test_action_component_build_ledger(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    config = make_config(tmpdir / "builder.yml")
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    distributions = config.get_distributions()[:1]
+    monkeypatch.setattr(components[0], "get_source_hash", lambda: "abc")
+
+    def fake_release_status(config, components, distributions):
+        return {
+            c.name: {
+                d.distribution: {"status": "not released", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    stages_run = []
+    notified = []
+    artifacts = {"present": True}
+
+    def fake_component_stage(stages, config, components, distributions):
+        stages_run.extend(s for s in stages if s != "fetch")
+        if "build" in stages:
+            artifacts["present"] = True
+        elif "publish" in stages and not artifacts["present"]:
+            raise RuntimeError("no build artifacts")
+
+    def fake_make_with_log(self, func, *args, on_log_start=None, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            raise mod.AutoActionError(str(e), log_file="log_error") from e
+        return f"log_{len(stages_run)}"
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(mod, "_component_stage", fake_component_stage)
+    monkeypatch.setattr(
+        mod.BaseAutoAction, "make_with_log", fake_make_with_log
+    )
+    monkeypatch.setattr(
+        mod.AutoAction,
+        "notify_build_status",
+        lambda self, status, stage="build", log_file=None, **kw: notified.append(
+            (status, log_file)
+        ),
+    )
+
+    def run_build(force_rebuild=False):
+        stages_run.clear()
+        notified.clear()
+        action = mod.AutoAction(
+            builder_dir=tmpdir / "qubes-builderv2",
+            config=config,
+            component=components[0],
+            distributions=distributions,
+            state_dir=tmpdir / "github-notify-state-ledger",
+            commit_sha=None,
+            repository_publish=None,
+            local_log_file=None,
+            dry_run=False,
+            force_rebuild=force_rebuild,
+        )
+        action.build()
+
+    shutil.rmtree(tmpdir / "github-notify-state-ledger", ignore_errors=True)
+    run_build()
+    assert stages_run == ["prep", "build", "sign", "publish", "upload"]
+    assert notified[-2:] == [("built", "log_4"), ("uploaded", "log_4")]
+
+    # same sources and configuration: reported with the log of the build
+    run_build()
+    assert stages_run == ["publish", "upload"]
+    assert notified == [("built", "log_4"), ("uploaded", "log_4")]
+
+    run_build(force_rebuild=True)
+    assert stages_run == ["prep", "build", "sign", "publish", "upload"]
+
+    # artifacts removed since: built again
+    artifacts["present"] = False
+    run_build()
+    assert stages_run == [
+        "publish",
+        "prep",
+        "build",
+        "sign",
+        "publish",
+        "upload",
+    ]
+    assert notified[-2:] == [("built", "log_5"), ("uploaded", "log_5")]
+
+
+def test_action_component_build_superseded(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    job_queue_mod = sys.modules["githubbuilder.job_queue"]
+    config = make_config(tmpdir / "builder.yml")
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    distributions = config.get_distributions()[:2]
+    assert len(distributions) == 2
+    builder_dir = tmpdir / "qubes-builderv2"
+    shutil.rmtree(builder_dir / ".jobs", ignore_errors=True)
+
+    get_components = config.get_components
+
+    def get_components_by_url(filtered=None, url_match=False):
+        # requested by its repository name
+        if url_match and filtered == ["qubes-app-linux-split-gpg"]:
+            filtered = ["app-linux-split-gpg"]
+        return get_components(filtered, url_match=url_match)
+
+    monkeypatch.setattr(config, "get_components", get_components_by_url)
+
+    def fake_release_status(config, components, distributions):
+        return {
+            c.name: {
+                d.distribution: {"status": "not released", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    stages_run = []
+    notified = []
+    commits = {"fetched": "1" * 40, "upstream": "1" * 40}
+    dispatched_during = {"stage": "build"}
+
+    def fake_component_stage(stages, config, components, distributions):
+        stages_run.extend(s for s in stages if s != "fetch")
+        if dispatched_during["stage"] in stages:
+            # newer builds are dispatched meanwhile
+            job_queue_mod.mark_superseded(builder_dir, "core-qrexec")
+            job_queue_mod.mark_superseded(
+                builder_dir, "qubes-app-linux-split-gpg"
+            )
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(mod, "_component_stage", fake_component_stage)
+
+    def fake_make_with_log(self, func, *args, on_log_start=None, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            raise mod.AutoActionError(str(e), log_file="log_build") from e
+        return "log_build"
+
+    monkeypatch.setattr(
+        mod.BaseAutoAction, "make_with_log", fake_make_with_log
+    )
+    monkeypatch.setattr(
+        mod.AutoAction,
+        "notify_build_status",
+        lambda self, status, stage="build", **kw: notified.append(
+            (kw["dist"].distribution, status)
+        ),
+    )
+    monkeypatch.setattr(
+        mod.AutoAction, "upstream_commit", lambda self: commits["upstream"]
+    )
+    monkeypatch.setattr(
+        mod.AutoAction, "fetched_commit", lambda self: commits["fetched"]
+    )
+
+    def run_build():
+        stages_run.clear()
+        notified.clear()
+        action = mod.AutoAction(
+            builder_dir=builder_dir,
+            config=config,
+            component=components[0],
+            distributions=distributions,
+            state_dir=tmpdir / "github-notify-state-superseded",
+            commit_sha=None,
+            repository_publish=None,
+            local_log_file=None,
+            dry_run=False,
+            force_rebuild=True,
+        )
+        action.build()
+        return action
+
+    # the branch didn't move: nothing to cancel
+    action = run_build()
+    assert stages_run == ["prep", "build", "sign", "publish", "upload"] * 2
+    for result in action.results.values():
+        assert result.status == "uploaded"
+
+    # cancelled before publishing, then before building the next one
+    commits["upstream"] = "2" * 40
+    action = run_build()
+    assert stages_run == ["prep", "build", "sign"]
+    first, second = [d.distribution for d in distributions]
+    assert notified == [
+        (first, "building"),
+        (first, "superseded"),
+        (second, "superseded"),
+    ]
+    assert action.results[distributions[0].name].log_file == "log_build"
+    for result in action.results.values():
+        assert result.status == "superseded"
+
+    # uploaded once published
+    dispatched_during["stage"] = "publish"
+    action = run_build()
+    assert stages_run == ["prep", "build", "sign", "publish", "upload"]
+    assert notified == [
+        (first, "building"),
+        (first, "built"),
+        (first, "uploaded"),
+        (second, "superseded"),
+    ]
+    assert action.results[distributions[0].name].status == "uploaded"
+    assert action.results[distributions[1].name].status == "superseded"
+
+
+def test_action_component_build_live_log(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    builder_conf = tmpdir / "builder-live-log.yml"
+    shutil.copy2(tmpdir / "builder.yml", builder_conf)
+    set_conf_options(builder_conf, {"github": {"live-log": True}})
+    config = make_config(builder_conf)
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+
+    home = Path(str(tmpdir)) / "live-log-home"
+    (home / "QubesIncomingBuildLog").mkdir(parents=True)
+    (home / "QubesIncomingBuildLog/buildlog.conf").write_text(
+        "live-log-segment-size = 1\n"
+    )
+
+    def popen_buildlog(args, *popen_args, **popen_kwargs):
+        assert args == ["qrexec-client-vm", "dom0", "qubesbuilder.BuildLog"]
+        popen_kwargs["env"] = {
+            **os.environ,
+            "HOME": str(home),
+            "QREXEC_REMOTE_DOMAIN": "testvm",
+        }
+        return subprocess.Popen(
+            [
+                sys.executable,
+                str(PROJECT_PATH / "rpc-services/qubesbuilder.BuildLog"),
+            ],
+            *popen_args,
+            **popen_kwargs,
+        )
+
+    monkeypatch.setattr(
+        mod,
+        "subprocess",
+        types.SimpleNamespace(**{**vars(subprocess), "Popen": popen_buildlog}),
+    )
+
+    action = mod.AutoAction(
+        builder_dir=tmpdir / "qubes-builderv2",
+        config=config,
+        component=components[0],
+        distributions=config.get_distributions(),
+        state_dir=tmpdir / "github-notify-state-live-log",
+        commit_sha=None,
+        repository_publish=None,
+        local_log_file=None,
+        dry_run=False,
+    )
+    notified = []
+    monkeypatch.setattr(
+        action, "notify_build_status", lambda **kw: notified.append(kw)
+    )
+    dist = action.distributions[0]
+    result = action.register_result(str(dist), dist, str(dist))
+
+    def build():
+        # the log link is sent while the build is running
+        deadline = time.monotonic() + 10
+        while not notified and time.monotonic() < deadline:
+            time.sleep(0.05)
+        mod.log.info("building")
+
+    log_file = action.make_with_log(
+        build,
+        on_log_start=action.live_log_notifier(result, "build", dist=dist),
+    )
+    assert log_file.startswith("testvm/log_")
+    assert len(notified) == 1
+    assert notified[0]["status"] == "building"
+    assert notified[0]["log_file"] == log_file
+    assert notified[0]["dist"] == dist
+    log_path = home / "QubesIncomingBuildLog" / log_file
+    assert "building" in log_path.read_text()
+    assert log_path.with_name(log_path.name + ".part001").exists()
+
+
+def test_action_component_build_release_status_batched(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    config = make_config(tmpdir / "builder.yml")
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    calls = []
+
+    def fake_release_status(config, components, distributions):
+        calls.append([d.distribution for d in distributions])
+        return {
+            c.name: {
+                d.distribution: {"status": "current", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(
+        mod.BaseAutoAction, "make_with_log", lambda self, *a, **kw: None
+    )
+
+    action = mod.AutoAction(
+        builder_dir=tmpdir / "qubes-builderv2",
+        config=config,
+        component=components[0],
+        distributions=config.get_distributions(),
+        state_dir=tmpdir / "github-notify-state-batched",
+        commit_sha=None,
+        repository_publish=None,
+        local_log_file=None,
+        dry_run=False,
+    )
+    action.build()
+
+    assert calls == [[d.distribution for d in config.get_distributions()]]
+
+
+def test_action_component_upload_batched(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    config = make_config(tmpdir / "builder.yml")
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    distributions = config.get_distributions()
+    assert len(distributions) > 1
+    monkeypatch.setattr(components[0], "get_source_commit_hash", lambda: "1")
+
+    def fake_release_status(config, components, distributions):
+        return {
+            c.name: {
+                d.distribution: {"status": "not released", "tag": "v2.0.60"}
+                for d in distributions
+            }
+            for c in components
+        }
+
+    published = []
+    uploaded = []
+    failing = distributions[-1].distribution
+
+    def fake_publish(
+        config, repository_publish, components, distributions, **kw
+    ):
+        published.append([d.distribution for d in distributions])
+
+    def fake_upload(config, repository_publish, distributions, **kw):
+        uploaded.append([d.distribution for d in distributions])
+        if failing in uploaded[-1]:
+            raise ValueError("rsync failed")
+
+    monkeypatch.setattr(
+        mod, "_check_release_status_for_component", fake_release_status
+    )
+    monkeypatch.setattr(mod, "_publish", fake_publish)
+    monkeypatch.setattr(mod, "_upload", fake_upload)
+    monkeypatch.setattr(
+        mod.BaseAutoAction,
+        "make_with_log",
+        lambda self, func, *a, on_log_start=None, **kw: func(*a, **kw),
+    )
+
+    def make_action():
+        return mod.AutoAction(
+            builder_dir=tmpdir / "qubes-builderv2",
+            config=config,
+            component=components[0],
+            distributions=distributions,
+            state_dir=tmpdir / "github-notify-state-upload-batched",
+            commit_sha="1",
+            repository_publish="current-testing",
+            local_log_file=None,
+            dry_run=False,
+        )
+
+    action = make_action()
+    action.upload()
+
+    names = [d.distribution for d in distributions]
+    assert published == [[name] for name in names]
+    # one upload for all distributions, then one by one after its failure
+    assert uploaded == [names] + [[name] for name in names]
+    for dist in distributions:
+        result = action.get_result(dist.name)
+        if dist.distribution == failing:
+            assert result.status == "failed"
+            assert "rsync failed" in result.reason
+        else:
+            assert result.status == "uploaded"
+
+    # only actions having all distributions uploaded are returned
+    assert mod.upload_components([make_action()]) == []
+    failing = None
+    action = make_action()
+    assert mod.upload_components([action]) == [action]
+
+
+class FakeIssue:
+    def __init__(self, number, title, state="open", updated_at=None):
+        self.number = number
+        self.title = title
+        self.state = state
+        self.updated_at = updated_at or datetime.datetime.now(
+            datetime.timezone.utc
+        )
+        self.labels = []
+        self.calls = []
+
+    def create_comment(self, body):
+        self.calls.append(("create_comment", body))
+
+    def set_labels(self, *labels):
+        self.calls.append(("set_labels", labels))
+        self.labels = [types.SimpleNamespace(name=label) for label in labels]
+
+
+class FakeRepository:
+    def __init__(self, issues):
+        self.issues = {i.number: i for i in issues}
+        self.calls = []
+
+    def get_issues(self, state="open", **kwargs):
+        self.calls.append(("get_issues", state, kwargs))
+        return [i for i in self.issues.values() if state in ("all", i.state)]
+
+    def get_issue(self, number):
+        self.calls.append(("get_issue", number))
+        return self.issues[number]
+
+    def create_issue(self, title, body):
+        self.calls.append(("create_issue", title))
+        issue = FakeIssue(max(self.issues, default=0) + 1, title)
+        self.issues[issue.number] = issue
+        return issue
+
+
+def make_unit_notify_cli(tmpdir, state_dir):
+    notify_issues = sys.modules["githubbuilder.notify_issues"]
+    return notify_issues.NotifyIssueCli(
+        token="",
+        release_name="r4.2",
+        source_dir=Path(str(tmpdir)),
+        message_templates_dir=PROJECT_PATH / "templates",
+        github_report_repo_name="QubesOS/updates-status",
+        min_age_days=5,
+        state_dir=Path(str(state_dir)),
+    )
+
+
+def test_notify_issue_index(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    title = "app-linux-split-gpg v2.0.60 (r4.2)"
+    repo = FakeRepository(
+        [FakeIssue(n, f"component-{n} v1.0.{n} (r4.2)") for n in range(1, 50)]
+        + [FakeIssue(50, title)]
+    )
+    state_dir = tmpdir / "github-notify-state-index"
+    notify_cli = make_unit_notify_cli(tmpdir, state_dir)
+    monkeypatch.setattr(notify_cli.gi, "get_repo", lambda name: repo)
+
+    # first lookup builds the index from open issues
+    assert (
+        notify_cli.search_or_create_issue(
+            "r4.2", "app-linux-split-gpg", "v2.0.60"
+        )
+        == 50
+    )
+
+    # persisted index: a new instance hits without listing issues
+    repo.calls.clear()
+    notify_cli = make_unit_notify_cli(tmpdir, state_dir)
+    monkeypatch.setattr(notify_cli.gi, "get_repo", lambda name: repo)
+    assert (
+        notify_cli.search_or_create_issue(
+            "r4.2", "app-linux-split-gpg", "v2.0.60"
+        )
+        == 50
+    )
+    assert repo.calls == [("get_issue", 50)]
+
+    # closed issue is invalidated and a new one is created
+    repo.issues[50].state = "closed"
+    issue_no = notify_cli.search_or_create_issue(
+        "r4.2", "app-linux-split-gpg", "v2.0.60"
+    )
+    assert issue_no == 51
+    assert (
+        notify_cli.get_issue_index("QubesOS/updates-status").get(title) == 51
+    )
+
+
+def test_notify_comment_issue_labels_batched(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    issue = FakeIssue(1, "app-linux-split-gpg v2.0.60 (r4.2)")
+    issue.labels = [
+        types.SimpleNamespace(name=label)
+        for label in ("r4.2-vm-bookworm-building", "r4.2-host-failed")
+    ]
+    repo = FakeRepository([issue])
+    notify_cli = make_unit_notify_cli(tmpdir, tmpdir / "github-notify-state")
+    monkeypatch.setattr(notify_cli.gi, "get_repo", lambda name: repo)
+
+    notify_cli.comment_issue(
+        1,
+        None,
+        add_labels=["r4.2-vm-bookworm-cur-test"],
+        delete_labels=[
+            "r4.2-vm-bookworm-failed",
+            "r4.2-vm-bookworm-building",
+        ],
+    )
+    assert issue.calls == [
+        (
+            "set_labels",
+            ("r4.2-host-failed", "r4.2-vm-bookworm-cur-test"),
+        )
+    ]
+
+    # labels already match: no request at all
+    issue.calls.clear()
+    notify_cli.comment_issue(
+        1,
+        None,
+        add_labels=["r4.2-vm-bookworm-cur-test"],
+        delete_labels=["r4.2-vm-bookworm-building"],
+    )
+    assert not issue.calls
+
+
+def test_notify_queue_coalesce_and_retry(workdir, monkeypatch):
+    tmpdir, env = workdir
+    load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    notify_queue = sys.modules["githubbuilder.notify_queue"]
+
+    processed = []
+    failures = {"host-fc41:uploaded": 1}
+
+    def handler(payload):
+        name = f"{payload['target']}:{payload['status']}"
+        if failures.get(name):
+            failures[name] -= 1
+            raise ValueError("temporary failure")
+        processed.append(name)
+
+    queue_dir = tmpdir / "notify-queue-unit"
+    shutil.rmtree(queue_dir, ignore_errors=True)
+    queue = notify_queue.NotifyQueue(queue_dir, handler, backoff=0.1)
+    # don't let the background thread run before everything is queued
+    queue.start = lambda: None
+    for target in ("host-fc41", "vm-bookworm"):
+        for status in ("building", "built", "building", "uploaded"):
+            queue.put(
+                key=target,
+                status=status,
+                payload={"target": target, "status": status},
+            )
+    # pending 'building' entries are superseded
+    assert queue.pending() == 4
+    del queue.start
+
+    queue.join(timeout=30)
+    assert queue.pending() == 0
+    for target in ("host-fc41", "vm-bookworm"):
+        assert [p for p in processed if p.startswith(target)] == [
+            f"{target}:built",
+            f"{target}:uploaded",
+        ]
+    assert not (queue_dir / "failed").exists()
+
+    # entries of other processes sharing the queue are not waited for
+    failures["vm-trixie:built"] = 5
+    other = notify_queue.NotifyQueue(queue_dir, handler, backoff=60)
+    other.start = lambda: None
+    other.put(
+        key="vm-trixie",
+        status="built",
+        payload={"target": "vm-trixie", "status": "built"},
+    )
+    queue = notify_queue.NotifyQueue(queue_dir, handler, backoff=60)
+    queue.put(
+        key="host-fc42",
+        status="built",
+        payload={"target": "host-fc42", "status": "built"},
+    )
+    start = time.monotonic()
+    queue.join(timeout=30)
+    assert time.monotonic() - start < 10
+    assert "host-fc42:built" in processed
+    assert queue.queued_pending() == 0
+    assert queue.pending() == 1
+
+
+def test_notify_queued_upload_state_and_retry(workdir, monkeypatch):
+    tmpdir, env = workdir
+    mod = load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    notify_issues = sys.modules["githubbuilder.notify_issues"]
+    git_metadata = sys.modules["githubbuilder.git_metadata"]
+    config = make_config(tmpdir / "builder.yml")
+    components = config.get_components(["app-linux-split-gpg"], url_match=True)
+    dist = config.get_distributions()[0]
+
+    action = mod.AutoAction(
+        builder_dir=tmpdir / "qubes-builderv2",
+        config=config,
+        component=components[0],
+        distributions=[dist],
+        state_dir=tmpdir / "github-notify-state-queued",
+        commit_sha=None,
+        repository_publish="current-testing",
+        local_log_file=None,
+        dry_run=False,
+    )
+    queued = []
+    action.notify_queue = types.SimpleNamespace(
+        put=lambda key, status, payload: queued.append(payload)
+    )
+    notify_cli = action.notify_cli
+    monkeypatch.setattr(notify_cli, "get_current_commit", lambda: "c2")
+    state_file = action.state_dir / "state-current-testing"
+    state_file.write_text("c1", encoding="utf-8")
+
+    # the state is updated when queued, not when the notification is sent
+    action.queue_notification(
+        {
+            "command": "upload",
+            "dist": dist,
+            "build_status": "uploaded",
+            "state_file": state_file,
+        },
+        "app-linux-split-gpg:" + str(dist),
+    )
+    assert state_file.read_text(encoding="utf-8") == "c2"
+    kwargs = queued[0]["kwargs"]
+    assert kwargs["previous_commit"] == "c1"
+    assert kwargs["state_file"] is None
+
+    monkeypatch.setattr(
+        notify_cli.git,
+        "log",
+        lambda start, end: [
+            git_metadata.GitLogEntry(
+                "c2", "c2", "fix", "Fixes QubesOS/qubes-issues#1"
+            ),
+            git_metadata.GitLogEntry(
+                "c3", "c3", "fix", "Fixes QubesOS/qubes-issues#2"
+            ),
+        ],
+    )
+    monkeypatch.setattr(notify_cli.git, "shortlog", lambda *args: "")
+    comments = []
+    failures = {2: 1}
+
+    def comment_issue(issue_no, message, add_labels, delete_labels, **kw):
+        comments.append(issue_no)
+        if failures.get(issue_no):
+            failures[issue_no] -= 1
+            raise notify_issues.NotifyIssueError("temporary failure")
+
+    monkeypatch.setattr(notify_cli, "comment_issue", comment_issue)
+
+    # a retry doesn't comment again issues commented before the failure
+    commented_issues = []
+    for _ in range(2):
+        try:
+            notify_cli.notify_closed_issues(
+                dist,
+                "app-linux-split-gpg",
+                "current-testing",
+                "c2",
+                "c1",
+                [],
+                [],
+                commented_issues=commented_issues,
+            )
+        except notify_issues.NotifyIssueError:
+            pass
+    assert comments == [1, 2, 2]
+    assert commented_issues == [1, 2]
+
+
+def test_action_daemon(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    daemon_mod = load_module(
+        "githubbuilder.daemon", PROJECT_PATH / "githubbuilder/daemon.py"
+    )
+    builder_dir = Path(str(tmpdir)) / "daemon-builder"
+    builder_dir.mkdir(exist_ok=True)
+
+    ran = []
+    oneshot = []
+
+    def run_action(argv):
+        ran.append(argv)
+        if argv[0] == "fail":
+            raise ValueError("action failed")
+
+    daemon = daemon_mod.ActionDaemon(builder_dir, run_action)
+    daemon.run_oneshot = oneshot.append
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    for _ in range(50):
+        if daemon.socket_path.exists():
+            break
+        time.sleep(0.1)
+
+    reply = daemon_mod.request_action(builder_dir, ["build-component", "a"])
+    assert reply == {"status": "queued"}
+    reply = daemon_mod.request_action(builder_dir, ["fail"], wait=True)
+    assert reply["status"] == "failed"
+    reply = daemon_mod.request_action(builder_dir, ["upload", "b"], wait=True)
+    assert reply == {"status": "done"}
+    assert ran == [["build-component", "a"], ["fail"], ["upload", "b"]]
+
+    # sources have been updated: run with the one-shot command and exit
+    daemon.heads = ("outdated", "outdated")
+    reply = daemon_mod.request_action(builder_dir, ["upload", "c"], wait=True)
+    assert reply == {"status": "done"}
+    assert oneshot == [["upload", "c"]]
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert not daemon.socket_path.exists()
+    # without daemon, the caller falls back to the one-shot command
+    assert daemon_mod.request_action(builder_dir, ["upload", "d"]) is None
+
+
+def test_config_cache_included_files(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    daemon_mod = load_module(
+        "githubbuilder.daemon", PROJECT_PATH / "githubbuilder/daemon.py"
+    )
+    conf_dir = Path(str(tmpdir)) / "config-cache"
+    (conf_dir / "configs").mkdir(parents=True, exist_ok=True)
+    conf_file = conf_dir / "builder.yml"
+    conf_file.write_text("include:\n  - configs/base.yml\n")
+    base_file = conf_dir / "configs" / "base.yml"
+    base_file.write_text("include:\n  - common.yml\n")
+    common_file = conf_dir / "configs" / "common.yml"
+    common_file.write_text("verbose: false\n")
+
+    loaded = []
+
+    def loader(path):
+        loaded.append(path)
+        return {"verbose": common_file.read_text()}
+
+    configs = daemon_mod.ConfigCache(loader)
+    assert configs.loaded_files(conf_file) == [
+        conf_file,
+        base_file,
+        common_file,
+    ]
+    assert configs.get(conf_file) == {"verbose": "verbose: false\n"}
+    assert configs.get(conf_file) == {"verbose": "verbose: false\n"}
+    assert len(loaded) == 1
+
+    # a file included by an included file is modified
+    common_file.write_text("verbose: true\n")
+    os.utime(common_file, ns=(10**18, 10**18))
+    assert configs.get(conf_file) == {"verbose": "verbose: true\n"}
+    assert len(loaded) == 2
+
+    # an included file is removed
+    base_file.unlink()
+    configs.get(conf_file)
+    assert len(loaded) == 3
+    configs.get(conf_file)
+    assert len(loaded) == 3
+
+
+def test_job_queue_priorities(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    monkeypatch.syspath_prepend(str(PROJECT_PATH))
+    job_queue_mod = load_module(
+        "githubbuilder.job_queue", PROJECT_PATH / "githubbuilder/job_queue.py"
+    )
+    daemon_mod = load_module(
+        "githubbuilder.daemon", PROJECT_PATH / "githubbuilder/daemon.py"
+    )
+    builder_dir = Path(str(tmpdir)) / "queue-builder"
+    shutil.rmtree(builder_dir, ignore_errors=True)
+    builder_dir.mkdir()
+    job_queue = job_queue_mod.JobQueue(builder_dir)
+
+    jobs = [
+        ["build-iso", "r4.3"],
+        ["build-component", "b", "core-qrexec"],
+        ["build-template", "b", "fedora-42"],
+        ["upload-component", "b", "core-qrexec", "1", "current"],
+        ["build-component", "b", "core-qubesdb"],
+    ]
+    job_ids = [
+        job_queue.put(argv, wait=argv[0] == "build-iso") for argv in jobs
+    ]
+    expected = [jobs[3], jobs[1], jobs[4], jobs[0], jobs[2]]
+    assert [job["argv"] for job in job_queue.pending()] == expected
+
+    ran = []
+
+    def run(argv):
+        # only one worker at a time
+        assert not job_queue.drain(run)
+        ran.append(argv)
+        if argv[0] == "build-iso":
+            raise ValueError("ISO build failed")
+
+    assert job_queue.drain(run)
+    assert ran == expected
+    assert job_queue.pending() == []
+    assert job_queue.wait_result(job_ids[0]) == {
+        "status": "failed",
+        "error": "ISO build failed",
+    }
+
+    # jobs waited for are run by a worker, started if none is running
+    job_id = job_queue.put(jobs[3], wait=True)
+    workers = []
+
+    def start_worker():
+        worker = threading.Thread(target=job_queue.drain, args=(run,))
+        workers.append(worker)
+        worker.start()
+
+    assert job_queue.wait_result(
+        job_id, start_worker=start_worker, poll_interval=0.1
+    ) == {"status": "done"}
+    assert workers and ran[-1] == jobs[3]
+    for worker in workers:
+        worker.join()
+
+    # the daemon runs its jobs in the same order
+    daemon_jobs = sorted(daemon_mod.ActionJob(argv) for argv in jobs)
+    assert [job.argv for job in daemon_jobs] == expected
+
+
+def test_job_queue_supersede(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    job_queue_mod = load_module(
+        "githubbuilder.job_queue", PROJECT_PATH / "githubbuilder/job_queue.py"
+    )
+    builder_dir = Path(str(tmpdir)) / "supersede-builder"
+    shutil.rmtree(builder_dir, ignore_errors=True)
+    builder_dir.mkdir()
+    job_queue = job_queue_mod.JobQueue(builder_dir)
+
+    def build(component):
+        return ["--signer-fpr", "ABCD", "build-component", "b", "c", component]
+
+    before = time.time_ns()
+    first = job_queue.put(build("core-qrexec"), wait=True)
+    job_queue.put(build("core-qubesdb"))
+    job_queue.put(
+        ["upload-component", "b", "c", "core-qrexec", "1", "current"]
+    )
+    assert (
+        job_queue_mod.superseded_markers(builder_dir)["core-qrexec"] > before
+    )
+    job_queue.put(build("core-qrexec"))
+
+    # the newer build replaces the queued one, uploads are kept
+    assert [job["argv"] for job in job_queue.pending()] == [
+        ["upload-component", "b", "c", "core-qrexec", "1", "current"],
+        build("core-qubesdb"),
+        build("core-qrexec"),
+    ]
+    assert job_queue.wait_result(first) == {"status": "superseded"}
+
+
+def test_dispatch_parallel_builders(workdir, monkeypatch):
+    tmpdir, _env = workdir
+    monkeypatch.syspath_prepend(str(PROJECT_PATH))
+    mod = load_module("github_command", PROJECT_PATH / "github-command.py")
+    workdir_path = Path(str(tmpdir)) / "dispatch"
+    builders = []
+    for release, name in (("r4.2", "b1"), ("r4.2", "b2"), ("r4.3", "b3")):
+        (workdir_path / name).mkdir(parents=True, exist_ok=True)
+        builders.append(f"{release}={workdir_path / name}=builder.yml")
+    (workdir_path / "builders.list").write_text("\n".join(builders) + "\n")
+    (workdir_path / "command").write_text("Upload-component r4.2 a 1 c d\n")
+
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def run_command(cmd, env=None, wait=False, ignore_exit_codes=(0,)):
+        if "worker" in cmd:
+            worker_args = mod.build_parser().parse_args(cmd[1:])
+            worker_args.func(worker_args)
+            return
+        with lock:
+            running.append(cmd)
+            max_running.append(len(running))
+        time.sleep(0.5)
+        with lock:
+            running.remove(cmd)
+        if "bash" in cmd and "/b2 " in cmd[-1]:
+            raise mod.GithubCommandError("Failed to run command: b2")
+
+    monkeypatch.setattr(mod, "run_command", run_command)
+    args = mod.build_parser().parse_args(
+        [
+            "dispatch",
+            "--wait",
+            "--no-daemon",
+            "--no-builders-update",
+            "--scripts-dir",
+            str(workdir_path),
+            "--config-file",
+            str(workdir_path / "builders.list"),
+            "Upload-component",
+            str(workdir_path / "command"),
+        ]
+    )
+    start = time.monotonic()
+    with pytest.raises(mod.GithubCommandError, match="1/2 builders.*b2"):
+        args.func(args)
+    # both r4.2 builders ran at the same time, b3 was not selected
+    assert time.monotonic() - start < 0.9
+    assert max(max_running) == 2
+
+
+def test_action_upload_batch_window(workdir, monkeypatch):
+    tmpdir, env = workdir
+    action_mod = load_action_module(
+        env, tmpdir / "qubes-builder-github", monkeypatch
+    )
+    mod = load_module("github_command", PROJECT_PATH / "github-command.py")
+    builder_dir = Path(str(tmpdir)) / "upload-batch-builder"
+    builder_dir.mkdir(exist_ok=True)
+
+    def argv(component, repository):
+        return [
+            "--signer-fpr",
+            "ABCD",
+            "upload-component",
+            str(builder_dir),
+            "builder.yml",
+            component,
+            "0123456789",
+            repository,
+            "--distribution",
+            "all",
+        ]
+
+    requests = {
+        "core-qrexec": argv("core-qrexec", "current"),
+        "core-qubesdb": argv("core-qubesdb", "current"),
+        "app-linux-split-gpg": argv("app-linux-split-gpg", "security-testing"),
+    }
+    start = time.monotonic()
+    for request in requests.values():
+        mod._add_upload_request(builder_dir, request)
+
+    batched = []
+    uploaded = []
+
+    class FakeAction:
+        def __init__(self, name):
+            self.name = name
+
+        def upload(self):
+            uploaded.append(self.name)
+
+        def wait_notifications(self):
+            pass
+
+    monkeypatch.setattr(
+        mod,
+        "_get_actions",
+        lambda args, config, context: [FakeAction(args.component_name)],
+    )
+    monkeypatch.setattr(
+        action_mod,
+        "upload_components",
+        lambda actions: batched.append([a.name for a in actions]) or actions,
+    )
+    config = {"github": {"upload-batch-window": 0.5}}
+    parser = mod.build_parser()
+    for request in requests.values():
+        mod._run_action(
+            parser.parse_args(["action", *request]),
+            config=config,
+            context=object(),
+        )
+    assert time.monotonic() - start >= 0.5
+    # commands for the same repository are uploaded by the first one
+    assert batched == [["core-qrexec", "core-qubesdb"]]
+    assert uploaded == ["app-linux-split-gpg"]
+    assert not [
+        p for p in (builder_dir / ".upload-batch").rglob("*") if p.is_file()
+    ]
+
+    # commands of a batch failing to upload are uploaded by their own action
+    batched.clear()
+    uploaded.clear()
+    for name in ("core-qrexec", "core-qubesdb"):
+        mod._add_upload_request(builder_dir, requests[name])
+
+    def failing_upload_components(actions):
+        batched.append([a.name for a in actions])
+        raise action_mod.AutoActionTimeout("Timeout reached for upload!")
+
+    monkeypatch.setattr(
+        action_mod, "upload_components", failing_upload_components
+    )
+    with pytest.raises(action_mod.AutoActionTimeout):
+        mod._run_action(
+            parser.parse_args(["action", *requests["core-qrexec"]]),
+            config=config,
+            context=object(),
+        )
+    mod._run_action(
+        parser.parse_args(["action", *requests["core-qubesdb"]]),
+        config=config,
+        context=object(),
+    )
+    assert batched == [["core-qrexec", "core-qubesdb"]]
+    assert uploaded == ["core-qubesdb"]
+
+    # failures reported without exception are left pending too
+    batched.clear()
+    uploaded.clear()
+    for name in ("core-qrexec", "core-qubesdb"):
+        mod._add_upload_request(builder_dir, requests[name])
+
+    def partial_upload_components(actions):
+        batched.append([a.name for a in actions])
+        return [a for a in actions if a.name != "core-qubesdb"]
+
+    monkeypatch.setattr(
+        action_mod, "upload_components", partial_upload_components
+    )
+    for name in ("core-qrexec", "core-qubesdb"):
+        mod._run_action(
+            parser.parse_args(["action", *requests[name]]),
+            config=config,
+            context=object(),
+        )
+    assert batched == [["core-qrexec", "core-qubesdb"]]
+    assert uploaded == ["core-qubesdb"]
+
+
+def test_action_context_shared(workdir, monkeypatch):
+    tmpdir, env = workdir
+    load_action_module(env, tmpdir / "qubes-builder-github", monkeypatch)
+    context = sys.modules["githubbuilder.context"].ActionContext()
+
+    notify_clis = [
+        sys.modules["githubbuilder.notify_issues"].NotifyIssueCli(
+            token="",
+            release_name="r4.2",
+            source_dir=Path(str(tmpdir)) / name,
+            message_templates_dir=PROJECT_PATH / "templates",
+            github_report_repo_name="QubesOS/updates-status",
+            min_age_days=5,
+            context=context,
+        )
+        for name in ("core-qrexec", "core-qubesdb")
+    ]
+    assert notify_clis[0].gi is notify_clis[1].gi
+    assert context.get_plugin_manager([]) is context.get_plugin_manager([])
+
+    repo = FakeRepository([])
+    get_repo_calls = []
+    monkeypatch.setattr(
+        notify_clis[0].gi,
+        "get_repo",
+        lambda name: get_repo_calls.append(name) or repo,
+    )
+    for notify_cli in notify_clis:
+        assert (
+            notify_cli.context.get_github_repo("", "QubesOS/updates-status")
+            is repo
+        )
+    assert get_repo_calls == ["QubesOS/updates-status"]
+
+    template = Path(str(tmpdir)) / "message-unit-template"
+    template.write_text("first")
+    assert context.read_message_template(template) == "first"
+    template.write_text("second")
+    os.utime(template, ns=(0, time.time_ns() + 10**9))
+    assert context.read_message_template(template) == "second"
+    assert context.read_message_template(template.with_name("none")) is None
+
+
+def make_unit_git_repo(path, commits):
+    """
+    Create a git repository with (message, tag) commits.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "unit",
+        "GIT_AUTHOR_EMAIL": "unit@localhost",
+        "GIT_COMMITTER_NAME": "unit",
+        "GIT_COMMITTER_EMAIL": "unit@localhost",
+    }
+    subprocess.run(["git", "init", "-q", str(path)], check=True, env=env)
+    for message, tag in commits:
+        subprocess.run(
+            ["git", "-C", str(path), "commit", "-q"]
+            + ["--allow-empty", "-m", message],
+            check=True,
+            env=env,
+        )
+        if tag:
+            subprocess.run(
+                ["git", "-C", str(path), "tag", "-a", "-m", tag, tag],
+                check=True,
+                env=env,
+            )
+    return path
+
+
+class CountingGitRepoView:
+    def __init__(self, repo):
+        self.repo = repo
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.repo, name)
+
+        def wrapper(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+
+        return wrapper
+
+
+@pytest.mark.parametrize(
+    "backend", ["SubprocessGitRepoView", "Pygit2GitRepoView"]
+)
+def test_notify_package_changes_cached(workdir, backend):
+    tmpdir, _env = workdir
+    git_metadata = sys.modules["githubbuilder.git_metadata"]
+    if backend == "Pygit2GitRepoView":
+        pytest.importorskip("pygit2")
+    source_dir = make_unit_git_repo(
+        Path(str(tmpdir)) / "unit-sources" / "core-qrexec",
+        [
+            ("Initial commit", "v1.0.0"),
+            ("Fix qrexec\n\nFixes QubesOS/qubes-issues#1234", None),
+            ("Update version", "v1.0.1"),
+        ],
+    )
+    state_dir = Path(str(tmpdir)) / "unit-git-state"
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+    def make_notify_cli():
+        notify_cli = make_unit_notify_cli(source_dir, state_dir)
+        repo = getattr(git_metadata, backend)(source_dir)
+        notify_cli.git._repo = CountingGitRepoView(repo)
+        return notify_cli, notify_cli.git._repo.calls
+
+    notify_cli, git_calls = make_notify_cli()
+    current_commit = notify_cli.get_current_commit()
+    git_url = "https://github.com/QubesOS/qubes-core-qrexec"
+    changes = notify_cli.get_package_changes(git_url, current_commit)
+    version, previous_version, shortlog, issues = changes
+    assert (version, previous_version) == ("v1.0.1", "v1.0.0")
+    assert [line.split(" ", 1)[1] for line in shortlog.splitlines()] == [
+        "Update version",
+        "Fix qrexec",
+    ]
+    assert shortlog.startswith("QubesOS/qubes-core-qrexec@")
+    assert issues == "QubesOS/qubes-issues#1234"
+    assert git_calls.count("log") == 1
+
+    # every other notification of the same commit reuses it
+    git_calls.clear()
+    for _ in range(3):
+        assert (
+            notify_cli.get_package_changes(git_url, current_commit) == changes
+        )
+    assert git_calls == []
+
+    # range log is kept in state_dir for next runs
+    notify_cli, git_calls = make_notify_cli()
+    assert notify_cli.get_package_changes(git_url, current_commit) == changes
+    assert "log" not in git_calls
@@ -0,0 +1,475 @@
+import concurrent.futures
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+PROJECT_PATH = Path(__file__).resolve().parents[1]
+WEBHOOKS_PATH = PROJECT_PATH / "webhooks"
+
+
+@pytest.fixture
+def webhooks_path(monkeypatch):
+    monkeypatch.syspath_prepend(str(WEBHOOKS_PATH))
+    return WEBHOOKS_PATH
+
+
+def dead_pid():
+    p = subprocess.Popen(["true"])
+    p.wait()
+    return p.pid
+
+
+def test_spool_dedup(tmp_path, webhooks_path):
+    import spool
+
+    deliveries = spool.DeliverySpool(str(tmp_path / "spool.db"))
+    assert deliveries.add("trigger_build:1", "trigger_build", "push", b"{}")
+    # sent again by GitHub
+    assert not deliveries.add(
+        "trigger_build:1", "trigger_build", "push", b"{}"
+    )
+    assert deliveries.add("trigger_build:2", "trigger_build", "push", b"{}")
+    assert deliveries.counts() == {"pending": 2}
+
+    # processed deliveries are still known
+    delivery_id = deliveries.claim()[0]
+    deliveries.complete(delivery_id)
+    assert not deliveries.add(delivery_id, "trigger_build", "push", b"{}")
+    assert deliveries.counts() == {"pending": 1, "done": 1}
+
+
+def test_spool_retry(tmp_path, webhooks_path):
+    import spool
+
+    deliveries = spool.DeliverySpool(
+        str(tmp_path / "spool.db"), max_attempts=3, backoff=0
+    )
+    deliveries.add("trigger_build:1", "trigger_build", "push", b"{}")
+    calls = []
+
+    def handler(service, event, payload):
+        calls.append((service, event, payload))
+        raise OSError("build VM not available")
+
+    workers = spool.SpoolWorkers(deliveries, handler)
+    for _ in range(2):
+        assert workers.process_one()
+        assert deliveries.counts() == {"pending": 1}
+    # given up after max_attempts
+    assert workers.process_one()
+    assert deliveries.counts() == {"failed": 1}
+    assert not workers.process_one()
+    assert calls == [("trigger_build", "push", b"{}")] * 3
+
+
+def test_spool_retry_backoff(tmp_path, webhooks_path):
+    import spool
+
+    deliveries = spool.DeliverySpool(str(tmp_path / "spool.db"), backoff=60)
+    deliveries.add("trigger_build:1", "trigger_build", "push", b"{}")
+    delivery_id = deliveries.claim()[0]
+    deliveries.fail(delivery_id, "OSError: build VM not available")
+    # not ready before the backoff delay
+    assert deliveries.claim() is None
+    assert deliveries.counts() == {"pending": 1}
+
+
+def test_spool_recover(tmp_path, webhooks_path):
+    import spool
+
+    deliveries = spool.DeliverySpool(str(tmp_path / "spool.db"))
+    deliveries.add("trigger_build:1", "trigger_build", "push", b"{}")
+    deliveries.add("trigger_build:2", "trigger_build", "push", b"{}")
+    first = deliveries.claim()[0]
+    second = deliveries.claim()[0]
+    assert deliveries.claim() is None
+
+    # the first one was claimed by a process which died
+    with deliveries.transaction() as conn:
+        conn.execute(
+            "UPDATE deliveries SET worker_pid = ? WHERE delivery_id = ?",
+            (dead_pid(), first),
+        )
+    deliveries.recover()
+    assert deliveries.claim()[0] == first
+    assert deliveries.counts() == {"processing": 2}
+
+    # still processed by this one
+    deliveries.recover()
+    assert deliveries.claim() is None
+    deliveries.complete(first)
+    deliveries.complete(second)
+    assert deliveries.counts() == {"done": 2}
+
+
+def test_webhooks_app(tmp_path, webhooks_path, monkeypatch):
+    pytest.importorskip("flask")
+    import spool
+
+    conf = tmp_path / "webhooks.conf"
+    conf.write_text(
+        json.dumps(
+            {
+                "services": ["process_comment"],
+                "spool": str(tmp_path / "spool.db"),
+                "webhook_secret": "secret",
+            }
+        )
+    )
+    monkeypatch.setenv("WEBHOOKS_CONFIG", str(conf))
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    # left by a previous run
+    deliveries = spool.DeliverySpool(str(tmp_path / "spool.db"))
+    deliveries.add(
+        "process_comment:1",
+        "process_comment",
+        "issue_comment",
+        json.dumps({"action": "deleted"}).encode(),
+    )
+
+    monkeypatch.delitem(sys.modules, "webhooks", raising=False)
+    import webhooks
+
+    # processed once the application is loaded, without a new delivery
+    deadline = time.monotonic() + 10
+    while deliveries.counts() != {"done": 1} and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert deliveries.counts() == {"done": 1}
+
+    client = webhooks.app.test_client()
+    assert client.get("/api/stats").status_code == 403
+    assert (
+        client.get(
+            "/api/stats", headers={"X-Webhooks-Token": "wrong"}
+        ).status_code
+        == 403
+    )
+    response = client.get("/api/stats", headers={"X-Webhooks-Token": "secret"})
+    assert response.status_code == 200
+    assert response.get_json()["deliveries"] == {"done": 1}
+
+
+@pytest.fixture
+def qrexec_stub(tmp_path, monkeypatch):
+    """qrexec-client-vm recording calls in tmp_path/calls/VM."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    stub = bin_dir / "qrexec-client-vm"
+    stub.write_text(
+        "#!/bin/sh\n"
+        'case "$2" in\n'
+        "    slow*) sleep 0.5;;\n"
+        "    hang) exec sleep 30;;\n"
+        "    broken) exit 1;;\n"
+        "esac\n"
+        f'cat > "{tmp_path}/calls/$2"\n'
+    )
+    stub.chmod(0o755)
+    (tmp_path / "calls").mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    return tmp_path / "calls"
+
+
+def test_fanout_concurrent(qrexec_stub, webhooks_path):
+    from services import fanout
+
+    vms = [f"slow-{i}" for i in range(4)]
+    start = time.monotonic()
+    futures = fanout.fan_out(
+        vms, fanout.qrexec, "qubesbuilder.TriggerBuild+core-qrexec"
+    )
+    for future in futures:
+        future.result()
+    # called at the same time
+    assert time.monotonic() - start < 1.5
+    assert sorted(p.name for p in qrexec_stub.iterdir()) == vms
+
+
+def test_fanout_errors(qrexec_stub, webhooks_path):
+    from services import fanout
+
+    def call(vm, service):
+        fanout.qrexec(vm, service, b"input", timeout=0.5)
+
+    start = time.monotonic()
+    ok, broken, hang = fanout.fan_out(
+        ["ok", "broken", "hang"], call, "qubesbuilder.ProcessGithubCommand"
+    )
+    ok.result()
+    assert (qrexec_stub / "ok").read_bytes() == b"input"
+    with pytest.raises(subprocess.CalledProcessError):
+        broken.result()
+    # killed after the timeout
+    with pytest.raises(subprocess.TimeoutExpired):
+        hang.result()
+    assert time.monotonic() - start < 10
+
+
+def test_build_vm_list_reload(tmp_path, webhooks_path):
+    from services.build_vms import BuildVMList
+
+    path = tmp_path / "build-vms.list"
+    path.write_text("build-r4.2\n")
+    os.utime(path, ns=(10**18, 10**18))
+    build_vms = BuildVMList(str(path))
+    assert build_vms.get() == ["build-r4.2"]
+
+    # not read again while not modified
+    path.write_text("build-r4.2\nbuild-r4.3\n")
+    os.utime(path, ns=(10**18, 10**18))
+    assert build_vms.get() == ["build-r4.2"]
+
+    os.utime(path, ns=(10**18 + 1, 10**18 + 1))
+    assert build_vms.get() == ["build-r4.2", "build-r4.3"]
+
+    path.unlink()
+    with pytest.raises(OSError):
+        build_vms.get()
+
+
+def test_webhooks_service_not_imported(tmp_path, webhooks_path, monkeypatch):
+    pytest.importorskip("flask")
+
+    conf = tmp_path / "webhooks.conf"
+    conf.write_text(
+        json.dumps(
+            {
+                "services": ["process_comment", "no_such_service"],
+                "spool": str(tmp_path / "spool.db"),
+            }
+        )
+    )
+    monkeypatch.setenv("WEBHOOKS_CONFIG", str(conf))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delitem(sys.modules, "webhooks", raising=False)
+    import webhooks
+
+    # the application is loaded anyway, with the other services
+    assert list(webhooks.service_registry) == ["process_comment"]
+    client = webhooks.app.test_client()
+    response = client.post(
+        "/api/services/no_such_service",
+        data=json.dumps({"repository": {}}),
+        headers={"X-GitHub-Event": "push"},
+    )
+    assert response.status_code == 500
+    assert response.get_json()["message"] == "Cannot import service"
+    # services not configured are still unknown
+    response = client.post(
+        "/api/services/trigger_build",
+        data=json.dumps({"repository": {}}),
+        headers={"X-GitHub-Event": "push"},
+    )
+    assert response.status_code == 404
+
+
+def test_trigger_build_debounce_opt_in(tmp_path, webhooks_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    from services import trigger_build
+
+    spool_path = str(tmp_path / "spool.db")
+    service = trigger_build.Service({"spool": spool_path})
+    assert service.debouncer is None
+    assert service.stats() == {}
+
+    monkeypatch.setattr(trigger_build.Debouncer, "start", lambda self: None)
+    service = trigger_build.Service(
+        {"spool": spool_path, "trigger_build_debounce": 10}
+    )
+    assert service.debouncer is not None
+    assert service.debouncer.window == 10
+
+
+def make_future(exc=None):
+    future = concurrent.futures.Future()
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(None)
+    return future
+
+
+@pytest.fixture
+def debounce(webhooks_path, monkeypatch):
+    from services import debounce
+
+    # triggers are sent by the test itself
+    monkeypatch.setattr(debounce.Debouncer, "start", lambda self: None)
+    return debounce
+
+
+def make_due(debouncer):
+    with debouncer.transaction() as conn:
+        conn.execute("UPDATE debounced_triggers SET due = 0")
+
+
+def test_debounce_coalesce(tmp_path, debounce):
+    sent = []
+    debouncer = debounce.Debouncer(
+        str(tmp_path / "spool.db"),
+        60,
+        lambda key: sent.append(key) or [make_future()],
+    )
+    assert debouncer.trigger("core-qrexec")
+    assert not debouncer.trigger("core-qrexec")
+    assert debouncer.trigger("core-admin")
+    # not before the end of the window
+    assert debouncer.send_due() == 0
+    make_due(debouncer)
+    assert debouncer.send_due() == 2
+    assert sorted(sent) == ["core-admin", "core-qrexec"]
+    stats = debouncer.stats()
+    assert stats["pending"] == 0
+    assert (stats["received"], stats["sent"], stats["suppressed"]) == (3, 2, 1)
+
+
+def test_debounce_retry(tmp_path, debounce):
+    failures = {"core-qrexec": 1}
+
+    def send(key):
+        if failures.get(key):
+            failures[key] -= 1
+            return [make_future(OSError("build VM not available"))]
+        return [make_future()]
+
+    debouncer = debounce.Debouncer(str(tmp_path / "spool.db"), 60, send)
+    debouncer.trigger("core-qrexec")
+    make_due(debouncer)
+    # kept until sent
+    assert debouncer.send_due() == 1
+    assert debouncer.stats()["pending"] == 1
+    assert debouncer.send_due() == 0
+    make_due(debouncer)
+    assert debouncer.send_due() == 1
+    assert debouncer.stats()["pending"] == 0
+    assert debouncer.stats()["sent"] == 1
+
+
+def test_debounce_recover(tmp_path, debounce):
+    sent = []
+    debouncer = debounce.Debouncer(
+        str(tmp_path / "spool.db"),
+        60,
+        lambda key: sent.append(key) or [make_future()],
+    )
+    debouncer.trigger("core-qrexec")
+    make_due(debouncer)
+    # claimed by a process which died before sending it
+    assert debouncer.claim_due() == ["core-qrexec"]
+    with debouncer.transaction() as conn:
+        conn.execute(
+            "UPDATE debounced_triggers SET sender_pid = ?", (dead_pid(),)
+        )
+    assert debouncer.send_due() == 0
+
+    restarted = debounce.Debouncer(
+        str(tmp_path / "spool.db"),
+        60,
+        lambda key: sent.append(key) or [make_future()],
+    )
+    restarted.recover()
+    assert restarted.send_due() == 1
+    assert sent == ["core-qrexec"]
+
+
+def test_debounce_retrigger_while_sending(tmp_path, debounce):
+    debouncer = debounce.Debouncer(
+        str(tmp_path / "spool.db"), 60, lambda key: [make_future()]
+    )
+    debouncer.trigger("core-qrexec")
+    make_due(debouncer)
+    assert debouncer.claim_due() == ["core-qrexec"]
+    # the trigger being sent may not see this push
+    assert debouncer.trigger("core-qrexec")
+    assert not debouncer.trigger("core-qrexec")
+    debouncer.complete("core-qrexec")
+    assert debouncer.stats()["pending"] == 1
+    assert debouncer.send_due() == 0
+    make_due(debouncer)
+    assert debouncer.send_due() == 1
+    assert debouncer.stats()["pending"] == 0
+
+
+@pytest.mark.parametrize(
+    "patterns",
+    [
+        ["refs/tags/v*"],
+        ["refs/tags/v*", "refs/heads/main"],
+        ["refs/heads/release?.?"],
+        ["refs/heads/[!w]*"],
+        ["refs/tags/v[0-9]*.*"],
+        ["refs/heads/*"],
+    ],
+)
+def test_event_filter_refs_like_fnmatch(webhooks_path, patterns):
+    from services.event_filter import EventFilter
+
+    event_filter = EventFilter({"refs": patterns})
+    refs = [
+        "refs/tags/v4.2.1",
+        "refs/tags/v",
+        "refs/tags/R4.2",
+        "refs/tags/4.2",
+        "refs/tags/vfoo",
+        "refs/heads/main",
+        "refs/heads/main2",
+        "refs/heads/feature/main",
+        "refs/heads/release4.2",
+        "refs/heads/release4.10",
+        "refs/heads/wip",
+        "refs/heads/",
+        "Refs/Tags/v4.2.1",
+        "refs/tags/v4.2\n",
+        "prefix/refs/tags/v4.2.1",
+    ]
+    for ref in refs:
+        expected = any(fnmatch.fnmatchcase(ref, p) for p in patterns)
+        assert (
+            event_filter.accepts("push", "core-qrexec", ref) is expected
+        ), ref
+
+
+def test_event_filter_rules(webhooks_path):
+    from services.event_filter import EventFilter, payload_ref
+
+    # without rules, any event and ref
+    event_filter = EventFilter()
+    assert event_filter.accepts("push", "core-qrexec", "refs/heads/wip")
+    assert event_filter.accepts("Pipeline Hook", "core-qrexec", None)
+    assert event_filter.accepts("issue_comment", "core-qrexec", None)
+    assert event_filter.accepts("pull_request", "core-qrexec", None)
+    assert event_filter.accepts(None, "core-qrexec", None)
+
+    event_filter = EventFilter(
+        {
+            "events": ["push"],
+            "refs": ["refs/tags/v*"],
+            "components": {
+                "core-qrexec": ["refs/tags/v*", "refs/heads/main"],
+                "linux-kernel": [],
+            },
+        }
+    )
+    assert event_filter.accepts("push", "core-admin", "refs/tags/v4.2.1")
+    assert not event_filter.accepts("push", "core-admin", "refs/heads/main")
+    assert event_filter.accepts("push", "core-qrexec", "refs/heads/main")
+    assert not event_filter.accepts("push", "linux-kernel", "refs/tags/v6.1")
+    assert not event_filter.accepts("Job Hook", "core-admin", "refs/tags/v1")
+    # events without a ref are only filtered by event
+    assert event_filter.accepts("push", "core-admin", None)
+
+    assert payload_ref({"ref": "refs/tags/v1"}) == "refs/tags/v1"
+    assert payload_ref({"ref": "v1", "tag": True}) == "refs/tags/v1"
+    assert payload_ref({"ref": "main", "tag": False}) == "refs/heads/main"
+    assert (
+        payload_ref({"object_attributes": {"ref": "v1", "tag": True}})
+        == "refs/tags/v1"
+    )
+    assert payload_ref({"repository": {}}) is None
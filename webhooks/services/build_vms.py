@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import threading
+
+
+def default_path():
+    return os.path.join(
+        os.environ.get("HOME", "/"),
+        ".config",
+        "qubes-builder-github",
+        "build-vms.list",
+    )
+
+
+class BuildVMList:
+    """
+    Build VMs listed in build-vms.list, read again only when the file is
+    modified.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._vms = []
+
+    def get(self):
+        """Return build VMs, raise OSError if the list cannot be read."""
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.path) as config:
+                    self._vms = config.read().splitlines()
+                self._mtime = mtime
+            return list(self._vms)
+
+
+_lists = {}
+_lists_lock = threading.Lock()
+
+
+def get_build_vm_list(path):
+    """Return the BuildVMList of path, shared by every service."""
+    with _lists_lock:
+        if path not in _lists:
+            _lists[path] = BuildVMList(path)
+        return _lists[path]
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from spool import SQLiteDatabase, pid_alive
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS debounced_triggers (
+    key TEXT PRIMARY KEY,
+    due REAL NOT NULL,
+    coalesced INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sender_pid INTEGER,
+    retrigger INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS trigger_stats (
+    key TEXT PRIMARY KEY,
+    received INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    suppressed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class Debouncer(SQLiteDatabase):
+    """
+    Collapse triggers of the same key received within window seconds into
+    one, sent at the end of the window (so it sees everything pushed
+    meanwhile). Pending triggers are stored in the database, so that every
+    process of the application shares them, and they are removed only once
+    sent: a delivery handed over to the debouncer is not lost on restart.
+    """
+
+    schema = SCHEMA
+
+    def __init__(self, path, window, send, poll_interval=0.5, max_attempts=5):
+        super().__init__(path)
+        self.window = window
+        self.send = send
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            # threads don't survive fork, start it again in a new process
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.recover()
+            threading.Thread(
+                target=self._run, name="debouncer", daemon=True
+            ).start()
+
+    def trigger(self, key):
+        """Schedule a trigger of key. Return False if one is pending."""
+        self.start()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT sender_pid, retrigger FROM debounced_triggers"
+                " WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                pending = False
+                conn.execute(
+                    "INSERT INTO debounced_triggers (key, due) VALUES (?, ?)",
+                    (key, time.time() + self.window),
+                )
+            elif row[0] is not None and not row[1]:
+                # being sent, it may not see this push: send it again after
+                pending = False
+                conn.execute(
+                    "UPDATE debounced_triggers SET retrigger = 1"
+                    " WHERE key = ?",
+                    (key,),
+                )
+            else:
+                pending = True
+                conn.execute(
+                    "UPDATE debounced_triggers SET coalesced = coalesced + 1"
+                    " WHERE key = ?",
+                    (key,),
+                )
+            conn.execute(
+                "INSERT INTO trigger_stats (key, received, suppressed)"
+                " VALUES (?, 1, ?) ON CONFLICT (key) DO UPDATE SET"
+                " received = received + 1,"
+                " suppressed = suppressed + excluded.suppressed",
+                (key, int(pending)),
+            )
+        return not pending
+
+    def recover(self):
+        """Put back triggers claimed by processes not running anymore."""
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT key, sender_pid FROM debounced_triggers"
+                " WHERE sender_pid IS NOT NULL"
+            ).fetchall()
+            for key, sender_pid in rows:
+                if not pid_alive(sender_pid):
+                    conn.execute(
+                        "UPDATE debounced_triggers SET sender_pid = NULL"
+                        " WHERE key = ?",
+                        (key,),
+                    )
+
+    def claim_due(self):
+        """Return keys of triggers to send now, claiming them."""
+        with self.transaction() as conn:
+            keys = [
+                key
+                for (key,) in conn.execute(
+                    "SELECT key FROM debounced_triggers"
+                    " WHERE due <= ? AND sender_pid IS NULL",
+                    (time.time(),),
+                ).fetchall()
+            ]
+            for key in keys:
+                conn.execute(
+                    "UPDATE debounced_triggers SET sender_pid = ?"
+                    " WHERE key = ?",
+                    (os.getpid(), key),
+                )
+        return keys
+
+    def complete(self, key):
+        """Remove a trigger sent, or schedule it again if retriggered."""
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM debounced_triggers WHERE key = ? AND retrigger = 0",
+                (key,),
+            )
+            conn.execute(
+                "UPDATE debounced_triggers SET sender_pid = NULL,"
+                " retrigger = 0, attempts = 0, due = ? WHERE key = ?",
+                (time.time() + self.window, key),
+            )
+            conn.execute(
+                "UPDATE trigger_stats SET sent = sent + 1 WHERE key = ?",
+                (key,),
+            )
+
+    def fail(self, key):
+        """Send a trigger again later, give up after max_attempts."""
+        with self.transaction() as conn:
+            (attempts,) = conn.execute(
+                "SELECT attempts + 1 FROM debounced_triggers WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if attempts >= self.max_attempts:
+                logger.error(
+                    f"{key}: giving up trigger after {attempts} attempts"
+                )
+                conn.execute(
+                    "DELETE FROM debounced_triggers WHERE key = ?", (key,)
+                )
+                return
+            conn.execute(
+                "UPDATE debounced_triggers SET sender_pid = NULL,"
+                " attempts = ?, due = ? WHERE key = ?",
+                (attempts, time.time() + self.window * attempts, key),
+            )
+
+    def send_due(self):
+        """Send triggers due now, return how many were sent."""
+        # calls to build VMs are made concurrently for all keys
+        sent = {}
+        for key in self.claim_due():
+            try:
+                sent[key] = self.send(key) or []
+            except Exception:
+                logger.exception(f"{key}: cannot send trigger")
+                self.fail(key)
+        for key, futures in sent.items():
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                logger.exception(f"{key}: cannot send trigger")
+                self.fail(key)
+            else:
+                self.complete(key)
+        return len(sent)
+
+    def _run(self):
+        while True:
+            try:
+                self.send_due()
+            except sqlite3.Error as e:
+                logger.error(f"Cannot send debounced triggers: {e}")
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        with self.transaction() as conn:
+            per_key = {
+                key: {"received": received, "sent": sent, "suppressed": sup}
+                for key, received, sent, sup in conn.execute(
+                    "SELECT key, received, sent, suppressed FROM trigger_stats"
+                ).fetchall()
+            }
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM debounced_triggers"
+            ).fetchone()[0]
+        return {
+            "window": self.window,
+            "pending": pending,
+            "received": sum(s["received"] for s in per_key.values()),
+            "sent": sum(s["sent"] for s in per_key.values()),
+            "suppressed": sum(s["suppressed"] for s in per_key.values()),
+            "components": per_key,
+        }
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import fnmatch
+import re
+
+
+def compile_patterns(patterns):
+    """Return a match function for shell-style patterns, None for any."""
+    if patterns is None:
+        return None
+    if not patterns:
+        return lambda ref: False
+    return re.compile(
+        "|".join(fnmatch.translate(pattern) for pattern in patterns)
+    ).match
+
+
+def payload_ref(payload):
+    """Full ref name of a GitHub push, GitLab job or pipeline event."""
+    attributes = payload.get("object_attributes")
+    if isinstance(attributes, dict):
+        # GitLab pipeline
+        ref, tag = attributes.get("ref"), attributes.get("tag")
+    else:
+        ref, tag = payload.get("ref"), payload.get("tag")
+    if not isinstance(ref, str):
+        return None
+    if ref.startswith("refs/"):
+        return ref
+    return ("refs/tags/" if tag else "refs/heads/") + ref
+
+
+class EventFilter:
+    """
+    Events and refs for which builds are triggered:
+
+      {
+        "events": ["push"],
+        "refs": ["refs/tags/v*"],
+        "components": {
+          "core-qrexec": ["refs/tags/v*", "refs/heads/main"]
+        }
+      }
+
+    Refs listed for a component replace "refs" for it. Events without a
+    ref are only filtered by "events". Anything not listed is accepted.
+    """
+
+    def __init__(self, rules=None):
+        rules = rules or {}
+        events = rules.get("events")
+        self.events = None if events is None else frozenset(events)
+        self.refs = compile_patterns(rules.get("refs"))
+        self.components = {
+            component: compile_patterns(patterns)
+            for component, patterns in rules.get("components", {}).items()
+        }
+
+    def accepts(self, event, component, ref):
+        if self.events is not None and event is not None:
+            if event not in self.events:
+                return False
+        if ref is None:
+            return True
+        match = self.components.get(component, self.refs)
+        return match is None or bool(match(ref))
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Longest time a qrexec call to a build VM may take
+QREXEC_TIMEOUT = 300
+
+# Calls to build VMs running at the same time, for all deliveries
+MAX_WORKERS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # created on first use, so that each uwsgi worker gets its own threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="qrexec"
+            )
+        return _executor
+
+
+def qrexec(vm, service, input_data=None, timeout=QREXEC_TIMEOUT):
+    """
+    Call service in vm. Raise subprocess.CalledProcessError if it failed,
+    or subprocess.TimeoutExpired if it took longer than timeout.
+    """
+    cmd = ["qrexec-client-vm", "--", vm, service]
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+    ) as p:
+        try:
+            p.communicate(input_data, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{vm}: {service} timed out after {timeout}s")
+            p.kill()
+            p.communicate()
+            raise
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def fan_out(vms, call, *args):
+    """
+    Run call(vm, *args) for every VM concurrently, without waiting for
+    them. Return futures of the calls.
+    """
+    executor = get_executor()
+    futures = []
+    for vm in vms:
+        future = executor.submit(call, vm, *args)
+        future.add_done_callback(_log_failure)
+        futures.append(future)
+    return futures
+
+
+def _log_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"qrexec call failed: {exc!r}")
@@ -21,31 +21,24 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import sys
-import subprocess
-import os
 import re
 
+from . import fanout
+from .build_vms import default_path, get_build_vm_list
+
 _trailing_space = re.compile(rb"[ \r\t\f\v]*\n")
 
 
 class Service:
-    def __init__(self):
-        self.config_path = os.path.join(
-            os.environ.get("HOME", "/"),
-            ".config",
-            "qubes-builder-github",
-            "build-vms.list",
-        )
+    def __init__(self, config=None):
+        self.config_path = default_path()
+        self.build_vms = get_build_vm_list(self.config_path)
+        self.timeout = fanout.QREXEC_TIMEOUT
 
     def qrexec(self, vm, service, input_data=None):
-        with subprocess.Popen(
-            ["qrexec-client-vm", "--", vm, service],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-        ) as p:
-            p.communicate(input_data)
+        fanout.qrexec(vm, service, input_data, timeout=self.timeout)
 
-    def handle(self, obj):
+    def handle(self, obj, event=None):
         try:
             if obj["action"] != "created":
                 return
@@ -78,10 +71,14 @@ class Service:
         # strip stuff after signature and add trailing newline
         comment_body = comment_body[: offset + len(end_index)] + b"\n"
         try:
-            with open(self.config_path) as config:
-                build_vms = config.read().splitlines()
+            build_vms = self.build_vms.get()
         except IOError as e:
             print(str(e), file=sys.stderr)
             return
-        for vm in build_vms:
-            self.qrexec(vm, "qubesbuilder.ProcessGithubCommand", comment_body)
+        # build VMs are called concurrently
+        return fanout.fan_out(
+            build_vms,
+            self.qrexec,
+            "qubesbuilder.ProcessGithubCommand",
+            comment_body,
+        )
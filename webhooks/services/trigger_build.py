@@ -20,31 +20,59 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import logging
 import sys
-import subprocess
-import os
 import re
 
+from . import fanout
+from .build_vms import default_path, get_build_vm_list
+from .debounce import Debouncer
+from .event_filter import EventFilter, payload_ref
+
+logger = logging.getLogger(__name__)
+
+
+# Triggers of the same component received within this many seconds are sent
+# once, at the end of the window; disabled unless "trigger_build_debounce" is
+# set in the config (a spool is needed too)
+DEBOUNCE_WINDOW = 0
+
 
 class Service:
-    def __init__(self):
-        self.config_path = os.path.join(
-            os.environ.get("HOME", "/"),
-            ".config",
-            "qubes-builder-github",
-            "build-vms.list",
-        )
+    def __init__(self, config=None):
+        config = config or {}
+        self.config_path = default_path()
+        self.build_vms = get_build_vm_list(self.config_path)
+        self.timeout = fanout.QREXEC_TIMEOUT
+        self.event_filter = EventFilter(config.get("trigger_build_filters"))
+        self.debouncer = None
+        window = config.get("trigger_build_debounce", DEBOUNCE_WINDOW)
+        if window and config.get("spool"):
+            self.debouncer = Debouncer(config["spool"], window, self.trigger)
+            # triggers pending from a previous run are sent without waiting
+            # for a new one
+            self.debouncer.start()
 
     def qrexec(self, vm, service, input_data=None):
-        with subprocess.Popen(
-            ["qrexec-client-vm", "--", vm, service],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-        ) as p:
-            if input_data is not None:
-                p.communicate(input_data)
+        fanout.qrexec(vm, service, input_data, timeout=self.timeout)
 
-    def handle(self, payload):
+    def trigger(self, repo_name):
+        try:
+            build_vms = self.build_vms.get()
+        except IOError as e:
+            print(str(e), file=sys.stderr)
+            return
+        # build VMs are called concurrently
+        return fanout.fan_out(
+            build_vms, self.qrexec, "qubesbuilder.TriggerBuild+" + repo_name
+        )
+
+    def stats(self):
+        if self.debouncer is None:
+            return {}
+        return self.debouncer.stats()
+
+    def handle(self, payload, event=None):
         try:
             if "repository" not in payload:
                 return
@@ -54,13 +82,14 @@ class Service:
                 repo_name = prefixed_repo.group(1)
             else:
                 repo_name = repo_name.split("/")[-1]
-            try:
-                with open(self.config_path) as config:
-                    build_vms = config.read().splitlines()
-            except IOError as e:
-                print(str(e), file=sys.stderr)
+            ref = payload_ref(payload)
+            if not self.event_filter.accepts(event, repo_name, ref):
+                logger.debug(f"{repo_name}: ignoring {event} event ({ref})")
+                return
+            if self.debouncer is not None:
+                if not self.debouncer.trigger(repo_name):
+                    logger.info(f"{repo_name}: trigger already pending")
                 return
-            for vm in build_vms:
-                self.qrexec(vm, "qubesbuilder.TriggerBuild+" + repo_name)
+            return self.trigger(repo_name)
         except KeyError:
             pass
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    delivery_id TEXT PRIMARY KEY,
+    service TEXT NOT NULL,
+    event TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    received REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    worker_pid INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS deliveries_state
+    ON deliveries (state, not_before, received);
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SQLiteDatabase:
+    """
+    SQLite database shared by threads and processes of the webhooks
+    application, with a connection per thread.
+    """
+
+    schema = ""
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect().executescript(self.schema)
+
+    def _connect(self):
+        # a connection per thread, the database is shared between processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def transaction(self):
+        return _Transaction(self._connect())
+
+
+class DeliverySpool(SQLiteDatabase):
+    """
+    Webhook deliveries stored in a SQLite database before being processed.
+
+    Each delivery is stored once, by its delivery ID, so deliveries sent
+    again by GitHub are ignored. Deliveries are processed at least once:
+    deliveries claimed by a process which died are processed again.
+    """
+
+    schema = SCHEMA
+
+    def __init__(
+        self, path, max_attempts=5, backoff=10.0, keep_days=7, timeout=30
+    ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.keep_days = keep_days
+        super().__init__(path, timeout=timeout)
+
+    def add(self, delivery_id, service, event, payload):
+        """Store a delivery. Return False if it was already received."""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO deliveries"
+                " (delivery_id, service, event, payload, received)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (delivery_id, service, event, payload, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def recover(self):
+        """Put back deliveries claimed by processes not running anymore."""
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT delivery_id, worker_pid FROM deliveries"
+                " WHERE state = 'processing'"
+            ).fetchall()
+            for delivery_id, worker_pid in rows:
+                if worker_pid is None or not pid_alive(worker_pid):
+                    conn.execute(
+                        "UPDATE deliveries SET state = 'pending',"
+                        " worker_pid = NULL WHERE delivery_id = ?",
+                        (delivery_id,),
+                    )
+
+    def claim(self):
+        """
+        Claim the oldest delivery ready to be processed. Return
+        (delivery_id, service, event, payload) or None.
+        """
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT delivery_id, service, event, payload FROM deliveries"
+                " WHERE state = 'pending' AND not_before <= ?"
+                " ORDER BY received LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE deliveries SET state = 'processing', worker_pid = ?"
+                " WHERE delivery_id = ?",
+                (os.getpid(), row[0]),
+            )
+            return row
+
+    def complete(self, delivery_id):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE deliveries SET state = 'done', worker_pid = NULL,"
+                " error = NULL WHERE delivery_id = ?",
+                (delivery_id,),
+            )
+
+    def fail(self, delivery_id, error):
+        """Retry a delivery later, give up after max_attempts."""
+        with self.transaction() as conn:
+            (attempts,) = conn.execute(
+                "SELECT attempts + 1 FROM deliveries WHERE delivery_id = ?",
+                (delivery_id,),
+            ).fetchone()
+            if attempts >= self.max_attempts:
+                state = "failed"
+                logger.error(
+                    f"{delivery_id}: giving up after {attempts} attempts: {error}"
+                )
+            else:
+                state = "pending"
+            conn.execute(
+                "UPDATE deliveries SET state = ?, attempts = ?,"
+                " not_before = ?, worker_pid = NULL, error = ?"
+                " WHERE delivery_id = ?",
+                (
+                    state,
+                    attempts,
+                    time.time() + self.backoff * 2 ** (attempts - 1),
+                    error,
+                    delivery_id,
+                ),
+            )
+
+    def purge(self):
+        """
+        Forget processed deliveries older than keep_days. Deliveries sent
+        again after that are processed again.
+        """
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM deliveries WHERE state = 'done' AND received < ?",
+                (time.time() - self.keep_days * 86400,),
+            )
+
+    def counts(self):
+        with self.transaction() as conn:
+            return dict(
+                conn.execute(
+                    "SELECT state, COUNT(*) FROM deliveries GROUP BY state"
+                ).fetchall()
+            )
+
+
+class _Transaction:
+    """Run statements of a 'with' block in an immediate transaction."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+
+
+class SpoolWorkers:
+    """
+    Threads processing deliveries of a spool with handler(service, event,
+    payload). They are started when the application is loaded, and again
+    on first use in a process forked after that.
+    """
+
+    def __init__(self, spool, handler, count=2, poll_interval=1.0):
+        self.spool = spool
+        self.handler = handler
+        self.count = count
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+
+    def start(self):
+        with self._cond:
+            # threads don't survive fork, start them again in a new process
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.spool.recover()
+            self.spool.purge()
+            self._threads = [
+                threading.Thread(
+                    target=self._run, name=f"spool-worker-{i}", daemon=True
+                )
+                for i in range(self.count)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def notify(self):
+        self.start()
+        with self._cond:
+            self._cond.notify()
+
+    def process_one(self):
+        """Process one delivery, return False if none is ready."""
+        delivery = self.spool.claim()
+        if delivery is None:
+            return False
+        delivery_id, service, event, payload = delivery
+        try:
+            self.handler(service, event, payload)
+        except Exception as e:
+            logger.exception(f"{delivery_id}: {service} failed")
+            self.spool.fail(delivery_id, f"{e.__class__.__name__}: {e}")
+        else:
+            self.spool.complete(delivery_id)
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if self.process_one():
+                    continue
+            except sqlite3.Error as e:
+                logger.error(f"Cannot process deliveries: {e}")
+            # deliveries may be added by other processes, or become ready
+            # to be retried
+            with self._cond:
+                self._cond.wait(timeout=self.poll_interval)
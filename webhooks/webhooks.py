@@ -28,6 +28,8 @@ import hashlib
 
 from flask import Flask, jsonify, request, Response
 
+from spool import DeliverySpool, SpoolWorkers
+
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -55,7 +57,17 @@ def read_config():
       "services": [
         "trigger_build",
         "process_comment"
-      ]
+      ],
+      "spool": "/home/user/webhooks/spool.db",
+      "workers": 2,
+      "trigger_build_debounce": 10,
+      "trigger_build_filters": {
+        "events": ["push"],
+        "refs": ["refs/tags/v*"],
+        "components": {
+          "core-qrexec": ["refs/tags/v*", "refs/heads/main"]
+        }
+      }
     }
     """
     config_path = os.environ.get(
@@ -67,11 +79,53 @@ def read_config():
     if not conf.get("services"):
         raise AttributeError("Services not provided")
 
+    conf.setdefault(
+        "spool", os.path.join(os.path.dirname(config_path), "spool.db")
+    )
     return conf
 
 
+def load_services(config):
+    """Instantiate services once, they are shared by every request."""
+    registry = {}
+    for service_name in config["services"]:
+        try:
+            module = importlib.import_module("services.%s" % service_name)
+        except (ImportError, ModuleNotFoundError, TypeError):
+            logger.exception(f"Cannot import service {service_name}")
+            continue
+        registry[service_name] = module.Service(config)
+    return registry
+
+
+def get_service(service_name):
+    try:
+        return service_registry[service_name]
+    except KeyError:
+        raise ApiError("Cannot import service", status_code=500)
+
+
+def process_delivery(service_name, event, payload_data):
+    service = get_service(service_name)
+    payload = json.loads(payload_data)
+    # wait for calls to build VMs, so that the delivery is processed again
+    # if they fail
+    for future in service.handle(payload, event=event) or []:
+        future.result()
+
+
 # read local config
 webhooks_config = read_config()
+service_registry = load_services(webhooks_config)
+
+# Deliveries are stored and processed in background, by each worker process
+spool = DeliverySpool(webhooks_config["spool"])
+spool_workers = SpoolWorkers(
+    spool, process_delivery, count=webhooks_config.get("workers", 2)
+)
+# deliveries left by a previous run are processed without waiting for a new
+# one (with lazy-apps, the application is loaded by each worker process)
+spool_workers.start()
 
 
 # begin flask app
@@ -82,6 +136,28 @@ def handle_invalid_usage(error):
     return response
 
 
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    """
+    GET deliveries and services counters, with the webhook secret in the
+    X-Webhooks-Token header
+    """
+    secret = webhooks_config.get("webhook_secret")
+    token = request.headers.get("X-Webhooks-Token", "")
+    if not secret or not hmac.compare_digest(secret.encode(), token.encode()):
+        return Response("forbidden", status=403, mimetype="text/plain")
+    return jsonify(
+        {
+            "deliveries": spool.counts(),
+            "services": {
+                service_name: service.stats()
+                for service_name, service in service_registry.items()
+                if hasattr(service, "stats")
+            },
+        }
+    )
+
+
 @app.route("/api/services/<string:service_name>", methods=["POST"])
 def run(service_name):
     """
@@ -123,18 +199,31 @@ def run(service_name):
 
     if service_name not in webhooks_config.get("services", []):
         raise ApiError("Unknown service", status_code=404)
+    get_service(service_name)
 
     try:
-        module = importlib.import_module("services.%s" % service_name)
-    except (ImportError, ModuleNotFoundError, TypeError):
-        raise ApiError("Cannot import service", status_code=500)
-
-    service = module.Service()
-    payload = json.loads(payload_data)
-    service.handle(payload)
+        json.loads(payload_data)
+    except ValueError:
+        raise ApiError("Invalid payload", status_code=400)
+
+    # GitHub sends a delivery again with the same ID
+    delivery_id = (
+        request.headers.get("X-GitHub-Delivery")
+        or request.headers.get("X-Gitlab-Event-UUID")
+        or hashlib.sha256(payload_data).hexdigest()
+    )
+    if spool.add(
+        f"{service_name}:{delivery_id}",
+        service_name,
+        event_type_github or event_type_gitlab,
+        payload_data,
+    ):
+        spool_workers.notify()
+    else:
+        logger.info(f"Ignoring delivery {delivery_id} already received")
 
     # return Response("OK", status=200, mimetype='application/json')
-    return Response("OK", status=200, mimetype="text/plain")
+    return Response("Accepted", status=202, mimetype="text/plain")
 
 
 if __name__ == "__main__":